@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from mapzebview.volumes import atomic_write
+
+
+class RegionAtlas:
+    """Label volume holding the most specific region at every voxel, for point-to-region lookups
+
+    Region ids follow the preorder of the region structure, which is the same order as the
+    continuous ids of the region tree. Voxels are labeled with id + 1, 0 means outside of all regions.
+    Regions are painted in preorder, so each voxel ends up with the deepest region containing it,
+    all regions above it are given by the ancestor table.
+    """
+
+    # Voxel size of the MapZeBrain reference brain along x, y and z in micrometers
+    voxel_size: Tuple[float, float, float] = (0.798, 0.798, 2.0)
+
+    def __init__(self, names: List[str], parents: np.ndarray, labels: np.ndarray, voxel_counts: np.ndarray,
+                 version: str, sources: List[Union[List[int], None]] = None):
+        self.names = names
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.labels = labels
+        self.shape = tuple(int(s) for s in labels.shape[:3])
+        self.ids: Dict[str, int] = {name: i for i, name in enumerate(names)}
+
+        # Number of voxels labeled with each region, excluding those of its subregions
+        self.voxel_counts = np.asarray(voxel_counts, dtype=np.int64)
+        self.version = version
+
+        # Modification time and size of the file each region was loaded from, see source_stamps
+        self.sources = sources
+
+        # ancestors[i] is the path from the top level region down to region i, padded with -1.
+        # The additional last row is selected by id -1 and holds no regions.
+        depths = np.zeros(len(names), dtype=np.int32)
+        for i, parent in enumerate(self.parents):
+            depths[i] = 0 if parent < 0 else depths[parent] + 1
+        self.ancestors = np.full((len(names) + 1, int(depths.max(initial=0)) + 1), -1, dtype=np.int32)
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.ancestors[i] = self.ancestors[parent]
+            self.ancestors[i, depths[i]] = i
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike]) -> RegionAtlas:
+        """Open atlas written by build_atlas, the label volume is memory-mapped"""
+
+        with open(atlas_metadata_path(path), 'r') as f:
+            metadata = json.load(f)
+
+        labels = np.load(atlas_label_path(path), mmap_mode='r')
+
+        return cls(metadata['names'], np.array(metadata['parents']), labels,
+                   np.array(metadata['voxel_counts']), metadata['version'], metadata.get('sources'))
+
+    def lookup(self, points: np.ndarray) -> np.ndarray:
+        """Return id of the most specific region for each of the (N, 3) points, -1 for points outside of all regions"""
+
+        coordinates = np.asarray(points)[:, :3].astype(np.intp)
+        inside = np.all((coordinates >= 0) & (coordinates < np.array(self.shape)), axis=1)
+
+        # Flat indices into the label volume, points out of bounds read voxel 0 and are masked afterwards
+        coordinates[~inside] = 0
+        flat = (coordinates[:, 0] * self.shape[1] + coordinates[:, 1]) * self.shape[2] + coordinates[:, 2]
+
+        ids = self.labels.reshape(-1)[flat].astype(np.int32) - 1
+        ids[~inside] = -1
+
+        return ids
+
+    def ancestor_paths(self, ids: np.ndarray) -> np.ndarray:
+        """Return (N, depth) region ids from the top level down to each region in ids, padded with -1"""
+        return self.ancestors[ids]
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return ids and ancestor paths of the regions the (N, 3) points fall in"""
+
+        ids = self.lookup(points)
+
+        return ids, self.ancestor_paths(ids)
+
+    def name_of(self, region_id: int) -> Union[str, None]:
+        return self.names[region_id] if region_id >= 0 else None
+
+    def roll_up(self, values: np.ndarray) -> np.ndarray:
+        """Return sum of values over each region and all of its subregions"""
+
+        totals = np.array(values, copy=True)
+
+        # Children always come after their parent in preorder
+        for i in range(len(self.names) - 1, -1, -1):
+            if self.parents[i] >= 0:
+                totals[self.parents[i]] += totals[i]
+
+        return totals
+
+    @property
+    def region_volumes(self) -> np.ndarray:
+        """Return volume of each region including its subregions in mm^3"""
+        return self.roll_up(self.voxel_counts) * np.prod(self.voxel_size) * 1e-9
+
+
+class RegionCounts:
+    """Number of points within each region and its subregions, with densities and fractions derived from them"""
+
+    def __init__(self, atlas: RegionAtlas, direct_counts: np.ndarray, total: int):
+        self.names = atlas.names
+        self.direct_counts = direct_counts
+        self.counts = atlas.roll_up(direct_counts)
+        self.total = total
+
+        volumes = atlas.region_volumes
+        self.densities = np.divide(self.counts, volumes, out=np.full(volumes.shape, np.nan), where=volumes > 0)
+        self.fractions = self.counts / total if total > 0 else np.zeros(self.counts.shape)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({'count': self.counts, 'density_per_mm3': self.densities, 'fraction': self.fractions},
+                            index=pd.Index(self.names, name='region'))
+
+
+_region_count_cache: OrderedDict[Tuple[str, str], RegionCounts] = OrderedDict()
+region_count_cache_size: int = 32
+
+
+def points_hash(points: np.ndarray) -> str:
+    points = np.ascontiguousarray(points)
+    return hashlib.sha1(str((points.shape, points.dtype.str)).encode() + points.tobytes()).hexdigest()
+
+
+def count_points(atlas: RegionAtlas, points: np.ndarray) -> RegionCounts:
+    """Return counts of points per region from a single bincount over their labels
+
+    Results are cached per content of points and atlas version
+    """
+
+    key = (points_hash(points), atlas.version)
+    if key in _region_count_cache:
+        _region_count_cache.move_to_end(key)
+        return _region_count_cache[key]
+
+    # Points outside of all regions are counted in the first bin
+    direct_counts = np.bincount(atlas.lookup(points) + 1, minlength=len(atlas.names) + 1)[1:]
+    region_counts = RegionCounts(atlas, direct_counts, points.shape[0])
+
+    _region_count_cache[key] = region_counts
+    while len(_region_count_cache) > region_count_cache_size:
+        _region_count_cache.popitem(last=False)
+
+    return region_counts
+
+
+def flatten_structure(structure: dict) -> Tuple[List[str], np.ndarray]:
+    """Return names of all regions in preorder and the index of each one's parent (-1 for top level regions)"""
+
+    names = []
+    parents = []
+
+    def _add(name: str, data: Union[dict, float], parent: int):
+        idx = len(names)
+        names.append(name)
+        parents.append(parent)
+
+        if isinstance(data, dict):
+            for n, d in data.items():
+                _add(n, d, idx)
+
+    for name, data in structure.items():
+        _add(name, data, -1)
+
+    return names, np.array(parents, dtype=np.int32)
+
+
+def atlas_label_path(path: Union[str, os.PathLike]) -> str:
+    return f'{path}.labels.npy'
+
+
+def atlas_metadata_path(path: Union[str, os.PathLike]) -> str:
+    return f'{path}.json'
+
+
+def source_stamps(names: List[str], source_path: Callable[[str], str] = None) -> List[Union[List[int], None]]:
+    """Return [modification time in ns, size] of the file each region is loaded from, None for missing files"""
+
+    if source_path is None:
+        return [None] * len(names)
+
+    stamps = []
+    for name in names:
+        try:
+            stat = os.stat(source_path(name))
+            stamps.append([stat.st_mtime_ns, stat.st_size])
+        except OSError as _:
+            stamps.append(None)
+
+    return stamps
+
+
+def build_atlas(path: Union[str, os.PathLike], structure: dict,
+                load_mask: Callable[[str], Union[np.ndarray, None]],
+                source_path: Callable[[str], str] = None,
+                progress: Callable[[float], None] = None):
+    """Paint masks of all regions in structure into a label volume and write it to path
+
+    load_mask returns the (x, y, z) mask of a region by name, or None if the region has no volume data.
+    source_path returns the file load_mask reads a region from, its stamps are part of the atlas version.
+    """
+
+    if progress is None:
+        progress = lambda _: None
+
+    names, parents = flatten_structure(structure)
+    dtype = np.uint8 if len(names) < 2 ** 8 else np.uint16
+
+    with atomic_write(atlas_metadata_path(path)) as metadata_path, \
+            atomic_write(atlas_label_path(path)) as label_path:
+        labels = None
+        for i, name in enumerate(names):
+            mask = load_mask(name)
+            progress((i + 1) / len(names))
+
+            if mask is None:
+                print(f'WARNING: no volume data for region {name}, skipped in atlas')
+                continue
+
+            if labels is None:
+                labels = np.lib.format.open_memmap(label_path, mode='w+', dtype=dtype, shape=mask.shape[:3])
+
+            # Only touch the bounding box of the region
+            mask = mask.reshape(mask.shape[:3]) > 0
+            bounds = []
+            for axis in range(3):
+                nonzero = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+                bounds.append(slice(nonzero[0], nonzero[-1] + 1) if nonzero.size > 0 else slice(0, 0))
+            bounds = tuple(bounds)
+
+            labels[bounds][mask[bounds]] = i + 1
+
+        if labels is None:
+            raise ValueError('No volume data for any region in structure')
+
+        labels.flush()
+
+        # Count voxels of each region one slab at a time
+        voxel_counts = np.zeros(len(names) + 1, dtype=np.int64)
+        for start in range(0, labels.shape[0], 64):
+            voxel_counts += np.bincount(labels[start:start + 64].ravel(), minlength=len(names) + 1)
+        voxel_counts = voxel_counts[1:].tolist()
+        del labels
+
+        # Stamp sources only after loading, load_mask may have downloaded them
+        metadata = {'names': names, 'parents': parents.tolist(), 'voxel_counts': voxel_counts,
+                    'sources': source_stamps(names, source_path)}
+        metadata['version'] = hashlib.sha1(json.dumps(metadata).encode()).hexdigest()
+
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+
+
+def load_cached_atlas(path: Union[str, os.PathLike], structure: dict,
+                      load_mask: Callable[[str], Union[np.ndarray, None]],
+                      source_path: Callable[[str], str] = None,
+                      progress: Callable[[float], None] = None) -> RegionAtlas:
+    """Return atlas cached at path, building it first if it is missing, was built for a different structure
+    or any region file returned by source_path was changed since
+    """
+
+    names, parents = flatten_structure(structure)
+
+    if os.path.exists(atlas_label_path(path)) and os.path.exists(atlas_metadata_path(path)):
+        try:
+            atlas = RegionAtlas.open(path)
+            if atlas.names == names and np.array_equal(atlas.parents, parents) \
+                    and atlas.sources == source_stamps(names, source_path):
+                return atlas
+        except KeyError as _:
+            # Atlas was written by an earlier version
+            pass
+
+    print(f'Build region atlas {path}')
+    build_atlas(path, structure, load_mask, source_path=source_path, progress=progress)
+
+    return RegionAtlas.open(path)
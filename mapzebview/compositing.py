@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+from pyqtgraph.Qt import QtCore, QtGui
+
+from mapzebview.volumes import PackedRegionVolume
+
+
+def bit_color_lut(colors: np.ndarray) -> np.ndarray:
+    """Return (256, 3) table holding the summed colors of all bits set in each byte value
+
+    colors is an (8, 3) array with one RGB color per bit
+    """
+
+    bits = (np.arange(256)[:, None] >> np.arange(8)[None, :]) & 1
+
+    return bits.astype(np.float32) @ colors.astype(np.float32)
+
+
+def word_color_lut(region_volume: PackedRegionVolume, word_idx: int,
+                   region_colors: Dict[str, QtGui.QColor]) -> np.ndarray:
+    return members_color_lut(region_volume.word_members(word_idx), region_colors)
+
+
+def members_color_lut(members: Dict[str, int], region_colors: Dict[str, QtGui.QColor]) -> np.ndarray:
+    """Return color table of a word from the bit position of each of its regions"""
+
+    colors = np.zeros((PackedRegionVolume.bits_per_word, 3), dtype=np.float32)
+    for name, bit in members.items():
+        r, g, b, a = region_colors[name].getRgbF()
+        colors[bit] = np.array([r, g, b]) * a * 255
+
+    return bit_color_lut(colors)
+
+
+def composite_slices(layers: List[Tuple[np.ndarray, QtCore.QRectF, np.ndarray]]) \
+        -> Union[Tuple[np.ndarray, QtCore.QRectF], None]:
+    """Blend packed word slices into one RGBA image covering the union of their display rectangles
+
+    Each layer is a (packed slice, display rectangle, color lookup table) tuple. The colors of
+    all regions are summed with one table lookup per word, so the cost grows with the
+    number of words (8 regions each) rather than with the number of regions.
+    """
+
+    if len(layers) == 0:
+        return None
+
+    rect = QtCore.QRectF(layers[0][1])
+    for _, layer_rect, _ in layers[1:]:
+        rect = rect.united(layer_rect)
+
+    x0, y0 = int(rect.x()), int(rect.y())
+    rgb = np.zeros((int(rect.height()), int(rect.width()), 3), dtype=np.float32)
+    for word_slice, layer_rect, lut in layers:
+        x, y = int(layer_rect.x()) - x0, int(layer_rect.y()) - y0
+        h, w = word_slice.shape[:2]
+        rgb[y:y + h, x:x + w] += lut[word_slice]
+
+    rgba = np.empty((*rgb.shape[:2], 4), dtype=np.uint8)
+    np.clip(rgb, 0, 255, out=rgb)
+    rgba[:, :, :3] = rgb
+    rgba[:, :, 3] = np.where(rgb.any(axis=-1), 255, 0)
+
+    return rgba, rect
@@ -1,24 +1,28 @@
 from __future__ import annotations
 
 import os
-from typing import Dict, TYPE_CHECKING, Tuple, Union
+from typing import Dict, TYPE_CHECKING, Union
 
 import numpy as np
-import stl
 from pyqtgraph.Qt import QtGui, QtWidgets
 
 if TYPE_CHECKING:
     from main import Window
+    from mapzebview.atlas import RegionAtlas
+    from mapzebview.meshes import RegionMesh
+    from mapzebview.volumes import PackedRegionVolume, VolumePyramid
 
 use_pretty_plots: bool = False
 default_marker_name = 'jf5Tg'
 debug: bool = False
 window: Union[Window, None] = None
 
-marker_image: Union[np.ndarray, None] = None
+marker_image: Union[np.ndarray, VolumePyramid, None] = None
 
-regions: Dict[str, Tuple[np.ndarray, Union[None, stl.Mesh]]] = {}
+regions: Dict[str, Union[None, RegionMesh]] = {}
+region_volume: Union[PackedRegionVolume, None] = None
 region_colors: Dict[str, QtGui.QColor] = {}
+region_atlas: Union[RegionAtlas, None] = None
 
 roi_set_items: Dict[str, QtWidgets.QTreeWidgetItem] = {}
 map_items: Dict[str, QtWidgets.QTreeWidgetItem] = {}
@@ -27,8 +31,7 @@ map_items: Dict[str, QtWidgets.QTreeWidgetItem] = {}
 def marker_path():
     path = os.path.join(os.getenv('LOCALAPPDATA'), 'mapzebview', 'markers')
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
     return path
 
@@ -36,7 +39,6 @@ def marker_path():
 def region_path() -> str:
     path = os.path.join(os.getenv('LOCALAPPDATA'), 'mapzebview', 'regions')
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
     return path
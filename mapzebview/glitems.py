@@ -0,0 +1,717 @@
+from __future__ import annotations
+
+import math
+from typing import Dict, Tuple
+
+import numpy as np
+from OpenGL import GL
+from OpenGL.GL import shaders
+from pyqtgraph import opengl as gl
+from pyqtgraph.opengl.items.GLScatterPlotItem import _is_compatibility_profile
+from pyqtgraph.Qt import QtGui
+from PySide6 import QtOpenGL
+
+
+class PointCloudItem(gl.GLScatterPlotItem):
+    """Draws any number of named point sets from one shared vertex buffer
+
+    Every point carries the slot of its set, which is looked up in a small color table
+    on the GPU. Showing, hiding and recoloring a set therefore only changes the table,
+    point positions are only uploaded again when sets are added or removed.
+
+    Points of each set are passed in progressive order (see spatial.progressive_order), so that
+    drawing only a prefix of a set gives an even subsample. How much of each set is drawn
+    depends on the camera distance and is limited to point_budget points in total.
+    Positions are only kept in the shared buffer, sets are appended to it and cut out of it.
+    """
+
+    max_sets: int = 128
+
+    # Grid spacing of the levels of detail, from coarse to fine
+    lod_cell_sizes: Tuple[float, ...] = (64., 32., 16., 8., 4., 2.)
+    # Draw the finest level whose cells are at least this many pixels apart on screen
+    lod_pixel_spacing: float = 2.
+    point_budget: int = 1_000_000
+
+    _cloud_shader_program = None
+
+    def __init__(self, **kwds):
+        gl.GLScatterPlotItem.__init__(self, **kwds)
+
+        self.set_slots: Dict[str, int] = {}
+        self.set_sizes: Dict[str, int] = {}
+        self.set_colors: Dict[str, Tuple[float, float, float, float]] = {}
+        self.set_visible: Dict[str, bool] = {}
+        self.set_level_counts: Dict[str, np.ndarray] = {}
+        self.set_offsets: Dict[str, int] = {}
+
+        self.set_ids: np.ndarray = None
+        self.lut = np.zeros((self.max_sets, 4), dtype=np.float32)
+
+        self.m_vbo_set_id = QtOpenGL.QOpenGLBuffer(QtOpenGL.QOpenGLBuffer.Type.VertexBuffer)
+        self.buffers_dirty = False
+
+    def add_set(self, name: str, positions: np.ndarray, level_counts: np.ndarray,
+                color: Tuple[float, float, float, float]):
+        """Append positions in progressive order for lod_cell_sizes, with level_counts from spatial.progressive_order"""
+
+        if name in self.set_slots:
+            return
+
+        free_slots = sorted(set(range(self.max_sets)) - set(self.set_slots.values()))
+        if len(free_slots) == 0:
+            print(f'WARNING: cannot display more than {self.max_sets} point sets, skip {name}')
+            return
+
+        self.set_slots[name] = free_slots[0]
+        self.set_sizes[name] = len(positions)
+        self.set_level_counts[name] = level_counts
+        self.set_visible[name] = True
+        self.set_color(name, color)
+
+        positions = np.asarray(positions, dtype=np.float32)
+        set_ids = np.full(len(positions), self.set_slots[name], dtype=np.float32)
+        if self.pos is None:
+            self.pos, self.set_ids = positions, set_ids
+        else:
+            self.pos = np.concatenate((self.pos, positions))
+            self.set_ids = np.concatenate((self.set_ids, set_ids))
+
+        self.update_buffers()
+
+    def remove_set(self, name: str):
+
+        if name not in self.set_slots:
+            return
+
+        start = self.set_offsets[name]
+        stop = start + self.set_sizes.pop(name)
+        if len(self.set_sizes) == 0:
+            self.pos, self.set_ids = None, None
+        else:
+            self.pos = np.concatenate((self.pos[:start], self.pos[stop:]))
+            self.set_ids = np.concatenate((self.set_ids[:start], self.set_ids[stop:]))
+
+        self.lut[self.set_slots.pop(name)] = 0.
+        del self.set_colors[name]
+        del self.set_visible[name]
+        del self.set_level_counts[name]
+
+        self.update_buffers()
+
+    def set_color(self, name: str, color: Tuple[float, float, float, float]):
+
+        if name not in self.set_slots:
+            return
+
+        self.set_colors[name] = color
+        self.update_lut(name)
+
+    def show_set(self, name: str, visible: bool = True):
+
+        if name not in self.set_slots:
+            return
+
+        self.set_visible[name] = visible
+        self.update_lut(name)
+
+    def update_lut(self, name: str):
+        # Fully transparent entries mark hidden sets
+        self.lut[self.set_slots[name]] = self.set_colors[name] if self.set_visible[name] else 0.
+        self.update()
+
+    def update_buffers(self):
+
+        # Start of each set within the shared buffer
+        sizes = list(self.set_sizes.values())
+        self.set_offsets = dict(zip(self.set_sizes, np.cumsum([0] + sizes[:-1]).tolist()))
+
+        self.buffers_dirty = True
+        self.update()
+
+    def draw_level(self) -> int:
+        """Return level of detail to draw, where len(lod_cell_sizes) stands for all points"""
+
+        view = self.view()
+        visible = [name for name, visible in self.set_visible.items() if visible]
+
+        # Size of one item unit on screen at the camera center
+        pixel_per_unit = view.height() / (2 * view.opts['distance'] * math.tan(math.radians(view.opts['fov']) / 2))
+
+        # Finest level whose cells are still far enough apart on screen
+        resolved = sum(cell_size * pixel_per_unit >= self.lod_pixel_spacing for cell_size in self.lod_cell_sizes)
+        level = len(self.lod_cell_sizes) if resolved == len(self.lod_cell_sizes) else max(resolved - 1, 0)
+
+        # Go coarser until all visible sets fit into the point budget
+        while level > 0 and sum(self.set_level_counts[name][level] for name in visible) > self.point_budget:
+            level -= 1
+
+        return level
+
+    @classmethod
+    def getShaderProgram(cls):
+
+        if cls._cloud_shader_program is not None:
+            return cls._cloud_shader_program
+
+        ctx = QtGui.QOpenGLContext.currentContext()
+        fmt = ctx.format()
+
+        if ctx.isOpenGLES():
+            core = fmt.version() >= (3, 0)
+            glsl_version = '#version 300 es\n' if core else '#version 100\n'
+        else:
+            core = fmt.version() >= (3, 1)
+            glsl_version = '#version 140\n' if core else '#version 120\n'
+
+        sources = {GL.GL_VERTEX_SHADER: _vertex_shader(core, cls.max_sets),
+                   GL.GL_FRAGMENT_SHADER: _fragment_shader(core)}
+        compiled = [shaders.compileShader([glsl_version, v], k) for k, v in sources.items()]
+        program = shaders.compileProgram(*compiled)
+
+        GL.glBindAttribLocation(program, 0, 'a_position')
+        GL.glBindAttribLocation(program, 1, 'a_set_id')
+        GL.glLinkProgram(program)
+
+        cls._cloud_shader_program = program
+
+        return program
+
+    def paint(self):
+        if self.pos is None:
+            return
+
+        self.setupGLState()
+
+        mat_mvp = np.array(self.mvpMatrix().data(), dtype=np.float32)
+        mat_modelview = np.array(self.modelViewMatrix().data(), dtype=np.float32)
+
+        view = self.view()
+        scale = 0 if self.pxMode else 2.0 * math.tan(math.radians(0.5 * view.opts['fov'])) / view.width()
+
+        # Positions and set ids only change with the sets themselves
+        if self.buffers_dirty:
+            self.upload_vbo(self.m_vbo_position, self.pos)
+            self.upload_vbo(self.m_vbo_set_id, self.set_ids)
+            self.buffers_dirty = False
+
+        context = QtGui.QOpenGLContext.currentContext()
+        if not context.isOpenGLES():
+            if _is_compatibility_profile(context):
+                GL.glEnable(GL.GL_POINT_SPRITE)
+            GL.glEnable(GL.GL_PROGRAM_POINT_SIZE)
+
+        program = self.getShaderProgram()
+
+        self.m_vbo_position.bind()
+        GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, False, 0, None)
+        self.m_vbo_position.release()
+
+        self.m_vbo_set_id.bind()
+        GL.glVertexAttribPointer(1, 1, GL.GL_FLOAT, False, 0, None)
+        self.m_vbo_set_id.release()
+
+        GL.glEnableVertexAttribArray(0)
+        GL.glEnableVertexAttribArray(1)
+
+        with program:
+            GL.glUniformMatrix4fv(GL.glGetUniformLocation(program, 'u_mvp'), 1, False, mat_mvp)
+            GL.glUniformMatrix4fv(GL.glGetUniformLocation(program, 'u_modelview'), 1, False, mat_modelview)
+            GL.glUniform1f(GL.glGetUniformLocation(program, 'u_scale'), scale)
+            GL.glUniform1f(GL.glGetUniformLocation(program, 'u_size'), self.size)
+            GL.glUniform4fv(GL.glGetUniformLocation(program, 'u_lut'), self.max_sets, self.lut)
+
+            # Draw prefix of each visible set
+            level = self.draw_level()
+            for name, visible in self.set_visible.items():
+                if visible:
+                    GL.glDrawArrays(GL.GL_POINTS, self.set_offsets[name], int(self.set_level_counts[name][level]))
+
+        GL.glDisableVertexAttribArray(0)
+        GL.glDisableVertexAttribArray(1)
+
+
+def _vertex_shader(core: bool, lut_size: int) -> str:
+    inp, out = ('in', 'out') if core else ('attribute', 'varying')
+
+    return f"""
+        uniform float u_scale;
+        uniform float u_size;
+        uniform mat4 u_modelview;
+        uniform mat4 u_mvp;
+        uniform vec4 u_lut[{lut_size}];
+        {inp} vec4 a_position;
+        {inp} float a_set_id;
+        {out} vec4 v_color;
+
+        void main() {{
+            v_color = u_lut[int(a_set_id + 0.5)];
+
+            // Move points of hidden sets out of the clip volume
+            if (v_color.a == 0.0) {{
+                gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+                gl_PointSize = 0.0;
+                return;
+            }}
+
+            gl_Position = u_mvp * a_position;
+            gl_PointSize = u_size;
+
+            if (u_scale != 0.0) {{
+                // Size in item coordinates, see GLScatterPlotItem
+                vec4 cpos = u_modelview * a_position;
+                gl_PointSize /= length(cpos.xyz) * u_scale;
+            }}
+        }}
+    """
+
+
+def _fragment_shader(core: bool) -> str:
+    inp = 'in' if core else 'varying'
+    frag_color = 'fragColor' if core else 'gl_FragColor'
+
+    return f"""
+        #ifdef GL_ES
+        precision mediump float;
+        #endif
+
+        {inp} vec4 v_color;
+        {'out vec4 fragColor;' if core else ''}
+        void main()
+        {{
+            vec2 xy = (gl_PointCoord - 0.5) * 2.0;
+            if (dot(xy, xy) <= 1.0) {frag_color} = v_color;
+            else discard;
+        }}
+    """
+
+
+class ScalarVolumeItem(gl.GLVolumeItem):
+    """Displays single channel 8 or 16 bit volume data through a color lookup table on the GPU
+
+    Data is uploaded as a one-channel 3D texture in slabs of upload_slab_size z-planes,
+    so that no full size RGBA or transposed copy of the volume is ever created.
+    Changing the lookup table only uploads its 256 entries.
+    """
+
+    upload_slab_size: int = 16
+
+    _scalar_shader_program = None
+
+    def __init__(self, data: np.ndarray, lut: np.ndarray, **kwds):
+        self.lut = np.ascontiguousarray(lut, dtype=np.uint8)
+        self.lut_texture = None
+        self._need_lut_upload = True
+
+        gl.GLVolumeItem.__init__(self, data, **kwds)
+
+    def setLookupTable(self, lut: np.ndarray):
+        self.lut = np.ascontiguousarray(lut, dtype=np.uint8)
+        self._need_lut_upload = True
+        self.update()
+
+    def _uploadData(self):
+        if self.texture is None:
+            self.texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_3D, self.texture)
+        filt = GL.GL_LINEAR if self.smooth else GL.GL_NEAREST
+        GL.glTexParameteri(GL.GL_TEXTURE_3D, GL.GL_TEXTURE_MIN_FILTER, filt)
+        GL.glTexParameteri(GL.GL_TEXTURE_3D, GL.GL_TEXTURE_MAG_FILTER, filt)
+        for wrap in (GL.GL_TEXTURE_WRAP_S, GL.GL_TEXTURE_WRAP_T, GL.GL_TEXTURE_WRAP_R):
+            GL.glTexParameteri(GL.GL_TEXTURE_3D, wrap, GL.GL_CLAMP_TO_EDGE)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+
+        shape = self.data.shape
+        internal_format, data_format, data_type, convert = self._texture_format()
+
+        context = QtGui.QOpenGLContext.currentContext()
+        if not context.isOpenGLES():
+            # Test texture dimensions first
+            GL.glTexImage3D(GL.GL_PROXY_TEXTURE_3D, 0, internal_format, *shape[:3], 0, data_format, data_type, None)
+            if GL.glGetTexLevelParameteriv(GL.GL_PROXY_TEXTURE_3D, 0, GL.GL_TEXTURE_WIDTH) == 0:
+                raise Exception('OpenGL failed to create 3D texture (%dx%dx%d); too large for this hardware.' % shape[:3])
+
+        # Allocate, then fill slab by slab
+        GL.glTexImage3D(GL.GL_TEXTURE_3D, 0, internal_format, *shape[:3], 0, data_format, data_type, None)
+        for z0 in range(0, shape[2], self.upload_slab_size):
+            slab = convert(np.ascontiguousarray(self.data[:, :, z0:z0 + self.upload_slab_size].transpose(2, 1, 0)))
+            GL.glTexSubImage3D(GL.GL_TEXTURE_3D, 0, 0, 0, z0, shape[0], shape[1], slab.shape[0],
+                               data_format, data_type, slab)
+        GL.glBindTexture(GL.GL_TEXTURE_3D, 0)
+
+        all_vertices = []
+        self.lists = {}
+        for ax in [0, 1, 2]:
+            for d in [-1, 1]:
+                vertices = self.drawVolume(ax, d)
+                self.lists[(ax, d)] = (len(all_vertices), len(vertices))
+                all_vertices.extend(vertices)
+
+        pos = np.array(all_vertices, dtype=np.float32)
+        vbo = self.m_vbo_position
+        if not vbo.isCreated():
+            vbo.create()
+        vbo.bind()
+        vbo.allocate(pos, pos.nbytes)
+        vbo.release()
+
+        self._needUpload = False
+
+    def _texture_format(self):
+        """Return (internal format, format, type, slab conversion) for the current data and context"""
+
+        context = QtGui.QOpenGLContext.currentContext()
+        core = context.format().version() >= ((3, 0) if context.isOpenGLES() else (3, 1))
+        wide = self.data.dtype == np.uint16
+
+        # Normalized 16 bit textures are not available in OpenGL ES, use the upper byte instead
+        if wide and context.isOpenGLES():
+            return GL.GL_R8 if core else GL.GL_LUMINANCE, GL.GL_RED if core else GL.GL_LUMINANCE, \
+                GL.GL_UNSIGNED_BYTE, lambda slab: (slab >> 8).astype(np.uint8)
+
+        if core:
+            return GL.GL_R16 if wide else GL.GL_R8, GL.GL_RED, \
+                GL.GL_UNSIGNED_SHORT if wide else GL.GL_UNSIGNED_BYTE, lambda slab: slab
+
+        return GL.GL_LUMINANCE16 if wide else GL.GL_LUMINANCE8, GL.GL_LUMINANCE, \
+            GL.GL_UNSIGNED_SHORT if wide else GL.GL_UNSIGNED_BYTE, lambda slab: slab
+
+    def _upload_lut(self):
+        if self.lut_texture is None:
+            self.lut_texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.lut_texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, self.lut.shape[0], 1, 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE,
+                        self.lut)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        self._need_lut_upload = False
+
+    @classmethod
+    def getShaderProgram(cls):
+
+        if cls._scalar_shader_program is not None:
+            return cls._scalar_shader_program
+
+        ctx = QtGui.QOpenGLContext.currentContext()
+        fmt = ctx.format()
+
+        if ctx.isOpenGLES():
+            core = fmt.version() >= (3, 0)
+            glsl_version = '#version 300 es\n' if core else ''
+        else:
+            core = fmt.version() >= (3, 1)
+            glsl_version = '#version 140\n' if core else ''
+
+        sources = {GL.GL_VERTEX_SHADER: _volume_vertex_shader(core),
+                   GL.GL_FRAGMENT_SHADER: _volume_fragment_shader(core)}
+        compiled = [shaders.compileShader([glsl_version, v], k) for k, v in sources.items()]
+        program = shaders.compileProgram(*compiled)
+
+        GL.glBindAttribLocation(program, 0, 'a_position')
+        GL.glBindAttribLocation(program, 1, 'a_texcoord')
+        GL.glLinkProgram(program)
+
+        cls._scalar_shader_program = program
+
+        return program
+
+    def paint(self):
+        if self.data is None:
+            return
+
+        if self._needUpload:
+            self._uploadData()
+        if self._need_lut_upload:
+            self._upload_lut()
+
+        self.setupGLState()
+
+        mat_mvp = np.array(self.mvpMatrix().data(), dtype=np.float32)
+
+        # Draw slices back to front along the axis closest to the viewing direction, see GLVolumeItem
+        cam_local = self.modelViewMatrix().inverted()[0].map(QtGui.QVector3D())
+        cam = cam_local - QtGui.QVector3D(*[x / 2. for x in self.data.shape[:3]])
+        cam = np.array([cam.x(), cam.y(), cam.z()])
+        ax = np.argmax(abs(cam))
+        offset, num_vertices = self.lists[(ax, 1 if cam[ax] > 0 else -1)]
+
+        program = self.getShaderProgram()
+
+        self.m_vbo_position.bind()
+        GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, False, 6 * 4, None)
+        GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, False, 6 * 4, GL.GLvoidp(3 * 4))
+        self.m_vbo_position.release()
+
+        GL.glActiveTexture(GL.GL_TEXTURE1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.lut_texture)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glBindTexture(GL.GL_TEXTURE_3D, self.texture)
+
+        GL.glEnableVertexAttribArray(0)
+        GL.glEnableVertexAttribArray(1)
+
+        with program:
+            GL.glUniformMatrix4fv(GL.glGetUniformLocation(program, 'u_mvp'), 1, False, mat_mvp)
+            GL.glUniform1i(GL.glGetUniformLocation(program, 'u_texture'), 0)
+            GL.glUniform1i(GL.glGetUniformLocation(program, 'u_lut'), 1)
+
+            GL.glDrawArrays(GL.GL_TRIANGLES, offset, num_vertices)
+
+        GL.glDisableVertexAttribArray(0)
+        GL.glDisableVertexAttribArray(1)
+
+        GL.glBindTexture(GL.GL_TEXTURE_3D, 0)
+        GL.glActiveTexture(GL.GL_TEXTURE1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+
+
+class SlicePlaneItem(gl.GLGraphicsItem.GLGraphicsItem):
+    """Unit square perpendicular to axis, showing a 2D slice on top of a flat tint
+
+    The slice is kept in a single channel 8 bit texture. A new slice of the same shape is written
+    into the existing texture with glTexSubImage2D, so moving the plane only uploads one slice.
+    flip_x mirrors the texture along volume axis 0, like the x inversion of the 3D view.
+    """
+
+    _plane_shader_program = None
+
+    def __init__(self, axis: int, color: Tuple[float, float, float, float], slice_alpha: float = 0.5,
+                 flip_x: bool = False, glOptions: str = 'additive', parentItem=None):
+        gl.GLGraphicsItem.GLGraphicsItem.__init__(self)
+        self.setGLOptions(glOptions)
+        self.setParentItem(parentItem)
+
+        self.axis = axis
+        self.color = color
+        self.slice_alpha = slice_alpha
+
+        self.slice_data = np.zeros((1, 1), dtype=np.uint8)
+        self.texture = None
+        self.texture_shape: Tuple[int, int] = None
+        self._need_slice_upload = True
+
+        # Unit square spanning the two remaining axes (u, v) with texture coordinates (s, t) = (v, u)
+        remaining = [i for i in range(3) if i != axis]
+        corners = np.array([[0, 0], [1, 0], [1, 1], [0, 0], [1, 1], [0, 1]], dtype=np.float32)
+        positions = np.zeros((6, 3), dtype=np.float32)
+        positions[:, remaining] = corners
+        texcoords = corners[:, ::-1].copy()
+        if flip_x and remaining[0] == 0:
+            texcoords[:, 1] = 1. - texcoords[:, 1]
+        self.vertexes = np.ascontiguousarray(np.hstack([positions, texcoords]))
+        self.m_vbo_position = QtOpenGL.QOpenGLBuffer(QtOpenGL.QOpenGLBuffer.Type.VertexBuffer)
+
+    def setSlice(self, data: np.ndarray):
+        """Set (u, v) uint8 slice, where u and v are the remaining volume axes in ascending order"""
+        self.slice_data = np.ascontiguousarray(data, dtype=np.uint8)
+        self._need_slice_upload = True
+        self.update()
+
+    def _upload_slice(self):
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        context = QtGui.QOpenGLContext.currentContext()
+        core = context.format().version() >= ((3, 0) if context.isOpenGLES() else (3, 1))
+        internal_format, data_format = (GL.GL_R8, GL.GL_RED) if core else (GL.GL_LUMINANCE, GL.GL_LUMINANCE)
+        height, width = self.slice_data.shape
+
+        if self.texture is None:
+            self.texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+
+        # Allocate only when the slice shape changes, e.g. for a new marker
+        if self.texture_shape != self.slice_data.shape:
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, internal_format, width, height, 0, data_format,
+                            GL.GL_UNSIGNED_BYTE, self.slice_data)
+            self.texture_shape = self.slice_data.shape
+        else:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, width, height, data_format,
+                               GL.GL_UNSIGNED_BYTE, self.slice_data)
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        self._need_slice_upload = False
+
+    @classmethod
+    def getShaderProgram(cls):
+
+        if cls._plane_shader_program is not None:
+            return cls._plane_shader_program
+
+        ctx = QtGui.QOpenGLContext.currentContext()
+        fmt = ctx.format()
+
+        if ctx.isOpenGLES():
+            core = fmt.version() >= (3, 0)
+            glsl_version = '#version 300 es\n' if core else ''
+        else:
+            core = fmt.version() >= (3, 1)
+            glsl_version = '#version 140\n' if core else ''
+
+        sources = {GL.GL_VERTEX_SHADER: _volume_vertex_shader(core, texcoord_size=2),
+                   GL.GL_FRAGMENT_SHADER: _plane_fragment_shader(core)}
+        compiled = [shaders.compileShader([glsl_version, v], k) for k, v in sources.items()]
+        program = shaders.compileProgram(*compiled)
+
+        GL.glBindAttribLocation(program, 0, 'a_position')
+        GL.glBindAttribLocation(program, 1, 'a_texcoord')
+        GL.glLinkProgram(program)
+
+        cls._plane_shader_program = program
+
+        return program
+
+    def paint(self):
+
+        if self._need_slice_upload:
+            self._upload_slice()
+
+        vbo = self.m_vbo_position
+        if not vbo.isCreated():
+            vbo.create()
+            vbo.bind()
+            vbo.allocate(self.vertexes, self.vertexes.nbytes)
+            vbo.release()
+
+        self.setupGLState()
+
+        mat_mvp = np.array(self.mvpMatrix().data(), dtype=np.float32)
+        program = self.getShaderProgram()
+
+        vbo.bind()
+        GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, False, 5 * 4, None)
+        GL.glVertexAttribPointer(1, 2, GL.GL_FLOAT, False, 5 * 4, GL.GLvoidp(3 * 4))
+        vbo.release()
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+        GL.glEnableVertexAttribArray(0)
+        GL.glEnableVertexAttribArray(1)
+
+        with program:
+            GL.glUniformMatrix4fv(GL.glGetUniformLocation(program, 'u_mvp'), 1, False, mat_mvp)
+            GL.glUniform1i(GL.glGetUniformLocation(program, 'u_texture'), 0)
+            GL.glUniform4f(GL.glGetUniformLocation(program, 'u_color'), *self.color)
+            GL.glUniform1f(GL.glGetUniformLocation(program, 'u_slice_alpha'), self.slice_alpha)
+
+            GL.glDrawArrays(GL.GL_TRIANGLES, 0, 6)
+
+        GL.glDisableVertexAttribArray(0)
+        GL.glDisableVertexAttribArray(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+
+def scalar_volume_data(data: np.ndarray, dtype: type = np.uint8, flip_x: bool = False,
+                       value_range: Tuple[float, float] = None, chunk_size: int = 16) -> np.ndarray:
+    """Convert (x, y, z[, 1]) volume into unsigned integer data for ScalarVolumeItem
+
+    Data of the target dtype is copied as is, all other data is rescaled from its value range,
+    which is computed if not given. Conversion runs in chunks of chunk_size x-planes, so only
+    the result and one chunk of intermediate values are held in memory at any time.
+    """
+
+    if data.ndim == 4:
+        data = data[..., 0]
+    if flip_x:
+        data = data[::-1]
+
+    out = np.empty(data.shape, dtype=dtype)
+
+    if data.dtype == out.dtype:
+        for i in range(0, data.shape[0], chunk_size):
+            out[i:i + chunk_size] = data[i:i + chunk_size]
+        return out
+
+    if value_range is None:
+        low = min(np.nanmin(data[i:i + chunk_size]) for i in range(0, data.shape[0], chunk_size))
+        high = max(np.nanmax(data[i:i + chunk_size]) for i in range(0, data.shape[0], chunk_size))
+    else:
+        low, high = value_range
+
+    out_max = np.iinfo(dtype).max
+    scale = out_max / (float(high) - float(low)) if high > low else 0.
+
+    for i in range(0, data.shape[0], chunk_size):
+        values = (data[i:i + chunk_size].astype(np.float32) - float(low)) * scale
+        out[i:i + chunk_size] = np.clip(np.rint(np.nan_to_num(values)), 0, out_max)
+
+    return out
+
+
+def color_ramp_lut(color: Tuple[float, float, float, float], alpha: float) -> np.ndarray:
+    """Return (256, 4) uint8 lookup table going from black to color with constant alpha"""
+
+    ramp = np.linspace(0., 1., 256)[:, None]
+    lut = np.empty((256, 4), dtype=np.uint8)
+    lut[:, :3] = np.round(ramp * np.array(color[:3]) * 255)
+    lut[:, 3] = int(round(alpha * 255))
+
+    return lut
+
+
+def _volume_vertex_shader(core: bool, texcoord_size: int = 3) -> str:
+    inp, out = ('in', 'out') if core else ('attribute', 'varying')
+
+    return f"""
+        uniform mat4 u_mvp;
+        {inp} vec4 a_position;
+        {inp} vec{texcoord_size} a_texcoord;
+        {out} vec{texcoord_size} v_texcoord;
+        void main() {{
+            gl_Position = u_mvp * a_position;
+            v_texcoord = a_texcoord;
+        }}
+    """
+
+
+def _volume_fragment_shader(core: bool) -> str:
+    inp = 'in' if core else 'varying'
+    frag_color = 'fragColor' if core else 'gl_FragColor'
+    tex3d, tex2d = ('texture', 'texture') if core else ('texture3D', 'texture2D')
+
+    return f"""
+        #ifdef GL_ES
+        precision mediump float;
+        precision lowp sampler3D;
+        #endif
+        uniform sampler3D u_texture;
+        uniform sampler2D u_lut;
+        {inp} vec3 v_texcoord;
+        {'out vec4 fragColor;' if core else ''}
+        void main()
+        {{
+            float value = {tex3d}(u_texture, v_texcoord).r;
+            // Map value range onto texel centers of the lookup table
+            {frag_color} = {tex2d}(u_lut, vec2((value * 255.0 + 0.5) / 256.0, 0.5));
+        }}
+    """
+
+
+def _plane_fragment_shader(core: bool) -> str:
+    inp = 'in' if core else 'varying'
+    frag_color = 'fragColor' if core else 'gl_FragColor'
+    tex2d = 'texture' if core else 'texture2D'
+
+    return f"""
+        #ifdef GL_ES
+        precision mediump float;
+        #endif
+        uniform sampler2D u_texture;
+        uniform vec4 u_color;
+        uniform float u_slice_alpha;
+        {inp} vec2 v_texcoord;
+        {'out vec4 fragColor;' if core else ''}
+        void main()
+        {{
+            // Output is blended additively, so tint and slice simply add up
+            float value = {tex2d}(u_texture, v_texcoord).r;
+            {frag_color} = vec4(u_color.rgb * u_color.a + vec3(value) * u_slice_alpha, 1.0);
+        }}
+    """
@@ -1,22 +1,31 @@
 from __future__ import annotations
 
+import functools
 import json
 import os
 import urllib.request
 import zipfile
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
 import colorcet as cc
 import numpy as np
 import pandas as pd
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
-import stl
 import tifffile
 
 from mapzebview import config
+from mapzebview.atlas import RegionAtlas, RegionCounts, count_points, load_cached_atlas
+from mapzebview.glitems import PointCloudItem
+from mapzebview.meshes import RegionMesh, load_cached_mesh
 from mapzebview.regions import region_structure
+from mapzebview.roidata import dataframe_coordinates, read_csv_coordinates, read_hdf_coordinates, read_json_coordinates
+from mapzebview.spatial import PointIndex, SliceIndex, progressive_order
 from mapzebview.views import CoronalView, PrettyView, SaggitalView, TransversalView, VolumeView
+from mapzebview.viewstate import ViewState
+from mapzebview.volumes import BrickedVolume, PackedRegionVolume, RegionChanges, RegionMask, VolumePyramid, \
+    atomic_write, downsample_levels, load_cached_pyramid
+from mapzebview.workers import Worker
 
 try:
     from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
@@ -32,8 +41,13 @@ app = None
 
 
 class Window(QtWidgets.QMainWindow):
-    sig_regions_updated = QtCore.Signal()
+    sig_regions_updated = QtCore.Signal(object)
     sig_marker_image_updated = QtCore.Signal()
+    sig_marker_level_loaded = QtCore.Signal()
+    sig_map_levels_loaded = QtCore.Signal()
+    sig_region_load_progress = QtCore.Signal(str, float)
+
+    max_loader_threads: int = 4
 
     def __init__(self):
         QtWidgets.QMainWindow.__init__(self)
@@ -41,6 +55,15 @@ class Window(QtWidgets.QMainWindow):
         self.setWindowTitle('MapZeBrain Viewer')
         config.window = self
 
+        # Thread pool for loading regions in the background
+        self.thread_pool = QtCore.QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(self.max_loader_threads)
+        self.pending_region_loaders: Dict[str, Worker] = {}
+        self.marker_level_loader: Union[Worker, None] = None
+        self.map_level_loaders: Dict[int, Worker] = {}
+        self.roi_count_loader: Union[Worker, None] = None
+        self.counted_roi_set: Union[str, None] = None
+
         self.wdgt = QtWidgets.QWidget()
         self.setCentralWidget(self.wdgt)
         self.wdgt.setLayout(QtWidgets.QHBoxLayout())
@@ -48,6 +71,7 @@ class Window(QtWidgets.QMainWindow):
         # Add panel
         self.panel = ControlPanel(self)
         self.panel.sig_region_color_changed.connect(self.update_region_color)
+        self.sig_region_load_progress.connect(self.panel.region_load_progress)
         self.wdgt.layout().addWidget(self.panel)
 
         self.browser = QtWidgets.QGroupBox('Anatomy browser')
@@ -57,27 +81,38 @@ class Window(QtWidgets.QMainWindow):
         # Saggital view
         self.saggital_view = SaggitalView(self)
         self.sig_marker_image_updated.connect(self.saggital_view.update_marker_image)
-        self.sig_regions_updated.connect(self.saggital_view.update_regions)
+        self.sig_marker_level_loaded.connect(self.saggital_view.marker_level_loaded)
+        self.sig_regions_updated.connect(self.saggital_view.regions_changed)
         self.browser.layout().addWidget(self.saggital_view, 0, 0)
 
         # Coronal view
         self.coronal_view = CoronalView(self)
         self.sig_marker_image_updated.connect(self.coronal_view.update_marker_image)
-        self.sig_regions_updated.connect(self.coronal_view.update_regions)
+        self.sig_marker_level_loaded.connect(self.coronal_view.marker_level_loaded)
+        self.sig_regions_updated.connect(self.coronal_view.regions_changed)
         self.browser.layout().addWidget(self.coronal_view, 1, 0)
 
         # Transversal view
         self.transverse_view = TransversalView(self)
         self.sig_marker_image_updated.connect(self.transverse_view.update_marker_image)
-        self.sig_regions_updated.connect(self.transverse_view.update_regions)
+        self.sig_marker_level_loaded.connect(self.transverse_view.marker_level_loaded)
+        self.sig_regions_updated.connect(self.transverse_view.regions_changed)
         self.browser.layout().addWidget(self.transverse_view, 1, 1)
 
         # Volumetric view
         self.volume_view = VolumeView(self)
         self.sig_marker_image_updated.connect(self.volume_view.marker_image_updated)
-        self.sig_regions_updated.connect(self.volume_view.update_regions)
+        self.sig_marker_level_loaded.connect(self.volume_view.marker_level_loaded)
+        self.sig_regions_updated.connect(self.volume_view.regions_changed)
         self.browser.layout().addWidget(self.volume_view, 0, 1)
 
+        # Collect index changes of all section views and apply them once per frame
+        self.view_state = ViewState(self)
+        for section_view in (self.saggital_view, self.coronal_view, self.transverse_view):
+            section_view.sig_index_requested.connect(self.view_state.set_index)
+            self.view_state.sig_index_changed.connect(section_view.apply_index)
+        self.view_state.sig_stats.connect(self.index_update_stats)
+
         # Connect line updates
         self.saggital_view.sig_index_changed.connect(self.coronal_view.update_hline)
         self.saggital_view.sig_index_changed.connect(self.transverse_view.update_vline)
@@ -126,12 +161,26 @@ class Window(QtWidgets.QMainWindow):
         self.panel.map_widget.sig_item_color_changed.connect(self.transverse_view.update_map_color)
 
         # Volumetric view
-        self.panel.roi_widget.sig_item_added.connect(self.volume_view.update_scatter)
-        self.panel.roi_widget.sig_item_shown.connect(self.volume_view.update_scatter)
-        self.panel.roi_widget.sig_item_color_changed.connect(self.volume_view.update_scatter)
-        self.panel.roi_widget.sig_item_removed.connect(self.volume_view.update_scatter)
-        self.panel.roi_widget.sig_item_hidden.connect(self.volume_view.update_scatter)
+        self.panel.roi_widget.sig_item_added.connect(self.volume_view.add_scatter)
+        self.panel.roi_widget.sig_item_shown.connect(self.volume_view.add_scatter)
+        self.panel.roi_widget.sig_item_color_changed.connect(self.volume_view.update_scatter_color)
+        self.panel.roi_widget.sig_item_removed.connect(self.volume_view.remove_scatter)
+        self.panel.roi_widget.sig_item_hidden.connect(self.volume_view.hide_scatter)
         self.panel.map_widget.sig_item_added.connect(self.volume_view.add_map)
+        self.panel.map_widget.sig_item_color_changed.connect(self.volume_view.update_map_color)
+
+        # Build coarser map levels in the background
+        self.panel.map_widget.sig_item_added.connect(self.build_map_levels)
+        for view in (self.saggital_view, self.coronal_view, self.transverse_view):
+            self.sig_map_levels_loaded.connect(view.update_map)
+
+        # Connect ROI picking
+        for view in (self.saggital_view, self.coronal_view, self.transverse_view, self.volume_view):
+            view.sig_roi_picked.connect(self.roi_picked)
+
+        # Connect region counts
+        self.panel.roi_widget.sig_count_requested.connect(self.count_rois_per_region)
+        self.panel.roi_widget.sig_item_removed.connect(self.roi_set_removed)
 
         marker_catalog_path = os.path.join(config.marker_path(), 'markers_catalog.json')
         if not os.path.exists(marker_catalog_path):
@@ -191,7 +240,78 @@ class Window(QtWidgets.QMainWindow):
 
         self.sig_marker_image_updated.emit()
 
-    def load_marker(self, name: str) -> np.ndarray:
+        # Views start out with the coarsest level, finer ones are loaded in the background
+        if isinstance(config.marker_image, VolumePyramid):
+            self.load_next_marker_level(config.marker_image)
+
+    def load_next_marker_level(self, pyramid: VolumePyramid):
+
+        finer_factors = [f for f in pyramid.factors if f < pyramid.loaded_factor]
+        if len(finer_factors) == 0:
+            self.marker_level_loader = None
+            return
+
+        factor = max(finer_factors)
+        loader = Worker(str(factor), functools.partial(self.load_marker_level, pyramid))
+        loader.signals.sig_finished.connect(self.marker_level_loaded)
+        loader.signals.sig_failed.connect(self.marker_level_load_failed)
+        self.marker_level_loader = loader
+
+        self.thread_pool.start(loader)
+
+    @staticmethod
+    def load_marker_level(pyramid: VolumePyramid, factor: str, progress: Callable[[float], None] = None) -> VolumePyramid:
+        pyramid.load_level(int(factor))
+
+        return pyramid
+
+    def marker_level_loaded(self, factor: str, pyramid: VolumePyramid):
+
+        # Discard level if marker was changed while loading
+        if pyramid is not config.marker_image:
+            return
+
+        print(f'Marker level {factor} loaded')
+        self.sig_marker_level_loaded.emit()
+
+        self.load_next_marker_level(pyramid)
+
+    def marker_level_load_failed(self, factor: str, error: str):
+        print(f'ERROR: failed to load marker level {factor}\n{error}')
+
+        self.marker_level_loader = None
+
+    def build_map_levels(self, map_item: MapItem):
+
+        # Loaders are kept by pyramid, a map replaced under the same name may still be downsampled
+        pyramid = map_item.map_pyramid
+        loader = Worker(map_item.name, functools.partial(self.downsample_map, pyramid))
+        loader.signals.sig_finished.connect(self.map_levels_built)
+        loader.signals.sig_failed.connect(functools.partial(self.map_levels_failed, id(pyramid)))
+        self.map_level_loaders[id(pyramid)] = loader
+
+        self.thread_pool.start(loader)
+
+    @staticmethod
+    def downsample_map(pyramid: VolumePyramid, name: str, progress: Callable[[float], None] = None) \
+            -> Tuple[VolumePyramid, Dict[int, BrickedVolume]]:
+        return pyramid, downsample_levels(pyramid.level(1))
+
+    def map_levels_built(self, name: str, result: Tuple[VolumePyramid, Dict[int, BrickedVolume]]):
+        pyramid, levels = result
+
+        self.map_level_loaders.pop(id(pyramid), None)
+
+        # Levels are only added on the GUI thread, views pick them up on their next update
+        pyramid.levels.update(levels)
+        self.sig_map_levels_loaded.emit()
+
+    def map_levels_failed(self, loader_key: int, name: str, error: str):
+        print(f'ERROR: failed to build downsampled levels of map {name}\n{error}')
+
+        self.map_level_loaders.pop(loader_key, None)
+
+    def load_marker(self, name: str) -> VolumePyramid:
 
         # Get file name from URL
         file_name = self.marker_structure[name].split('/')[-1].split('.')[0]
@@ -201,7 +321,7 @@ class Window(QtWidgets.QMainWindow):
         if not os.path.exists(file_path):
             self.download_marker(name)
 
-        return np.swapaxes(np.moveaxis(tifffile.imread(file_path), 0, 2), 0, 1)[:, :, :, None]
+        return load_cached_pyramid(file_path)
 
     def download_marker(self, name: str):
 
@@ -218,53 +338,218 @@ class Window(QtWidgets.QMainWindow):
         os.remove(zip_path)
 
     def add_region(self, name: str):
+
+        if name in config.regions or name in self.pending_region_loaders:
+            return
+
         print(f'Add region {name}')
 
-        config.regions[name] = self.load_region(name)
+        # Load on thread pool, regions are only added once their data is ready
+        loader = Worker(name, self.load_region)
+        loader.signals.sig_progress.connect(self.sig_region_load_progress)
+        loader.signals.sig_finished.connect(self.region_loaded)
+        loader.signals.sig_failed.connect(self.region_load_failed)
+        self.pending_region_loaders[name] = loader
+
+        self.thread_pool.start(loader)
+
+    def region_loaded(self, name: str, data: Tuple[RegionMask, RegionMesh]):
+
+        # Discard result if region was removed while loading
+        if self.pending_region_loaders.pop(name, None) is None:
+            return
+
+        mask, mesh = data
+
+        # Pack mask into the shared region volume
+        if config.region_volume is None:
+            config.region_volume = PackedRegionVolume(mask.shape)
+        config.region_volume.add(name, mask)
+
+        config.regions[name] = mesh
 
         print(f'Region {name} added')
-        self.sig_regions_updated.emit()
+        self.sig_regions_updated.emit(RegionChanges(added=[name]))
+
+    def region_load_failed(self, name: str, error: str):
+        print(f'ERROR: failed to load region {name}\n{error}')
+
+        self.pending_region_loaders.pop(name, None)
+        self.panel.region_tree.deselect_item(name)
 
     def remove_region(self, name: str):
         print(f'Remove region {name}')
 
-        if name in config.regions:
-            del config.regions[name]
+        self.pending_region_loaders.pop(name, None)
 
-        self.sig_regions_updated.emit()
+        if name not in config.regions:
+            return
 
-    def load_region(self, name: str) -> Tuple[np.ndarray, stl.Mesh]:
+        del config.regions[name]
+        config.region_volume.remove(name)
 
-        name_str = name.replace(' ', '_')
-        file_path = os.path.join(config.region_path(), f'{name_str}.tif')
-        print(f'Load region volume {file_path}')
+        self.sig_regions_updated.emit(RegionChanges(removed=[name]))
 
-        if not os.path.exists(file_path):
-            self.download_region(name_str)
+    def load_region(self, name: str, progress: Callable[[float], None] = None) -> Tuple[RegionMask, RegionMesh]:
 
-        im = np.swapaxes(np.moveaxis(tifffile.imread(file_path), 0, 2), 0, 1)
+        if progress is None:
+            progress = lambda _: None
+
+        name_str = name.replace(' ', '_')
+        im = self.load_region_array(name, progress=lambda f: progress(0.6 * f))
+        progress(0.7)
+
+        # Only keep the bounding box of the region
+        mask = RegionMask.from_array(im)
+        del im
+        progress(0.8)
 
         try:
             path_stl = os.path.join(config.region_path(), f'{name_str}.stl')
             print(f'Load region mesh {path_stl}')
-            mesh = stl.Mesh.from_file(path_stl)
+            mesh = load_cached_mesh(path_stl)
         except FileNotFoundError as e:
             print(f'WARNING: no mesh data for {name}')
             mesh = None
+        progress(1.0)
 
-        return im, mesh
+        return mask, mesh
 
     @staticmethod
-    def download_region(name_str: str):
+    def region_array_path(name: str) -> str:
+        return os.path.join(config.region_path(), f'{name.replace(" ", "_")}.tif')
+
+    def load_region_array(self, name: str, progress: Callable[[float], None] = None) -> np.ndarray:
+        """Return full (x, y, z) mask volume of region, downloading it first if necessary"""
+
+        file_path = self.region_array_path(name)
+        print(f'Load region volume {file_path}')
+
+        if not os.path.exists(file_path):
+            self.download_region(name.replace(' ', '_'), progress=progress)
+
+        return np.swapaxes(np.moveaxis(tifffile.imread(file_path), 0, 2), 0, 1)
+
+    def load_region_atlas(self, progress: Callable[[float], None] = None) -> RegionAtlas:
+        """Return label volume of all regions for point lookups, building it from all region volumes if not cached
+
+        Runs on a worker thread, the returned atlas is only stored in config on the GUI thread
+        """
+
+        def _load_mask(name: str) -> Union[np.ndarray, None]:
+            try:
+                return self.load_region_array(name)
+            except OSError as _:
+                return None
+
+        return load_cached_atlas(os.path.join(config.region_path(), 'atlas'), region_structure,
+                                 _load_mask, source_path=self.region_array_path, progress=progress)
+
+    def closeEvent(self, event):
+
+        # Section views are not closed along with the window, stop their prefetchers explicitly
+        for view in (self.saggital_view, self.coronal_view, self.transverse_view):
+            view.prefetcher.stop()
+
+        QtWidgets.QMainWindow.closeEvent(self, event)
+
+    def index_update_stats(self, applied: int, dropped: int):
+
+        # Keep message up until the next report would replace it
+        message = f'Slice updates: {applied} applied, {dropped} coalesced in the last {ViewState.stats_interval} ms'
+        self.statusBar().showMessage(message, 2 * ViewState.stats_interval)
+
+    def roi_picked(self, name: str, row: int):
+
+        tree_item = config.roi_set_items.get(name)
+        if tree_item is None:
+            return
+
+        x, y, z = tree_item.coordinates[row][:3]
+        message = f'ROI {row} of {name} at ({x:.1f}, {y:.1f}, {z:.1f})'
+        if config.region_atlas is not None:
+            region = config.region_atlas.name_of(config.region_atlas.lookup(tree_item.coordinates[row:row + 1])[0])
+            message += f' in {region}' if region is not None else ' outside of all regions'
+
+        print(message)
+        self.statusBar().showMessage(message)
+
+    def count_rois_per_region(self, tree_item: QtWidgets.QTreeWidgetItem):
+
+        # Only a single count at a time, concurrent atlas builds would write the same cache files
+        if self.roi_count_loader is not None:
+            print(f'WARNING: still counting ROIs of {self.roi_count_loader.name}, ignoring {tree_item.name}')
+            return
+
+        print(f'Count ROIs of {tree_item.name} per region')
+
+        # Atlas is built on first use, which requires all region volumes
+        loader = Worker(tree_item.name, functools.partial(self.count_roi_set, tree_item.coordinates,
+                                                          config.region_atlas))
+        loader.signals.sig_progress.connect(self.panel.roi_widget.count_progress)
+        loader.signals.sig_finished.connect(self.roi_set_counted)
+        loader.signals.sig_failed.connect(self.roi_set_count_failed)
+        self.roi_count_loader = loader
+        self.panel.roi_widget.count_btn.setEnabled(False)
+
+        self.thread_pool.start(loader)
+
+    def count_roi_set(self, coordinates: np.ndarray, atlas: Union[RegionAtlas, None],
+                      name: str, progress: Callable[[float], None] = None) -> Tuple[RegionAtlas, RegionCounts]:
+        if atlas is None:
+            atlas = self.load_region_atlas(progress=progress)
+
+        return atlas, count_points(atlas, coordinates)
+
+    def roi_set_counted(self, name: str, result: Tuple[RegionAtlas, RegionCounts]):
+        atlas, counts = result
+
+        config.region_atlas = atlas
+        self.roi_count_loader = None
+        self.panel.roi_widget.count_btn.setEnabled(True)
+        self.panel.roi_widget.count_progress(name, 1.0)
+
+        # Discard counts if set was removed in the meantime
+        if all(self.panel.roi_widget.tree_widget.topLevelItem(i).name != name
+               for i in range(self.panel.roi_widget.tree_widget.topLevelItemCount())):
+            return
+
+        self.counted_roi_set = name
+        self.panel.region_tree.set_region_counts(counts, name)
+
+    def roi_set_count_failed(self, name: str, error: str):
+        print(f'ERROR: failed to count ROIs of {name} per region\n{error}')
+
+        self.roi_count_loader = None
+        self.panel.roi_widget.count_btn.setEnabled(True)
+        self.panel.roi_widget.count_progress(name, 1.0)
+
+    def roi_set_removed(self, tree_item: QtWidgets.QTreeWidgetItem):
+
+        if tree_item.name == self.counted_roi_set:
+            self.counted_roi_set = None
+            self.panel.region_tree.set_region_counts(None)
+
+    @staticmethod
+    def download_region(name_str: str, progress: Callable[[float], None] = None):
+
+        def _report(block_num: int, block_size: int, total_size: int):
+            if progress is not None and total_size > 0:
+                progress(min(block_num * block_size / total_size, 1.0))
+
+        def _retrieve(url: str, path: str):
+            with atomic_write(path) as temp_path:
+                urllib.request.urlretrieve(url, temp_path, reporthook=_report)
 
         url = f'https://api.mapzebrain.org/media/Regions/v2.0.1/{name_str}/{name_str}.tif'
         print(f'Download region data for {name_str} from {url}')
-        urllib.request.urlretrieve(url, os.path.join(config.region_path(), f'{name_str}.tif'))
+        _retrieve(url, os.path.join(config.region_path(), f'{name_str}.tif'))
 
         try:
             url_stl = f'https://api.mapzebrain.org/media/Regions/v2.0.1/{name_str}/{name_str}.stl'
             print(f'Download region mesh data for {name_str} from {url_stl}')
-            urllib.request.urlretrieve(url_stl, os.path.join(config.region_path(), f'{name_str}.stl'))
+            with atomic_write(os.path.join(config.region_path(), f'{name_str}.stl')) as temp_path:
+                urllib.request.urlretrieve(url_stl, temp_path)
 
         except urllib.request.HTTPError as _:
             print('WARNING: Failed to load region mesh data')
@@ -272,7 +557,7 @@ class Window(QtWidgets.QMainWindow):
     def update_region_color(self, name: str, color: QtGui.QColor):
         config.region_colors[name] = color
 
-        self.sig_regions_updated.emit()
+        self.sig_regions_updated.emit(RegionChanges(recolored=[name]))
 
 
 class ControlPanel(QtWidgets.QGroupBox):
@@ -331,6 +616,9 @@ class ControlPanel(QtWidgets.QGroupBox):
         name = item.data(0, RegionTreeWidget.UniqueNameRole)
         config.window.remove_region(name)
 
+    def region_load_progress(self, name: str, fraction: float):
+        self.region_tree.set_item_progress(name, fraction)
+
 
 class RegionTreeWidget(QtWidgets.QWidget):
     ContinuousIdRole = 40
@@ -363,6 +651,9 @@ class RegionTreeWidget(QtWidgets.QWidget):
         self.tree_widget.headerItem().setText(2, '')
         self.tree_widget.header().resizeSection(2, 25)
         self.tree_widget.header().setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeMode.Fixed)
+        self.tree_widget.headerItem().setText(3, 'ROIs')
+        self.tree_widget.header().resizeSection(3, 60)
+        self.tree_widget.header().setSectionResizeMode(3, QtWidgets.QHeaderView.ResizeMode.Fixed)
         self.tree_widget.header().setStretchLastSection(False)
 
         self.sig_item_color_changed.connect(self.update_colorpicker_button)
@@ -454,7 +745,7 @@ class RegionTreeWidget(QtWidgets.QWidget):
         for i in range(self.tree_widget.topLevelItemCount()):
             _find_text_in_item(self.tree_widget.topLevelItem(i), False)
 
-    def select_exact_match_in_tree(self, search_text: str, only_toggle_on: bool = False):
+    def find_exact_match_in_tree(self, search_text: str) -> Union[QtWidgets.QTreeWidgetItem, None]:
 
         def _find_item_in_tree(item: QtWidgets.QTreeWidgetItem) -> Union[QtWidgets.QTreeWidgetItem, None]:
 
@@ -479,10 +770,36 @@ class RegionTreeWidget(QtWidgets.QWidget):
             final_ret = _find_item_in_tree(self.tree_widget.topLevelItem(i))
 
             if final_ret is not None:
-                self.toggle_item(final_ret, only_toggle_on=only_toggle_on)
-                # Search tree to cause selected item to expand
-                self.search_tree('')
-                break
+                return final_ret
+
+        return None
+
+    def select_exact_match_in_tree(self, search_text: str, only_toggle_on: bool = False):
+
+        tree_item = self.find_exact_match_in_tree(search_text)
+
+        if tree_item is not None:
+            self.toggle_item(tree_item, only_toggle_on=only_toggle_on)
+            # Search tree to cause selected item to expand
+            self.search_tree('')
+
+    def deselect_item(self, name: str):
+
+        tree_item = self.find_exact_match_in_tree(name)
+
+        if tree_item is not None and tree_item in self.selected_items:
+            self.toggle_item(tree_item)
+
+    def set_item_progress(self, name: str, fraction: float):
+
+        tree_item = self.find_exact_match_in_tree(name)
+
+        if tree_item is None or tree_item not in self.selected_items:
+            return
+
+        # Show loading progress on select button until region is ready
+        select_btn = self.tree_widget.itemWidget(tree_item, 1)
+        select_btn.setText('hide' if fraction >= 1.0 else f'{int(fraction * 100)}%')
 
     def toggle_item(self, tree_item: QtWidgets.QTreeWidgetItem, only_toggle_on: bool = False):
 
@@ -551,6 +868,27 @@ class RegionTreeWidget(QtWidgets.QWidget):
         color_btn = self.tree_widget.itemWidget(tree_item, 2)
         color_btn.setStyleSheet(f'background-color: rgba{color.getRgb()};')
 
+    def set_region_counts(self, counts: Union[RegionCounts, None], roi_set_name: str = None):
+        """Show ROI counts of one set next to each region, counts are given in the tree's continuous id order"""
+
+        header = 'ROIs' if counts is None else f'ROIs ({roi_set_name.split("/")[-1]})'
+        self.tree_widget.headerItem().setText(3, header)
+
+        iterator = QtWidgets.QTreeWidgetItemIterator(self.tree_widget)
+        while iterator.value() is not None:
+            tree_item = iterator.value()
+            iterator += 1
+
+            if counts is None:
+                tree_item.setText(3, '')
+                tree_item.setToolTip(3, '')
+                continue
+
+            idx = self.get_item_continuous_id(tree_item)
+            tree_item.setText(3, str(counts.counts[idx]))
+            tree_item.setToolTip(3, f'{counts.counts[idx]} ROIs, {counts.densities[idx]:.1f} per mm³, '
+                                    f'{counts.fractions[idx] * 100:.2f}% of {roi_set_name}')
+
     def get_item_name(self, tree_item: QtWidgets.QTreeWidgetItem):
         return tree_item.data(0, self.UniqueNameRole)
 
@@ -774,7 +1112,9 @@ class MapWidget(QtWidgets.QWidget):
                 break
 
         # Add tree item
-        map_item = MapItem(name=name, shortname=name_short, data=data, color=color)
+        map_item = MapItem(self, name=name, shortname=name_short, data=data, color=color)
+        # Views start out with the full resolution array, coarser levels are built in the background
+        map_item.map_pyramid = VolumePyramid({1: data})
         self.tree_widget.addTopLevelItem(map_item)
 
         # Emit item added signal
@@ -807,6 +1147,7 @@ class RoiWidget(QtWidgets.QWidget):
     sig_item_color_changed = QtCore.Signal(QtWidgets.QTreeWidgetItem)
     sig_item_added = QtCore.Signal(QtWidgets.QTreeWidgetItem)
     sig_item_removed = QtCore.Signal(QtWidgets.QTreeWidgetItem)
+    sig_count_requested = QtCore.Signal(QtWidgets.QTreeWidgetItem)
 
     item_count: int = 0
     selected_items: List[QtWidgets.QTreeWidgetItem] = []
@@ -821,6 +1162,11 @@ class RoiWidget(QtWidgets.QWidget):
         self.drop_label.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
         self.layout().addWidget(self.drop_label)
 
+        # Add region count button
+        self.count_btn = QtWidgets.QPushButton('Count ROIs per region')
+        self.count_btn.clicked.connect(self.request_count)
+        self.layout().addWidget(self.count_btn)
+
         # Add tree widget
         self.tree_widget = QtWidgets.QTreeWidget(self)
         self.tree_widget.headerItem().setText(0, 'ROI sets')
@@ -834,6 +1180,9 @@ class RoiWidget(QtWidgets.QWidget):
         self.tree_widget.header().setStretchLastSection(False)
         self.layout().addWidget(self.tree_widget)
 
+        # Sets being loaded and indexed in the background
+        self.pending_loaders: Dict[str, Worker] = {}
+
         self.sig_path_added.connect(self.add_roi_set)
         self.sig_item_shown.connect(self.update_color_btn)
         self.sig_item_hidden.connect(self.update_color_btn)
@@ -879,11 +1228,17 @@ class RoiWidget(QtWidgets.QWidget):
         ext = path.split('.')[-1]
 
         if ext in ['h5', 'hdf5']:
-            data = pd.read_hdf(path)
+            data = read_hdf_coordinates(path)
 
         elif ext == 'npy':
             data = np.load(path)
 
+        elif ext == 'csv':
+            data = read_csv_coordinates(path)
+
+        elif ext == 'json':
+            data = read_json_coordinates(path)
+
         else:
             return
 
@@ -891,44 +1246,66 @@ class RoiWidget(QtWidgets.QWidget):
 
     def add_roi_set(self, data: Union[np.ndarray, pd.DataFrame, str, os.PathLike], name: str = None):
 
-        # Load data from path
-        if isinstance(data, (str, os.PathLike)):
-            if name is None:
+        # Set name if none given
+        if name is None:
+            if isinstance(data, (str, os.PathLike)):
                 name = data
+            else:
+                name = f'ROI set {self.item_count}'
+                self.item_count += 1
 
+        # Load and index on thread pool, the set is only added once it is ready
+        loader = Worker(name, functools.partial(self.prepare_roi_set, data))
+        loader.signals.sig_finished.connect(functools.partial(self.roi_set_prepared, loader))
+        loader.signals.sig_failed.connect(functools.partial(self.roi_set_prepare_failed, loader))
+        self.pending_loaders[name] = loader
+
+        config.window.thread_pool.start(loader)
+
+    def prepare_roi_set(self, data: Union[np.ndarray, pd.DataFrame, str, os.PathLike], name: str,
+                        progress: Callable[[float], None] = None) \
+            -> Union[Tuple[np.ndarray, SliceIndex, PointIndex, np.ndarray, np.ndarray], None]:
+        """Load coordinates and build their indexes, called on a worker thread"""
+
+        # Load data from path
+        if isinstance(data, (str, os.PathLike)):
             data = self.load_roi_data(data)
 
         if data is None:
-            return
+            return None
 
         # Unpack DataFrames
         if isinstance(data, pd.DataFrame):
-
-            if len(data.columns) == 3:
-                keys = data.columns
-
-            else:
-                keys = []
-                for _n in ['x', 'y', 'z']:
-                    _keys = [k.lower() for k in data.keys() if _n in k]
-                    if len(_keys) > 0:
-                        keys.append(_keys[0])
-
-                if len(keys) != 3:
-                    raise KeyError('No matching coordinate keys found for x/y/z')
-
-            data = data[keys].values
-            print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+            data = dataframe_coordinates(data)
 
         # Deal with NaNs
         if np.any(np.isnan(data)):
             print('WARNING: coordinates contain NaN values')
             data = data[~np.any(np.isnan(data), axis=1), :]
 
-        # Set name if none given
-        if name is None:
-            name = f'ROI set {self.item_count}'
-            self.item_count += 1
+        # Order of points in the 3D view, where drawing a prefix gives an even subsample
+        order, level_counts = progressive_order(data[:, :3], PointCloudItem.lod_cell_sizes)
+
+        return data, SliceIndex(data), PointIndex(data, scale=RegionAtlas.voxel_size), order, level_counts
+
+    def roi_set_prepare_failed(self, loader: Worker, name: str, error: str):
+        print(f'ERROR: failed to load ROI set {name}\n{error}')
+
+        if self.pending_loaders.get(name) is loader:
+            del self.pending_loaders[name]
+
+    def roi_set_prepared(self, loader: Worker, name: str,
+                         result: Union[Tuple[np.ndarray, SliceIndex, PointIndex, np.ndarray, np.ndarray], None]):
+
+        # Discard result if a newer set of the same name was requested meanwhile
+        if self.pending_loaders.get(name) is not loader:
+            return
+        del self.pending_loaders[name]
+
+        if result is None:
+            return
+
+        data, slice_index, point_index, order, level_counts = result
 
         if '/' in name:
             name_short = name.split('/')[-1]
@@ -952,6 +1329,10 @@ class RoiWidget(QtWidgets.QWidget):
         tree_item.setToolTip(0, name)
         tree_item.name = name
         tree_item.coordinates = data
+        tree_item.slice_index = slice_index
+        tree_item.point_index = point_index
+        tree_item.progressive_order = order
+        tree_item.level_counts = level_counts
         self.tree_widget.addTopLevelItem(tree_item)
         # Start color
         if color is None:
@@ -1037,6 +1418,15 @@ class RoiWidget(QtWidgets.QWidget):
             # Emit signal
             self.sig_item_hidden.emit(tree_item)
 
+    def request_count(self):
+
+        # Count the most recently shown set
+        if len(self.selected_items) > 0:
+            self.sig_count_requested.emit(self.selected_items[-1])
+
+    def count_progress(self, name: str, fraction: float):
+        self.count_btn.setText('Count ROIs per region' if fraction >= 1.0 else f'Building region atlas {int(fraction * 100)}%')
+
     def open_colorpicker(self, tree_item: QtWidgets.QTreeWidgetItem):
 
         new_color = QtWidgets.QColorDialog().getColor(initial=tree_item.color,
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import os
+from typing import List, Tuple, Union
+
+import numpy as np
+import stl
+
+from mapzebview.volumes import atomic_write
+
+
+class RegionMesh:
+    """Indexed triangle mesh with one normal per (welded) vertex
+
+    Coarser levels of detail are kept in levels, where levels[i] was decimated with
+    a clustering cell size of lod_cell_sizes[i] voxels. Small regions may collapse to
+    (almost) nothing at coarse cell sizes, those levels are replaced by the next finer one.
+    """
+
+    lod_cell_sizes: Tuple[float, ...] = (2., 4., 8.)
+    lod_min_faces: int = 32
+
+    def __init__(self, vertexes: np.ndarray, faces: np.ndarray, normals: np.ndarray = None):
+        self.vertexes = np.ascontiguousarray(vertexes, dtype=np.float32)
+        self.faces = np.ascontiguousarray(faces, dtype=np.uint32)
+        self.normals = vertex_normals(self.vertexes, self.faces) if normals is None \
+            else np.ascontiguousarray(normals, dtype=np.float32)
+
+        self.levels: List[RegionMesh] = []
+
+    @classmethod
+    def from_stl(cls, mesh: stl.Mesh) -> RegionMesh:
+        vertexes, faces = weld_vertexes(mesh.vectors)
+        region_mesh = cls(vertexes, faces)
+        region_mesh.levels = [cls(*decimate(vertexes, faces, cell_size)) for cell_size in cls.lod_cell_sizes]
+
+        return region_mesh
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike]) -> RegionMesh:
+        with np.load(path) as data:
+            region_mesh = cls(data['vertexes'], data['faces'], data['normals'])
+
+            cell_sizes = tuple(data['lod_cell_sizes']) if 'lod_cell_sizes' in data else ()
+            if cell_sizes != cls.lod_cell_sizes:
+                raise ValueError(f'Mesh levels in {path} do not match {cls.lod_cell_sizes}')
+
+            for i in range(len(cell_sizes)):
+                region_mesh.levels.append(cls(data[f'vertexes_{i}'], data[f'faces_{i}'], data[f'normals_{i}']))
+
+        return region_mesh
+
+    def save(self, path: Union[str, os.PathLike]):
+
+        arrays = {'vertexes': self.vertexes, 'faces': self.faces, 'normals': self.normals,
+                  'lod_cell_sizes': np.array(self.lod_cell_sizes[:len(self.levels)])}
+        for i, level in enumerate(self.levels):
+            arrays.update({f'vertexes_{i}': level.vertexes, f'faces_{i}': level.faces, f'normals_{i}': level.normals})
+
+        with atomic_write(path) as temp_path, open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @property
+    def level_count(self) -> int:
+        return len(self.levels) + 1
+
+    def level_index(self, idx: int) -> int:
+        """Return the coarsest level up to idx that still has at least lod_min_faces faces"""
+
+        idx = min(idx, len(self.levels))
+        while idx > 0 and self.levels[idx - 1].faces.shape[0] < self.lod_min_faces:
+            idx -= 1
+
+        return idx
+
+    def level(self, idx: int) -> RegionMesh:
+        """Return level of detail idx, where 0 is the full resolution mesh and higher levels are coarser"""
+
+        idx = self.level_index(idx)
+
+        return self if idx == 0 else self.levels[idx - 1]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Return (n_faces, 3, 3) triangle soup, same as stl.Mesh.vectors"""
+        return self.vertexes[self.faces]
+
+
+def weld_vertexes(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge identical corners of the (n_faces, 3, 3) triangle soup into (vertexes, faces)
+
+    Faces that collapse to a line or point after welding are dropped
+    """
+
+    # Adding 0 turns -0 into 0, which would otherwise differ in the comparison below
+    corners = np.ascontiguousarray(vectors.reshape(-1, 3), dtype=np.float32) + np.float32(0)
+
+    # Compare corners as a whole by viewing each one as a single opaque item
+    keys = corners.view(np.dtype((np.void, corners.dtype.itemsize * 3))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    vertexes = corners[first]
+    faces = inverse.reshape(-1, 3).astype(np.uint32)
+
+    degenerate = (faces[:, 0] == faces[:, 1]) | (faces[:, 1] == faces[:, 2]) | (faces[:, 0] == faces[:, 2])
+
+    return vertexes, faces[~degenerate]
+
+
+def vertex_normals(vertexes: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Return area-weighted average of the normals of all faces adjacent to each vertex"""
+
+    triangles = vertexes[faces]
+    face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+
+    normals = np.zeros_like(vertexes, dtype=np.float32)
+    for i in range(3):
+        np.add.at(normals, faces[:, i], face_normals)
+
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, norms, out=normals, where=norms > 0)
+
+    return normals
+
+
+def decimate(vertexes: np.ndarray, faces: np.ndarray, cell_size: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Simplify mesh by merging all vertexes within each cell of a regular grid
+
+    Each cell is represented by the point that minimizes the summed squared distance
+    to the planes of all faces around its vertexes (the quadric error), regularized towards
+    the cell's centroid where those planes do not define a unique point (e.g. flat areas)
+    """
+
+    # Assign vertexes to grid cells
+    cells = np.floor(vertexes / cell_size).astype(np.int64)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+    cluster_count = counts.shape[0]
+
+    # Plane (n, d) of each face, weighted by face area through the unnormalized cross product
+    triangles = vertexes[faces].astype(np.float64)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]) / 2
+    areas = np.linalg.norm(normals, axis=1)
+    unit_normals = np.divide(normals, areas[:, None], out=np.zeros_like(normals), where=areas[:, None] > 0)
+    offsets = -(unit_normals * triangles[:, 0]).sum(axis=1)
+
+    # Face quadrics: A = n n^T, b = d n (weighted by area)
+    face_a = areas[:, None, None] * unit_normals[:, :, None] * unit_normals[:, None, :]
+    face_b = (areas * offsets)[:, None] * unit_normals
+
+    # Accumulate quadrics of all faces touching a vertex of each cluster
+    quadric_a = np.zeros((cluster_count, 3, 3))
+    quadric_b = np.zeros((cluster_count, 3))
+    for i in range(3):
+        np.add.at(quadric_a, cluster[faces[:, i]], face_a)
+        np.add.at(quadric_b, cluster[faces[:, i]], face_b)
+
+    centroids = np.zeros((cluster_count, 3))
+    np.add.at(centroids, cluster, vertexes)
+    centroids /= counts[:, None]
+
+    # Minimize x^T A x + 2 b^T x + w |x - c|^2
+    weight = 1e-3 * (quadric_a.trace(axis1=1, axis2=2) + 1e-9)
+    quadric_a += weight[:, None, None] * np.eye(3)[None, :, :]
+    positions = np.linalg.solve(quadric_a, (weight[:, None] * centroids - quadric_b)[:, :, None])[:, :, 0]
+
+    # Keep positions within reach of their cluster, so ill-conditioned quadrics cannot produce spikes
+    positions = np.clip(positions, centroids - cell_size, centroids + cell_size)
+
+    # Re-index faces and drop collapsed and duplicate ones
+    new_faces = cluster[faces]
+    collapsed = (new_faces[:, 0] == new_faces[:, 1]) | (new_faces[:, 1] == new_faces[:, 2]) \
+        | (new_faces[:, 0] == new_faces[:, 2])
+    new_faces = new_faces[~collapsed]
+    _, unique_idcs = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(unique_idcs)]
+
+    # Remove vertexes no longer referenced by any face
+    used, new_faces = np.unique(new_faces, return_inverse=True)
+
+    return positions[used].astype(np.float32), new_faces.reshape(-1, 3).astype(np.uint32)
+
+
+def mesh_cache_path(stl_path: Union[str, os.PathLike]) -> str:
+    return f'{os.path.splitext(stl_path)[0]}.mesh.npz'
+
+
+def load_cached_mesh(stl_path: Union[str, os.PathLike]) -> RegionMesh:
+    """Return the mesh stored in stl_path as welded RegionMesh including its levels of detail
+
+    The first call prepares the mesh and writes it to a .mesh.npz cache file next to it,
+    all subsequent calls only read the prepared arrays
+    """
+
+    cache_path = mesh_cache_path(stl_path)
+
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(stl_path):
+        try:
+            return RegionMesh.open(cache_path)
+        except (KeyError, ValueError) as _:
+            # Cache was written with different levels of detail
+            pass
+
+    print(f'Write mesh cache for {stl_path} to {cache_path}')
+    mesh = RegionMesh.from_stl(stl.Mesh.from_file(stl_path))
+    mesh.save(cache_path)
+
+    return mesh
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import json
+import os
+from operator import itemgetter
+from typing import BinaryIO, Dict, Iterator, List, Sequence, Tuple, Union
+
+import h5py
+import numpy as np
+import pandas as pd
+
+default_chunk_rows: int = 1_000_000
+default_chunk_bytes: int = 2 ** 23
+
+# Bytes that delimit strings, nested values and elements in JSON
+_json_structural = np.zeros(256, dtype=bool)
+_json_structural[np.frombuffer(b'"[]{},', dtype=np.uint8)] = True
+
+
+def coordinate_columns(columns: Sequence) -> List:
+    """Return the columns holding x, y and z coordinates, those named after them or else the only three columns"""
+
+    columns = list(columns)
+
+    keys = []
+    for _n in ['x', 'y', 'z']:
+        # Prefer exact matches over names merely containing the axis
+        _keys = [k for k in columns if str(k).lower() == _n] + [k for k in columns if _n in str(k).lower()]
+        if len(_keys) > 0:
+            keys.append(_keys[0])
+
+    if len(keys) == 3 and len(set(keys)) == 3:
+        return keys
+
+    # Only fall back to the column order if no column is named after any of the axes
+    if len(keys) == 0 and len(columns) == 3:
+        return columns
+
+    raise KeyError('No matching coordinate keys found for x/y/z')
+
+
+def dataframe_coordinates(data: pd.DataFrame) -> np.ndarray:
+    keys = coordinate_columns(data.columns)
+    print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+
+    return data[keys].to_numpy(dtype=np.float32)
+
+
+def read_hdf_coordinates(path: Union[str, os.PathLike], key: str = None, chunk_rows: int = None) -> np.ndarray:
+    """Return (N, 3) float32 coordinates from a DataFrame stored by pandas in an HDF5 file
+
+    Only the three coordinate columns are read, chunk_rows rows at a time, so that tables with many
+    other columns never need to fit into memory. Both the fixed and the table format are supported.
+    """
+
+    chunk_rows = default_chunk_rows if chunk_rows is None else chunk_rows
+
+    with h5py.File(path, 'r') as f:
+        if key is None:
+            keys = list(f.keys())
+            if len(keys) != 1:
+                raise ValueError(f'{path} contains {len(keys)} datasets, a key has to be specified')
+            key = keys[0]
+
+        group = f[key]
+        pandas_type = _decode(group.attrs.get('pandas_type', b''))
+
+        if pandas_type == 'frame':
+            try:
+                return _read_fixed_coordinates(group, chunk_rows)
+            except (KeyError, ValueError, StopIteration) as _:
+                print(f'WARNING: unexpected layout of {key} in {path}, reading full table')
+
+    if pandas_type == 'frame':
+        return dataframe_coordinates(pd.read_hdf(path, key))
+
+    if pandas_type == 'frame_table':
+        return _read_table_coordinates(path, key, chunk_rows)
+
+    raise ValueError(f'{key} in {path} is not a pandas DataFrame')
+
+
+def _decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+def _read_fixed_coordinates(group: h5py.Group, chunk_rows: int) -> np.ndarray:
+    """Read coordinate columns from the value blocks of a DataFrame written in fixed format"""
+
+    columns = [_decode(c) for c in group['axis0'][()]]
+    keys = coordinate_columns(columns)
+    print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+
+    # Columns are spread across one block per dtype, locate each coordinate column within its block
+    block_items = [[_decode(c) for c in group[f'block{i}_items'][()]] for i in range(int(group.attrs['nblocks']))]
+    locations = []
+    for k in keys:
+        block = next(i for i, items in enumerate(block_items) if k in items)
+        locations.append((group[f'block{block}_values'], block_items[block].index(k)))
+
+    # Values are stored as (rows, columns) unless marked otherwise
+    transposed = [bool(values.attrs.get('transposed', True)) for values, _ in locations]
+    row_count = locations[0][0].shape[0 if transposed[0] else 1]
+
+    coordinates = np.empty((row_count, 3), dtype=np.float32)
+    for start in range(0, row_count, chunk_rows):
+        stop = min(start + chunk_rows, row_count)
+        for j, ((values, column), t) in enumerate(zip(locations, transposed)):
+            coordinates[start:stop, j] = values[start:stop, column] if t else values[column, start:stop]
+
+    return coordinates
+
+
+def _read_table_coordinates(path: Union[str, os.PathLike], key: str, chunk_rows: int) -> np.ndarray:
+    """Read coordinate columns of a DataFrame written in table format through PyTables, one chunk at a time"""
+
+    with pd.HDFStore(path, 'r') as store:
+        storer = store.get_storer(key)
+        storer.infer_axes()
+
+        columns = [c for axis in storer.values_axes for c in axis.values]
+        keys = coordinate_columns(columns)
+        print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+
+        # Each column is part of a table field, which holds either a single data column or a block of columns.
+        # Columns sharing a field are read together, so that every field is read once per chunk.
+        fields: Dict[str, List[Tuple[int, int]]] = {}
+        for j, k in enumerate(keys):
+            axis = next(a for a in storer.values_axes if k in list(a.values))
+            fields.setdefault(axis.cname, []).append((j, list(axis.values).index(k)))
+
+        # Wide blocks of many columns take fewer rows per chunk, never reading more than
+        # three float64 columns would take for chunk_rows rows
+        row_bytes = sum(storer.table.coldtypes[field].itemsize for field in fields)
+        chunk_rows = max(1, min(chunk_rows, chunk_rows * 3 * 8 // row_bytes))
+
+        row_count = storer.nrows
+        coordinates = np.empty((row_count, 3), dtype=np.float32)
+        for start in range(0, row_count, chunk_rows):
+            stop = min(start + chunk_rows, row_count)
+            for field, locations in fields.items():
+                values = storer.table.read(start, stop, field=field)
+                for j, column in locations:
+                    coordinates[start:stop, j] = values if values.ndim == 1 else values[:, column]
+
+    return coordinates
+
+
+def read_csv_coordinates(path: Union[str, os.PathLike], chunk_rows: int = None) -> np.ndarray:
+    """Return (N, 3) float32 coordinates from a CSV file
+
+    Only the three coordinate columns are parsed, chunk_rows rows at a time. Files without
+    a header row are expected to hold coordinates in their first three columns.
+    """
+
+    chunk_rows = default_chunk_rows if chunk_rows is None else chunk_rows
+
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        header = f.readline().rstrip('\r\n')
+
+    # Pick the most frequent of the common delimiters, so the fast C parser can be used
+    sep = max([',', ';', '\t'], key=header.count)
+    fields = [field.strip().strip('"') for field in header.split(sep)]
+
+    if _is_numeric(fields):
+        if len(fields) < 3:
+            raise KeyError('No matching coordinate keys found for x/y/z')
+        header_row = None
+        positions = [0, 1, 2]
+    else:
+        header_row = 0
+        keys = coordinate_columns(fields)
+        print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+        positions = [fields.index(k) for k in keys]
+
+    # Columns are selected by position, names parsed by pandas may still differ by whitespace or quotes.
+    # Selected columns come out in file order, order reorders them to x/y/z.
+    order = [sorted(positions).index(i) for i in positions]
+
+    chunks = []
+    reader = pd.read_csv(path, sep=sep, header=header_row, usecols=positions, dtype=np.float32, engine='c',
+                         skipinitialspace=True, chunksize=chunk_rows)
+    with reader:
+        for chunk in reader:
+            chunks.append(chunk.to_numpy(dtype=np.float32)[:, order])
+
+    if len(chunks) == 0:
+        return np.empty((0, 3), dtype=np.float32)
+
+    return np.concatenate(chunks)
+
+
+def _is_numeric(fields: List[str]) -> bool:
+    try:
+        [float(field) for field in fields]
+    except ValueError as _:
+        return False
+    return True
+
+
+def read_json_coordinates(path: Union[str, os.PathLike], chunk_bytes: int = None) -> np.ndarray:
+    """Return (N, 3) float32 coordinates from a JSON file
+
+    Files holding a top level array of either [x, y, z, ...] arrays or of objects with x/y/z keys
+    are streamed chunk_bytes at a time. Any other layout is read as a whole through pandas.
+    """
+
+    chunk_bytes = default_chunk_bytes if chunk_bytes is None else chunk_bytes
+
+    with open(path, 'rb') as f:
+        start = f.read(4096).lstrip(b'\xef\xbb\xbf \t\r\n')
+        if not start.startswith(b'['):
+            print(f'WARNING: {path} does not hold a JSON array, reading it as a whole')
+            return dataframe_coordinates(pd.read_json(path))
+
+        f.seek(0)
+        chunks = []
+        getter = None
+        for elements in _iter_json_array(f, chunk_bytes):
+            if len(elements) == 0:
+                continue
+
+            if getter is None:
+                if isinstance(elements[0], dict):
+                    keys = coordinate_columns(elements[0].keys())
+                    print(f'Found coordinate keys: {keys} for axes x/y/z respectively')
+                else:
+                    keys = [0, 1, 2]
+                getter = itemgetter(*keys)
+
+            chunks.append(np.array(list(map(getter, elements)), dtype=np.float32))
+
+    if len(chunks) == 0:
+        return np.empty((0, 3), dtype=np.float32)
+
+    return np.concatenate(chunks)
+
+
+def _iter_json_array(f: BinaryIO, chunk_bytes: int) -> Iterator[list]:
+    """Yield elements of the top level JSON array in f as lists, parsing about chunk_bytes at a time
+
+    Each chunk is cut after the last complete element, found by tracking bracket depth outside of strings
+    """
+
+    # Skip everything up to and including the opening bracket
+    head = b''
+    while b'[' not in head:
+        block = f.read(4096)
+        if len(block) == 0:
+            raise ValueError('No JSON array found')
+        head += block
+    pending = head[head.index(b'[') + 1:]
+
+    # pending always starts right after a separator of the top level array
+    while True:
+        block = f.read(chunk_bytes)
+        pending += block
+        data = np.frombuffer(pending, dtype=np.uint8)
+
+        # Only quotes, brackets and separators matter, track string state and depth over those alone
+        tokens = np.flatnonzero(_json_structural[data])
+        kinds = data[tokens]
+        is_quote = kinds == ord('"')
+
+        # Quotes preceded by an odd number of backslashes are escaped and do not end strings
+        escapable = np.flatnonzero(is_quote)
+        escapable = escapable[data[np.maximum(tokens[escapable] - 1, 0)] == ord('\\')]
+        backslashes = np.zeros(escapable.shape[0], dtype=np.int64)
+        active = np.arange(escapable.shape[0])
+        while active.size > 0:
+            backslashes[active] += 1
+            preceding = tokens[escapable[active]] - backslashes[active] - 1
+            active = active[(preceding >= 0) & (data[np.maximum(preceding, 0)] == ord('\\'))]
+        is_quote[escapable[backslashes % 2 == 1]] = False
+
+        outside = np.cumsum(is_quote) % 2 == 0
+        steps = np.zeros(kinds.shape[0], dtype=np.int64)
+        steps[(kinds == ord('[')) | (kinds == ord('{'))] = 1
+        steps[(kinds == ord(']')) | (kinds == ord('}'))] = -1
+        depth = 1 + np.cumsum(steps * outside)
+
+        end = np.flatnonzero(depth == 0)
+        if end.size > 0:
+            yield json.loads(b'[' + pending[:tokens[end[0]]] + b']')
+            return
+
+        if len(block) == 0:
+            raise ValueError('JSON array is not terminated')
+
+        separators = tokens[(kinds == ord(',')) & (depth == 1) & outside]
+        if separators.size > 0:
+            cut = separators[-1]
+            yield json.loads(b'[' + pending[:cut] + b']')
+            pending = pending[cut + 1:]
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Tuple
+
+import numpy as np
+
+
+def _nbytes(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class SliceCache:
+    """Bounded LRU cache of finished slice products, keyed by e.g. (product, view axis, index, content version)
+
+    Entries are evicted least recently used first once their total size exceeds max_bytes.
+    The cache may be filled from background threads.
+    """
+
+    default_max_bytes: int = 128 * 2**20
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (True, value) if key is cached, (False, None) otherwise"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            self._entries.move_to_end(key)
+
+            return True, entry[0]
+
+    def put(self, key: Hashable, value: Any):
+
+        nbytes = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                return
+
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            # Evict least recently used entries, but always keep the newest one
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class SlicePrefetcher:
+    """Call compute(index) for the next indices in scroll direction on a background thread
+
+    Each new request replaces all pending indices, so the prefetcher always
+    works ahead of the most recent position. Owners call stop once they are closed.
+    """
+
+    default_count: int = 8
+
+    def __init__(self, compute: Callable[[int], None], count: int = None):
+        self.compute = compute
+        self.count = self.default_count if count is None else count
+
+        self._pending: List[int] = []
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, index: int, direction: int, size: int):
+
+        direction = 1 if direction >= 0 else -1
+        indices = [index + direction * i for i in range(1, self.count + 1)]
+
+        with self._condition:
+            if self._stopped:
+                return
+            self._pending = [i for i in indices if 0 <= i < size]
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self._pending = []
+
+    def stop(self):
+        """Drop pending indices and wait for the slice currently computed, requests are ignored afterwards"""
+
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            self._condition.notify()
+
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                index = self._pending.pop(0)
+
+            try:
+                self.compute(index)
+            except Exception as _:
+                print(f'WARNING: failed to prefetch slice {index}\n{traceback.format_exc()}')
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+from typing import List, Tuple, Union
+
+import numpy as np
+
+
+class SliceIndex:
+    """Points bucketed by their integer coordinate along each of the three axes
+
+    For every axis only the permutation sorting the points by their (truncated) coordinate is stored,
+    together with CSR-style bucket offsets. All points within one slice are gathered from the
+    original points in O(k) instead of scanning all points.
+    """
+
+    def __init__(self, points: np.ndarray):
+        self.count = points.shape[0]
+        self.points = points
+        self.orders: List[np.ndarray] = []
+        self.offsets: List[np.ndarray] = []
+        self.first_index: List[int] = []
+
+        order_dtype = np.int32 if self.count < 2 ** 31 else np.int64
+        for axis in range(3):
+            keys = points[:, axis].astype(np.int64)
+            first = int(keys.min()) if self.count > 0 else 0
+            last = int(keys.max()) if self.count > 0 else -1
+
+            # Keys relative to the first slice usually fit into 16 bits, which numpy sorts by radix sort
+            keys -= first
+            if last - first < 2 ** 16:
+                keys = keys.astype(np.uint16)
+            order = np.argsort(keys, kind='stable')
+
+            # offsets[i]:offsets[i+1] are the positions of all points in slice first + i
+            offsets = np.zeros(last - first + 2, dtype=np.int64)
+            np.cumsum(np.bincount(keys, minlength=last - first + 1), out=offsets[1:])
+
+            self.orders.append(order.astype(order_dtype))
+            self.offsets.append(offsets)
+            self.first_index.append(first)
+
+    def _bucket(self, axis: int, index: int) -> slice:
+        i = index - self.first_index[axis]
+        if not 0 <= i < len(self.offsets[axis]) - 1:
+            return slice(0, 0)
+
+        return slice(self.offsets[axis][i], self.offsets[axis][i + 1])
+
+    def get_slice(self, axis: int, index: int) -> np.ndarray:
+        """Return (k, 3) coordinates of all points whose coordinate along axis truncates to index"""
+        return self.points[self.get_slice_rows(axis, index), :3]
+
+    def get_slice_rows(self, axis: int, index: int) -> np.ndarray:
+        """Return the original row indices of the points returned by get_slice"""
+        return self.orders[axis][self._bucket(axis, index)]
+
+
+class PointIndex:
+    """Points hashed into a regular grid of cubic cells for box, radius, nearest neighbor and ray queries
+
+    Points are stored sorted by cell together with CSR-style offsets for every occupied cell.
+    Occupied cells are found by binary search over their sorted linear keys, so a query only
+    touches the points within the cells it overlaps. Positions are given in the coordinates of the points,
+    radius and nearest neighbor distances are measured after multiplying all axes by scale,
+    e.g. by the voxel size to query in micrometers.
+    """
+
+    default_cell_size: float = 8.
+
+    def __init__(self, points: np.ndarray, cell_size: float = None, scale: Tuple[float, float, float] = (1., 1., 1.)):
+        self.count = points.shape[0]
+        self.cell_size = self.default_cell_size if cell_size is None else cell_size
+        self.scale = np.array(scale, dtype=np.float64)
+
+        # Original points by row
+        self.points = points
+
+        points = np.asarray(points[:, :3], dtype=np.float64)
+        self.origin = points.min(axis=0) if self.count > 0 else np.zeros(3)
+
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        self.grid_shape = cells.max(axis=0) + 1 if self.count > 0 else np.ones(3, dtype=np.int64)
+        keys = self._keys(cells)
+
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+
+        # offsets[i]:offsets[i+1] are the positions of all points in cell cell_keys[i]
+        self.rows = order
+        self.sorted_points = np.ascontiguousarray(points[order], dtype=np.float32)
+        starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))) if self.count > 0 \
+            else np.zeros(0, dtype=np.int64)
+        self.cell_keys = sorted_keys[starts]
+        self.offsets = np.append(starts, self.count)
+
+    def _keys(self, cells: np.ndarray) -> np.ndarray:
+        return (cells[..., 0] * self.grid_shape[1] + cells[..., 1]) * self.grid_shape[2] + cells[..., 2]
+
+    def _cell_range(self, lower: np.ndarray, upper: np.ndarray) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+        first = np.floor((np.asarray(lower) - self.origin) / self.cell_size).astype(np.int64)
+        last = np.floor((np.asarray(upper) - self.origin) / self.cell_size).astype(np.int64)
+
+        first = np.maximum(first, 0)
+        last = np.minimum(last, self.grid_shape - 1)
+
+        return (first, last) if np.all(first <= last) else None
+
+    def _occupied_cells(self, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+        """Return positions in cell_keys of all occupied cells from first to last cell (inclusive)"""
+
+        # Large boxes test all occupied cells instead of enumerating every cell within them
+        if np.prod(last - first + 1) > len(self.cell_keys):
+            cells = np.stack(np.unravel_index(self.cell_keys, self.grid_shape), axis=1)
+            return np.flatnonzero(np.all((cells >= first) & (cells <= last), axis=1))
+
+        axes = [np.arange(f, l + 1) for f, l in zip(first, last)]
+        keys = self._keys(np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)).ravel()
+
+        positions = np.searchsorted(self.cell_keys, keys)
+        found = positions < len(self.cell_keys)
+        found[found] = self.cell_keys[positions[found]] == keys[found]
+
+        return positions[found]
+
+    def _gather(self, cell_positions: np.ndarray) -> np.ndarray:
+        """Return positions in sorted_points of all points within the given cells"""
+
+        starts = self.offsets[cell_positions]
+        lengths = self.offsets[cell_positions + 1] - starts
+        if lengths.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Concatenate all ranges starts[i]:starts[i] + lengths[i] without a Python loop
+        shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+
+        return np.arange(lengths.sum()) + shifts
+
+    def _candidates(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        cell_range = self._cell_range(lower, upper)
+        if cell_range is None:
+            return np.zeros(0, dtype=np.int64)
+
+        return self._gather(self._occupied_cells(*cell_range))
+
+    def box(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        """Return rows of all points with lower <= point <= upper"""
+
+        candidates = self._candidates(lower, upper)
+        points = self.sorted_points[candidates]
+        inside = np.all((points >= lower) & (points <= upper), axis=1)
+
+        return self.rows[candidates[inside]]
+
+    def radius(self, center: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Return rows and distances of all points within radius of center, sorted by distance"""
+
+        center = np.asarray(center, dtype=np.float64)
+        extent = radius / self.scale
+        candidates = self._candidates(center - extent, center + extent)
+
+        distances = np.linalg.norm((self.sorted_points[candidates] - center) * self.scale, axis=1)
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+
+        return self.rows[candidates[order]], distances[order]
+
+    def nearest(self, center: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Return rows and distances of the k points closest to center, sorted by distance"""
+
+        k = min(k, self.count)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # Grow search radius until it holds at least k points, those are then guaranteed to be the closest
+        radius = self.cell_size * self.scale.min()
+        while True:
+            rows, distances = self.radius(center, radius)
+            if len(rows) >= k:
+                return rows[:k], distances[:k]
+            radius *= 2
+
+    def ray(self, origin: np.ndarray, direction: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Return rows of all points within (unscaled) radius of a ray, sorted by their depth along it, and depths"""
+
+        origin = np.asarray(origin, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64)
+        direction = direction / np.linalg.norm(direction)
+
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # Clip ray to the bounds of all points
+        lower = self.origin - radius
+        upper = self.origin + self.grid_shape * self.cell_size + radius
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (lower - origin) / direction
+            t1 = (upper - origin) / direction
+        t0, t1 = np.nan_to_num(np.minimum(t0, t1), nan=-np.inf), np.nan_to_num(np.maximum(t0, t1), nan=np.inf)
+        t_start, t_end = max(t0.max(), 0.), t1.min()
+        if t_start > t_end:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # Collect occupied cells around each cell-sized segment of the ray
+        steps = np.append(np.arange(t_start, t_end, self.cell_size), t_end)
+        cell_positions = []
+        for a, b in zip(steps[:-1], steps[1:]):
+            p, q = origin + a * direction, origin + b * direction
+            cell_range = self._cell_range(np.minimum(p, q) - radius, np.maximum(p, q) + radius)
+            if cell_range is not None:
+                cell_positions.append(self._occupied_cells(*cell_range))
+        if len(cell_positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        candidates = self._gather(np.unique(np.concatenate(cell_positions)))
+
+        offsets = self.sorted_points[candidates] - origin
+        depths = offsets @ direction
+        distances = np.linalg.norm(offsets - depths[:, None] * direction, axis=1)
+        inside = (distances <= radius) & (depths >= 0)
+        candidates, depths = candidates[inside], depths[inside]
+        order = np.argsort(depths, kind='stable')
+
+        return self.rows[candidates[order]], depths[order]
+
+
+def progressive_order(points: np.ndarray, cell_sizes: Tuple[float, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (order, counts) so that points[order][:counts[i]] is a spatially even subsample of points
+
+    The prefix of length counts[i] holds exactly one point in every occupied cell of a grid with
+    spacing cell_sizes[i], cell_sizes are expected from coarse to fine. The last entry of counts
+    is the total number of points.
+    """
+
+    count = points.shape[0]
+    origin = points.min(axis=0) if count > 0 else np.zeros(3)
+
+    # Level at which each point is first picked, all others only show up at full resolution
+    levels = np.full(count, len(cell_sizes), dtype=np.int64)
+
+    # Always picking the first point of a cell makes the subsamples nested, because the first point
+    # of a cell is also the first one of the finer cell it lies in. Coarser levels therefore only
+    # need to look at the points picked for the next finer one.
+    candidates = np.arange(count)
+    for i, cell_size in reversed(list(enumerate(cell_sizes))):
+        cells = np.floor((points[candidates] - origin) / cell_size).astype(np.int64)
+        dims = cells.max(axis=0) + 1 if len(candidates) > 0 else np.ones(3, dtype=np.int64)
+        keys = cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2])
+
+        candidates = candidates[_first_per_key(keys)]
+        levels[candidates] = i
+
+    order = np.concatenate([np.flatnonzero(levels == level) for level in range(len(cell_sizes) + 1)])
+    counts = np.cumsum(np.bincount(levels, minlength=len(cell_sizes) + 1))
+
+    return order, counts
+
+
+def _first_per_key(keys: np.ndarray) -> np.ndarray:
+    """Return sorted positions of the first occurrence of every distinct key"""
+
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    by_key = np.argsort(keys)
+    sorted_keys = keys[by_key]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+
+    return np.sort(np.minimum.reduceat(by_key, starts))
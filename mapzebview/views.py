@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from abc import abstractmethod
-from typing import Dict
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import pyqtgraph as pg
@@ -9,6 +9,12 @@ from pyqtgraph import Vector, opengl as gl
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 
 from mapzebview import config
+from mapzebview.compositing import composite_slices, members_color_lut, word_color_lut
+from mapzebview.glitems import PointCloudItem, ScalarVolumeItem, SlicePlaneItem, color_ramp_lut, scalar_volume_data
+from mapzebview.meshes import RegionMesh
+from mapzebview.slicecache import SliceCache, SlicePrefetcher
+from mapzebview.spatial import PointIndex, SliceIndex
+from mapzebview.volumes import BrickedVolume, RegionChanges, VolumePyramid
 
 try:
     from mpl_toolkits.mplot3d.art3d import Poly3DCollection
@@ -20,11 +26,20 @@ except ImportError:
 class SecionView(pg.ImageView):
 
     direction_label: str = None
+    axis: int = None
 
     sig_index_changed = QtCore.Signal(int)
+    sig_index_requested = QtCore.Signal(int, int)
+    sig_roi_picked = QtCore.Signal(str, int)
 
     last_idx: int = -1
 
+    # Distance in pixels within which a click picks a ROI
+    pick_pixel_tolerance: float = 6.
+
+    # Fraction of the visible width and height that is rendered in addition on each side
+    crop_margin: float = 0.5
+
     def __init__(self, parent):
         level_mode = 'rgba' if config.debug else 'mono'
         pg.ImageView.__init__(self, parent=parent, discreteTimeLine=True, levelMode=level_mode)
@@ -34,12 +49,35 @@ class SecionView(pg.ImageView):
         self.ui.roiBtn.hide()
         self.ui.menuBtn.hide()
 
-        # Add region image item
-        self.region_image_items: Dict[str, pg.ImageItem] = {}
+        # Add region image item, all regions are composited into this single image
+        self.region_image_item = pg.ImageItem()
+        self.region_image_item.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_ColorDodge)
+        self.region_image_item.hide()
+        self.view.addItem(self.region_image_item)
+
+        # Packed word slices for the current index and color tables, kept until their word changes
+        self.word_slices: Dict[int, Tuple[int, np.ndarray, QtCore.QRectF]] = {}
+        self.word_slice_index: int = -1
+        self.word_luts: Dict[int, Tuple[int, np.ndarray]] = {}
+        self.composited_layers: List[Tuple[np.ndarray, QtCore.QRectF, np.ndarray]] = []
+        self.composite: Tuple[np.ndarray, QtCore.QRectF] = (None, None)
+
+        # Finished marker and region slices, filled ahead of the scroll direction in the background.
+        # Marker and its version are replaced together, so other threads never pair a version with the wrong marker.
+        self.marker_source: Tuple[Union[np.ndarray, VolumePyramid, None], int] = (None, 0)
+        self.region_version: int = 0
+        self.slice_cache = SliceCache()
+        self.prefetcher = SlicePrefetcher(self.prefetch_slices)
+
         self.scatter_items: Dict[str, pg.ScatterPlotItem] = {}
-        self.scatter_coordinates: Dict[str, np.ndarray] = {}
+        self.scatter_slice_indices: Dict[str, SliceIndex] = {}
+        self.scatter_point_indices: Dict[str, PointIndex] = {}
         self.map_items: Dict[str, pg.ImageItem] = {}
-        self.map_data: Dict[str, np.ndarray] = {}
+        self.map_data: Dict[str, VolumePyramid] = {}
+
+        # Pyramid level matching the current zoom and the area around the visible part that is rendered
+        self.display_factor: int = 1
+        self.display_rect: QtCore.QRectF = None
 
         # Add lines
         self.vline = VerticalLine(self)
@@ -52,18 +90,28 @@ class SecionView(pg.ImageView):
         self.sigTimeChanged.connect(self.time_changed)
         self.sig_index_changed.connect(self.update_regions)
         self.sig_index_changed.connect(self.update_scatter)
-        # self.sig_index_changed.connect(self.update_map)
+        self.sig_index_changed.connect(self.update_map)
+        self.view.sigRangeChanged.connect(self.view_range_changed)
+        self.scene.sigMouseClicked.connect(self.mouse_clicked)
+
+    @abstractmethod
+    def get_region_slice(self, region: np.ndarray, idx: int) -> np.ndarray:
+        pass
 
     @abstractmethod
-    def get_region_slice(self, region: np.ndarray):
+    def get_slice_rect(self, offset: Tuple[int, int, int], size: Tuple[int, int, int]) -> QtCore.QRectF:
         pass
 
     @abstractmethod
-    def get_coordinate_slice(self, points: np.ndarray) -> np.ndarray:
+    def get_coordinate_slice(self, slice_index: SliceIndex) -> np.ndarray:
         pass
 
     @abstractmethod
-    def get_map_slice(self, data: np.ndarray) -> np.ndarray:
+    def get_map_slice(self, data: Union[np.ndarray, BrickedVolume], idx: int) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def get_volume_position(self, pos: QtCore.QPointF) -> np.ndarray:
         pass
 
     @abstractmethod
@@ -74,6 +122,214 @@ class SecionView(pg.ImageView):
     def ymax(self) -> int:
         pass
 
+    def marker_level(self, image: Union[np.ndarray, VolumePyramid] = None) \
+            -> Tuple[Union[np.ndarray, BrickedVolume], int]:
+        """Return marker level matching the current zoom, or the finest one loaded so far, with its downsampling factor"""
+
+        image = self.marker_source[0] if image is None else image
+        if not isinstance(image, VolumePyramid):
+            return image, 1
+
+        factor = max(image.loaded_factor, self.display_factor)
+
+        return image.level(factor), factor
+
+    def zoom_factor(self) -> int:
+        """Return coarsest pyramid factor for which one voxel still covers at least one screen pixel"""
+
+        pixel_size = self.view.viewPixelSize()
+        units_per_pixel = min(abs(pixel_size[0]), abs(pixel_size[1]))
+
+        factors = [f for f in (1, *VolumePyramid.default_factors) if f <= units_per_pixel]
+
+        return max(factors) if len(factors) > 0 else 1
+
+    def view_range_changed(self):
+
+        if self.image is None:
+            return
+
+        factor = self.zoom_factor()
+        view_rect = self.view.viewRect()
+
+        dx, dy = view_rect.width() * self.crop_margin, view_rect.height() * self.crop_margin
+        display_rect = view_rect.adjusted(-dx, -dy, dx, dy)
+
+        # Only re-render once the view leaves the rendered area, zooms in far into it or the zoom level changes
+        if factor == self.display_factor and self.display_rect is not None and self.display_rect.contains(view_rect) \
+                and self.display_rect.width() < 2 * display_rect.width():
+            return
+
+        self.display_factor = factor
+        self.display_rect = display_rect
+
+        self.updateImage(autoHistogramRange=False)
+        self.update_regions()
+        self.update_map()
+
+    def crop_to_display(self, image: np.ndarray, rect: QtCore.QRectF) -> Tuple[np.ndarray, QtCore.QRectF]:
+        """Return part of image that lies within the rendered area together with its rect"""
+
+        if self.display_rect is None or image.shape[0] == 0 or image.shape[1] == 0:
+            return image, rect
+
+        pixel_width = rect.width() / image.shape[1]
+        pixel_height = rect.height() / image.shape[0]
+
+        col_start = int(np.clip(np.floor((self.display_rect.left() - rect.left()) / pixel_width), 0, image.shape[1] - 1))
+        col_end = int(np.clip(np.ceil((self.display_rect.right() - rect.left()) / pixel_width), col_start + 1, image.shape[1]))
+        row_start = int(np.clip(np.floor((self.display_rect.top() - rect.top()) / pixel_height), 0, image.shape[0] - 1))
+        row_end = int(np.clip(np.ceil((self.display_rect.bottom() - rect.top()) / pixel_height), row_start + 1, image.shape[0]))
+
+        cropped_rect = QtCore.QRectF(rect.left() + col_start * pixel_width, rect.top() + row_start * pixel_height,
+                                     (col_end - col_start) * pixel_width, (row_end - row_start) * pixel_height)
+
+        return image[row_start:row_end, col_start:col_end], cropped_rect
+
+    def level_rect(self, shape: Tuple[int, ...], factor: int) -> QtCore.QRectF:
+        """Return rect covered by a slice of a level downsampled by factor from a volume of the given shape"""
+        return self.get_slice_rect((0, 0, 0), [-(-s // factor) * factor for s in shape[:3]])
+
+    def get_marker_slice(self, idx: int = None) -> Tuple[np.ndarray, int]:
+
+        idx = self.currentIndex if idx is None else idx
+        image, version = self.marker_source
+        volume, factor = self.marker_level(image)
+
+        key = ('marker', self.axis, idx // factor, factor, version)
+        hit, marker_slice = self.slice_cache.lookup(key)
+
+        if not hit:
+            # Marker and regions share the same (x, y, z) layout, the marker has an additional channel axis
+            marker_slice = self.get_region_slice(volume, idx // factor)
+            self.slice_cache.put(key, marker_slice)
+
+        return marker_slice, factor
+
+    def compute_region_composite(self, idx: int) -> Tuple[np.ndarray, QtCore.QRectF]:
+        """Blend all regions at idx from scratch, without touching the state used for incremental updates"""
+
+        region_volume = config.region_volume
+        if region_volume is None:
+            return None, None
+
+        # Regions may be repacked on the GUI thread meanwhile, only work on a consistent snapshot of the words
+        layers = []
+        for _, word, _, members in region_volume.snapshot(self.axis, idx):
+            word_slice = self.get_region_slice(word.data, idx - word.offset[self.axis])
+            lut = members_color_lut(members, config.region_colors)
+            layers.append((word_slice, self.get_slice_rect(word.offset, word.size), lut))
+
+        composite = composite_slices(layers)
+
+        return (None, None) if composite is None else composite
+
+    def prefetch_slices(self, idx: int):
+        """Fill slice cache for idx, called from the prefetcher thread"""
+
+        if self.marker_source[0] is None:
+            return
+
+        self.get_marker_slice(idx)
+
+        # Capture version before computing, so results of outdated region data are never looked up
+        region_key = ('regions', self.axis, idx, self.region_version)
+        if region_key not in self.slice_cache:
+            try:
+                composite = self.compute_region_composite(idx)
+            except KeyError as _:
+                # Regions are colored on the GUI thread after they are packed, this slice is composited once shown
+                return
+            self.slice_cache.put(region_key, composite)
+
+    def closeEvent(self, event):
+        self.prefetcher.stop()
+        pg.ImageView.closeEvent(self, event)
+
+    def setImage(self, img, *args, **kwargs):
+        # Slices cached for the previous marker are no longer looked up
+        self.marker_source = (img, self.marker_source[1] + 1)
+        self.display_rect = None
+
+        # Use levels precomputed for the marker instead of letting every view scan the volume
+        if isinstance(img, VolumePyramid) and img.statistics is not None and kwargs.get('levels') is None:
+            kwargs['levels'] = img.statistics.levels
+
+        pg.ImageView.setImage(self, img, *args, **kwargs)
+
+    def autoRange(self):
+        """Fit the full volume extent, the image item only covers the rendered part of it"""
+
+        if self.image is None:
+            return
+
+        self.view.setRange(self.get_slice_rect((0, 0, 0), self.image.shape[:3]))
+
+    def getProcessedImage(self):
+        """Use the value range known for bricked marker volumes instead of subsampling the full volume"""
+
+        if isinstance(self.image, np.ndarray):
+            return pg.ImageView.getProcessedImage(self)
+
+        if self.imageDisp is None:
+            self.imageDisp = self.image
+            self._imageLevels = [(self.image.min(), self.image.max())]
+            self.levelMin, self.levelMax = self._imageLevels[0]
+
+        return self.imageDisp
+
+    def updateImage(self, autoHistogramRange=True):
+        """Fetch only the current marker slice instead of transposing and indexing the full volume"""
+
+        if self.image is None:
+            return
+
+        self.getProcessedImage()
+        if autoHistogramRange:
+            self.ui.histogram.setHistogramRange(self.levelMin, self.levelMax)
+
+        self.ui.roiPlot.show()
+
+        # Slices of downsampled levels are stretched over the full volume extent
+        marker_slice, factor = self.get_marker_slice()
+        marker_slice, rect = self.crop_to_display(marker_slice, self.level_rect(self.image.shape, factor))
+        self.imageItem.updateImage(marker_slice)
+        self.imageItem.setRect(rect)
+
+    def marker_level_loaded(self):
+        self.updateImage(autoHistogramRange=False)
+
+    def timeLineChanged(self):
+        """Snap timeline to frame, but only request the new index instead of rendering it right away"""
+
+        if not self.ignoreTimeLine:
+            self.play(0)
+
+        idx, _ = self.timeIndex(self.timeLine)
+        if self.discreteTimeLine:
+            with pg.SignalBlock(self.timeLine.sigPositionChanged, self.timeLineChanged):
+                self.timeLine.setPos(self.tVals[idx] if self.tVals is not None else idx)
+
+        self.sig_index_requested.emit(self.axis, idx)
+
+    def apply_index(self, axis: int, idx: int):
+        """Render idx if it belongs to this view's axis, called once per frame by the shared view state"""
+
+        if axis != self.axis or self.image is None:
+            return
+
+        idx = min(max(idx, 0), self.nframes() - 1)
+
+        # Move timeline in case the request came from a line in another view
+        with pg.SignalBlock(self.timeLine.sigPositionChanged, self.timeLineChanged):
+            self.timeLine.setPos(self.tVals[idx])
+
+        if idx != self.currentIndex:
+            self.currentIndex = idx
+            self.updateImage()
+
+        self.sigTimeChanged.emit(idx, self.tVals[idx])
+
     def time_changed(self):
         """Check currentIndex against last_idx. This is done to prevent unnecessary update calls, since
         sigTimeChanged is also emitted on fractional changes of the timeline
@@ -83,37 +339,93 @@ class SecionView(pg.ImageView):
         if self.last_idx == cur_idx:
             return
 
+        direction = cur_idx - self.last_idx
         self.last_idx = cur_idx
 
         self.sig_index_changed.emit(cur_idx)
 
+        # Work ahead in scroll direction
+        self.prefetcher.request(cur_idx, direction, self.nframes())
+
+    def regions_changed(self, changes: RegionChanges):
+
+        if config.region_volume is None:
+            return
+
+        # Cached composites of the previous version are no longer looked up and eventually evicted
+        self.region_version += 1
+        self.prefetcher.request(self.currentIndex, 0, self.nframes())
+
+        # Only color tables of words holding recolored regions need to be rebuilt,
+        # added and removed regions change the version of their word
+        for name in changes.recolored:
+            self.word_luts.pop(config.region_volume.word_of(name), None)
+
+        self.update_regions()
+
     def update_regions(self):
 
-        # Hide all
-        for image_item in self.region_image_items.values():
-            image_item.hide()
+        key = ('regions', self.axis, self.currentIndex, self.region_version)
+        hit, composite = self.slice_cache.lookup(key)
 
-        # Update all
-        for i, (name, (region, _)) in enumerate(config.regions.items()):
+        if not hit:
+            composite = self.update_region_composite()
+            self.slice_cache.put(key, composite)
 
-            image_item = self.region_image_items.get(name)
+        rgba, rect = composite
+        if rgba is None:
+            self.region_image_item.hide()
+            return
 
-            # Create
-            if image_item is None:
-                image_item = pg.ImageItem()
-                image_item.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_ColorDodge)
-                self.view.addItem(image_item)
-                self.region_image_items[name] = image_item
+        rgba, rect = self.crop_to_display(rgba, rect)
+        self.region_image_item.setImage(rgba, levels=(0, 255))
+        self.region_image_item.setRect(rect)
+        self.region_image_item.show()
 
-            # Set colormap
-            color = config.region_colors[name]
-            cmap = pg.ColorMap(pos=[0., 1.], color=[[0, 0, 0], color], linearize=True)
-            image_item.setColorMap(cmap)
-            # image_item.setColorMap('CET-L14')
+    def update_region_composite(self) -> Tuple[np.ndarray, QtCore.QRectF]:
+        """Blend all regions at the current index, reusing word slices and color tables of unchanged words"""
 
-            region_slice = self.get_region_slice(region)
-            image_item.setImage(region_slice)
-            image_item.show()
+        if config.region_volume is None:
+            self.composited_layers = []
+            self.composite = (None, None)
+            return self.composite
+
+        region_volume = config.region_volume
+        idx = self.currentIndex
+        if idx != self.word_slice_index:
+            self.word_slices.clear()
+            self.word_slice_index = idx
+
+        # Collect packed slices of all words intersecting the current slice, reuse unchanged ones
+        layers = []
+        for word_idx in region_volume.intersecting_words(self.axis, idx):
+            word = region_volume.words[word_idx]
+            version = region_volume.versions[word_idx]
+
+            cached = self.word_slices.get(word_idx)
+            if cached is None or cached[0] != version:
+                word_slice = self.get_region_slice(word.data, idx - word.offset[self.axis])
+                cached = (version, word_slice, self.get_slice_rect(word.offset, word.size))
+                self.word_slices[word_idx] = cached
+
+            cached_lut = self.word_luts.get(word_idx)
+            if cached_lut is None or cached_lut[0] != version:
+                cached_lut = (version, word_color_lut(region_volume, word_idx, config.region_colors))
+                self.word_luts[word_idx] = cached_lut
+
+            layers.append((cached[1], cached[2], cached_lut[1]))
+
+        # Skip blending if neither slices nor colors changed
+        if len(layers) == len(self.composited_layers) \
+                and all(a[0] is b[0] and a[2] is b[2] for a, b in zip(layers, self.composited_layers)):
+            return self.composite
+        self.composited_layers = layers
+
+        # Blend into a single image
+        composite = composite_slices(layers)
+        self.composite = (None, None) if composite is None else composite
+
+        return self.composite
 
     def add_scatter(self, tree_item: QtWidgets.QTreeWidgetItem):
 
@@ -126,7 +438,8 @@ class SecionView(pg.ImageView):
             scatter_item.setBrush(pg.mkBrush(color=tree_item.color))
             self.view.addItem(scatter_item)
             self.scatter_items[name] = scatter_item
-            self.scatter_coordinates[name] = tree_item.coordinates
+            self.scatter_slice_indices[name] = tree_item.slice_index
+            self.scatter_point_indices[name] = tree_item.point_index
 
         self.update_scatter()
 
@@ -140,7 +453,7 @@ class SecionView(pg.ImageView):
             image_item.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_ColorDodge)
             self.view.addItem(image_item)
             self.map_items[name] = image_item
-            self.map_data[name] = tree_item.map_data
+            self.map_data[name] = tree_item.map_pyramid
 
             color = tree_item.color
             cmap = pg.ColorMap(pos=[0., 1.], color=[[0, 0, 0], color], linearize=True)
@@ -148,32 +461,62 @@ class SecionView(pg.ImageView):
 
         self.update_map()
 
+    def mouse_clicked(self, ev):
+
+        if ev.button() != QtCore.Qt.MouseButton.LeftButton or self.image is None:
+            return
+
+        picked = self.pick_roi(self.view.mapSceneToView(ev.scenePos()))
+        if picked is not None:
+            self.sig_roi_picked.emit(*picked)
+
+    def pick_roi(self, pos: QtCore.QPointF) -> Union[Tuple[str, int], None]:
+        """Return name and row of the ROI in the current slice closest to pos, if any is within pick tolerance"""
+
+        center = self.get_volume_position(pos)
+        tolerance = self.pick_pixel_tolerance * max(abs(s) for s in self.view.viewPixelSize())
+        plane_axes = [a for a in range(3) if a != self.axis]
+
+        # Only points whose coordinate along the axis truncates to the current index are shown
+        lower, upper = center - tolerance, center + tolerance
+        lower[self.axis] = self.currentIndex
+        upper[self.axis] = np.nextafter(self.currentIndex + 1, -np.inf)
+
+        picked, picked_distance = None, tolerance
+        for name in self.scatter_items:
+            point_index = self.scatter_point_indices[name]
+            rows = point_index.box(lower, upper)
+            if len(rows) == 0:
+                continue
+
+            distances = np.linalg.norm(point_index.points[rows][:, plane_axes] - center[plane_axes], axis=1)
+            closest = np.argmin(distances)
+            if distances[closest] <= picked_distance:
+                picked, picked_distance = (name, int(rows[closest])), distances[closest]
+
+        return picked
+
     def update_scatter(self):
 
         for name in self.scatter_items:
 
             scatter_item = self.scatter_items[name]
-            scatter_coordinates = self.scatter_coordinates[name]
+            slice_index = self.scatter_slice_indices[name]
 
-            data_slice = self.get_coordinate_slice(scatter_coordinates)
+            data_slice = self.get_coordinate_slice(slice_index)
             scatter_item.setData(*data_slice.T)
 
     def update_map(self):
 
-        # for name in self.map_items:
-        #
-        #     map_item = self.map_items[name]
-        #     map_data = self.map_data[name]
-        #
-        #     data_slice = self.get_map_slice(map_data)
-        #     map_item.setImage(data_slice)
-
         # Hide all
-        for image_item in self.region_image_items.values():
+        for image_item in self.map_items.values():
             image_item.hide()
 
+        if config.marker_image is None:
+            return
+
         # Update all
-        for i, (name, data) in enumerate(self.map_data.items()):
+        for i, (name, pyramid) in enumerate(self.map_data.items()):
 
             image_item = self.map_items.get(name)
 
@@ -182,10 +525,14 @@ class SecionView(pg.ImageView):
                 image_item = pg.ImageItem()
                 image_item.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_ColorDodge)
                 self.view.addItem(image_item)
-                self.region_image_items[name] = image_item
+                self.map_items[name] = image_item
 
-            data_slice = self.get_map_slice(data)
+            # Coarser levels are built in the background, fall back to full resolution until they are ready
+            factor = self.display_factor if self.display_factor in pyramid.levels else 1
+            data_slice = self.get_map_slice(pyramid.level(factor), self.currentIndex // factor)
+            data_slice, rect = self.crop_to_display(data_slice, self.level_rect(pyramid.shape, factor))
             image_item.setImage(data_slice)
+            image_item.setRect(rect)
             image_item.show()
 
     def update_map_color(self, tree_item: QtWidgets.QTreeWidgetItem):
@@ -215,6 +562,8 @@ class SecionView(pg.ImageView):
             scatter_item = self.scatter_items[name]
             self.view.removeItem(scatter_item)
             del self.scatter_items[name]
+            del self.scatter_slice_indices[name]
+            del self.scatter_point_indices[name]
 
     def update_vline(self, idx: int):
         self.vline.blockSignals(True)
@@ -232,22 +581,29 @@ class SecionView(pg.ImageView):
 
 class SaggitalView(SecionView):
 
+    axis = 0
+
     def update_marker_image(self):
-        self.setImage(config.marker_image[:, :, ::-1], axes={'t': 0, 'x': 1, 'y': 2, 'c': 3})
+        self.setImage(config.marker_image, axes={'t': 0, 'x': 1, 'y': 2, 'c': 3})
         self.timeLine.setPos(config.marker_image.shape[0] // 2)
 
-    def get_region_slice(self, region: np.ndarray):
-        return np.swapaxes(region[self.currentIndex, :, :], 0, 1)[::-1, :]
+    def get_region_slice(self, region: np.ndarray, idx: int) -> np.ndarray:
+        return np.swapaxes(region[idx, :, :], 0, 1)[::-1, :]
 
-    def get_coordinate_slice(self, points: np.ndarray) -> np.ndarray:
+    def get_slice_rect(self, offset: Tuple[int, int, int], size: Tuple[int, int, int]) -> QtCore.QRectF:
+        return QtCore.QRectF(offset[1], self.ymax() - offset[2] - size[2], size[1], size[2])
 
-        data_slice = points[points[:, 0].astype(int) == self.currentIndex, 1:]
-        data_slice[:, 1] = config.marker_image.shape[2] - data_slice[:, 1]
+    def get_coordinate_slice(self, slice_index: SliceIndex) -> np.ndarray:
 
-        return data_slice
+        points = slice_index.get_slice(self.axis, self.currentIndex)
 
-    def get_map_slice(self, data: np.ndarray) -> np.ndarray:
-        return np.swapaxes(data[self.currentIndex, :, :], 0, 1)[::-1, :]
+        return np.column_stack((points[:, 1], self.ymax() - points[:, 2]))
+
+    def get_map_slice(self, data: Union[np.ndarray, BrickedVolume], idx: int) -> np.ndarray:
+        return np.swapaxes(data[idx, :, :], 0, 1)[::-1, :]
+
+    def get_volume_position(self, pos: QtCore.QPointF) -> np.ndarray:
+        return np.array([self.currentIndex, pos.x(), self.ymax() - pos.y()])
 
     def ymax(self):
         return config.marker_image.shape[2]
@@ -255,22 +611,29 @@ class SaggitalView(SecionView):
 
 class CoronalView(SecionView):
 
+    axis = 2
+
     def update_marker_image(self):
-        self.setImage(config.marker_image[::-1, :, :], axes={'t': 2, 'x': 1, 'y': 0, 'c': 3})
+        self.setImage(config.marker_image, axes={'t': 2, 'x': 1, 'y': 0, 'c': 3})
         self.timeLine.setPos(config.marker_image.shape[2] // 2)
 
-    def get_region_slice(self, region: np.ndarray):
-        return region[::-1, :, self.currentIndex]
+    def get_region_slice(self, region: np.ndarray, idx: int) -> np.ndarray:
+        return region[::-1, :, idx]
+
+    def get_slice_rect(self, offset: Tuple[int, int, int], size: Tuple[int, int, int]) -> QtCore.QRectF:
+        return QtCore.QRectF(offset[1], self.ymax() - offset[0] - size[0], size[1], size[0])
 
-    def get_coordinate_slice(self, points: np.ndarray) -> np.ndarray:
+    def get_coordinate_slice(self, slice_index: SliceIndex) -> np.ndarray:
 
-        data_slice = points[points[:, 2].astype(int) == self.currentIndex, :2][:, ::-1]
-        data_slice[:, 1] = self.ymax() - data_slice[:, 1]
+        points = slice_index.get_slice(self.axis, self.currentIndex)
 
-        return data_slice
+        return np.column_stack((points[:, 1], self.ymax() - points[:, 0]))
 
-    def get_map_slice(self, data: np.ndarray) -> np.ndarray:
-        return data[::-1, :, self.currentIndex]
+    def get_map_slice(self, data: Union[np.ndarray, BrickedVolume], idx: int) -> np.ndarray:
+        return data[::-1, :, idx]
+
+    def get_volume_position(self, pos: QtCore.QPointF) -> np.ndarray:
+        return np.array([self.ymax() - pos.y(), pos.x(), self.currentIndex])
 
     def ymax(self):
         return config.marker_image.shape[0]
@@ -278,22 +641,29 @@ class CoronalView(SecionView):
 
 class TransversalView(SecionView):
 
+    axis = 1
+
     def update_marker_image(self):
-        self.setImage(config.marker_image[:, :, ::-1], axes={'t': 1, 'x': 0, 'y': 2, 'c': 3})
+        self.setImage(config.marker_image, axes={'t': 1, 'x': 0, 'y': 2, 'c': 3})
         self.timeLine.setPos(config.marker_image.shape[1] // 2)
 
-    def get_region_slice(self, region: np.ndarray):
-        return np.swapaxes(region[:, self.currentIndex, :], 0, 1)[::-1, :]
+    def get_region_slice(self, region: np.ndarray, idx: int) -> np.ndarray:
+        return np.swapaxes(region[:, idx, :], 0, 1)[::-1, :]
+
+    def get_slice_rect(self, offset: Tuple[int, int, int], size: Tuple[int, int, int]) -> QtCore.QRectF:
+        return QtCore.QRectF(offset[0], self.ymax() - offset[2] - size[2], size[0], size[2])
 
-    def get_coordinate_slice(self, points: np.ndarray) -> np.ndarray:
+    def get_coordinate_slice(self, slice_index: SliceIndex) -> np.ndarray:
 
-        data_slice = points[points[:, 1].astype(int) == self.currentIndex, ::2]
-        data_slice[:, 1] = config.marker_image.shape[2] - data_slice[:, 1]
+        points = slice_index.get_slice(self.axis, self.currentIndex)
 
-        return data_slice
+        return np.column_stack((points[:, 0], self.ymax() - points[:, 2]))
 
-    def get_map_slice(self, data: np.ndarray) -> np.ndarray:
-        return np.swapaxes(data[:, self.currentIndex, :], 0, 1)[::-1, :]
+    def get_map_slice(self, data: Union[np.ndarray, BrickedVolume], idx: int) -> np.ndarray:
+        return np.swapaxes(data[:, idx, :], 0, 1)[::-1, :]
+
+    def get_volume_position(self, pos: QtCore.QPointF) -> np.ndarray:
+        return np.array([pos.x(), self.currentIndex, self.ymax() - pos.y()])
 
     def ymax(self):
         return config.marker_image.shape[2]
@@ -336,32 +706,55 @@ class VerticalLine(MovableLine):
 
 class VolumeView(gl.GLViewWidget):
 
-    mesh_items: Dict[str, gl.GLMeshItem] = {}
-    scatter_items: Dict[str, gl.GLScatterPlotItem] = {}
+    sig_roi_picked = QtCore.Signal(str, int)
+
+    mesh_items: Dict[str, Dict[int, gl.GLMeshItem]] = {}
+    mesh_levels: Dict[str, int] = {}
     map_data: Dict[str, np.ndarray] = {}
-    map_items: Dict[str, gl.GLVolumeItem] = {}
+    map_items: Dict[str, ScalarVolumeItem] = {}
+    map_alpha: float = 0.1
 
     volume_bounds: np.ndarray = None
-    plane_color = np.array([200, 200, 100, 5])
-    plane_thickness = 3
+    plane_color = np.array([200, 200, 100, 15])
+    plane_slice_alpha: float = 0.5
+    marker_levels: Tuple[float, float] = None
+    plane_indices: Dict[int, int] = {}
+
+    # Coarsest mesh level whose clustering cells appear smaller than this (in pixels) is shown when idle
+    lod_pixel_tolerance: float = 1.
+    # Time after the last camera movement before meshes are switched back to the fine level
+    lod_idle_delay: int = 250
+
+    # Distance in pixels within which a click picks a ROI, clicks are presses released within click_distance
+    pick_pixel_tolerance: float = 6.
+    click_distance: float = 3.
 
     def __init__(self, parent):
         gl.GLViewWidget.__init__(self, parent=parent, rotationMethod='euler')
         self.opts['fov'] = 1.
-
-        sag_data = np.ones((1, 100, 100, 4)) * self.plane_color[None, None, None, :]
-        self.saggital_plane = gl.GLVolumeItem(sag_data)
-        self.saggital_plane.setGLOptions('additive')
+        self.press_pos: QtCore.QPointF = None
+
+        # Show coarse meshes while the camera moves
+        self.camera_moving = False
+        self.camera_idle_timer = QtCore.QTimer(self)
+        self.camera_idle_timer.setSingleShot(True)
+        self.camera_idle_timer.setInterval(self.lod_idle_delay)
+        self.camera_idle_timer.timeout.connect(self.camera_idle)
+
+        # All ROI sets share one point cloud
+        self.roi_cloud = PointCloudItem(size=5, pxMode=False)
+        self.roi_cloud.setGLOptions('additive')
+        self.addItem(self.roi_cloud)
+
+        # Position planes are unit squares showing the current marker slice,
+        # they are scaled and moved through their transform
+        self.saggital_plane = self.create_plane(0)
         self.addItem(self.saggital_plane)
 
-        cor_data = np.ones((100, 100, 1, 4)) * self.plane_color[None, None, None, :]
-        self.coronal_plane = gl.GLVolumeItem(cor_data)
-        self.coronal_plane.setGLOptions('additive')
+        self.coronal_plane = self.create_plane(2)
         self.addItem(self.coronal_plane)
 
-        trans_data = np.ones((100, 1, 100, 4)) * self.plane_color[None, None, None, :]
-        self.transverse_plane = gl.GLVolumeItem(trans_data)
-        self.transverse_plane.setGLOptions('additive')
+        self.transverse_plane = self.create_plane(1)
         self.addItem(self.transverse_plane)
 
     def keyPressEvent(self, ev: QtGui.QKeyEvent):
@@ -402,24 +795,126 @@ class VolumeView(gl.GLViewWidget):
 
         gl.GLViewWidget.keyPressEvent(self, ev)
 
-    def marker_image_updated(self):
+        self.camera_moved()
 
-        volume_shape = config.marker_image.shape[:3]
+    def mousePressEvent(self, ev: QtGui.QMouseEvent):
+        gl.GLViewWidget.mousePressEvent(self, ev)
 
-        self.volume_bounds = np.array(volume_shape, dtype=np.float32)
+        self.press_pos = ev.position()
+
+    def mouseReleaseEvent(self, ev: QtGui.QMouseEvent):
+        gl.GLViewWidget.mouseReleaseEvent(self, ev)
 
-        # Set plane extents
-        sag_data = (np.ones((self.plane_thickness, volume_shape[1], volume_shape[2], 4)) * self.plane_color[None, None, None, :]).astype(np.uint8)
-        self.saggital_plane.setData(sag_data)
+        if ev.button() != QtCore.Qt.MouseButton.LeftButton or self.press_pos is None:
+            return
 
-        cor_data = (np.ones((volume_shape[0], volume_shape[1], self.plane_thickness, 4)) * self.plane_color[None, None, None, :]).astype(np.uint8)
-        self.coronal_plane.setData(cor_data)
+        if (ev.position() - self.press_pos).manhattanLength() <= self.click_distance:
+            picked = self.pick_roi(ev.position())
+            if picked is not None:
+                self.sig_roi_picked.emit(*picked)
 
-        trans_data = np.ones((volume_shape[0], self.plane_thickness, volume_shape[2], 4))
-        trans_data *= self.plane_color[None, None, None, :]
-        self.transverse_plane.setData(trans_data)
+    def mouseMoveEvent(self, ev: QtGui.QMouseEvent):
+        gl.GLViewWidget.mouseMoveEvent(self, ev)
 
-        # Translate
+        if ev.buttons() != QtCore.Qt.MouseButton.NoButton:
+            self.camera_moved()
+
+    def wheelEvent(self, ev: QtGui.QWheelEvent):
+        gl.GLViewWidget.wheelEvent(self, ev)
+
+        self.camera_moved()
+
+    def camera_moved(self):
+
+        if not self.camera_moving:
+            self.camera_moving = True
+            self.update_mesh_levels()
+
+        self.camera_idle_timer.start()
+
+    def camera_idle(self):
+        self.camera_moving = False
+        self.update_mesh_levels()
+
+    def mesh_level(self) -> int:
+        """Return the coarsest level of detail that still looks like the full resolution mesh from the current camera distance"""
+
+        if self.camera_moving:
+            return len(RegionMesh.lod_cell_sizes)
+
+        pixel_per_unit = self.pixel_per_unit()
+
+        level = 0
+        for i, cell_size in enumerate(RegionMesh.lod_cell_sizes):
+            if cell_size * pixel_per_unit <= self.lod_pixel_tolerance:
+                level = i + 1
+
+        return level
+
+    def pixel_per_unit(self) -> float:
+        """Return size of one volume unit on screen at the camera center"""
+
+        distance = self.opts['distance']
+
+        return self.height() / (2 * distance * np.tan(np.radians(self.opts['fov']) / 2))
+
+    def view_ray(self, pos: QtCore.QPointF) -> Tuple[np.ndarray, np.ndarray]:
+        """Return origin and direction of the ray through widget position pos in volume coordinates"""
+
+        region = (0, 0, self.width(), self.height())
+        inverse, _ = (self.projectionMatrix(region, region) * self.viewMatrix()).inverted()
+
+        ndc_x, ndc_y = 2 * pos.x() / self.width() - 1, 1 - 2 * pos.y() / self.height()
+        near = inverse.map(QtGui.QVector4D(ndc_x, ndc_y, -1., 1.)).toVector3DAffine()
+        far = inverse.map(QtGui.QVector4D(ndc_x, ndc_y, 1., 1.)).toVector3DAffine()
+
+        origin = np.array([near.x(), near.y(), near.z()])
+        direction = np.array([far.x(), far.y(), far.z()]) - origin
+
+        # Volume X is inverted in GL view
+        origin[0] = self.volume_bounds[0] - origin[0]
+        direction[0] = -direction[0]
+
+        return origin, direction / np.linalg.norm(direction)
+
+    def pick_roi(self, pos: QtCore.QPointF) -> Union[Tuple[str, int], None]:
+        """Return name and row of the visible ROI closest to the camera along the ray through pos, if any"""
+
+        if self.volume_bounds is None:
+            return None
+
+        origin, direction = self.view_ray(pos)
+        tolerance = self.pick_pixel_tolerance / self.pixel_per_unit()
+
+        picked, picked_depth = None, np.inf
+        for name, visible in self.roi_cloud.set_visible.items():
+            if not visible or name not in config.roi_set_items:
+                continue
+
+            rows, depths = config.roi_set_items[name].point_index.ray(origin, direction, tolerance)
+            if len(rows) > 0 and depths[0] < picked_depth:
+                picked, picked_depth = (name, int(rows[0])), depths[0]
+
+        return picked
+
+    def update_mesh_levels(self):
+
+        level = self.mesh_level()
+        for name in self.mesh_levels:
+            if name in config.regions:
+                self.show_mesh(name, level)
+
+    def marker_image_updated(self):
+
+        volume_shape = config.marker_image.shape[:3]
+
+        self.volume_bounds = np.array(volume_shape, dtype=np.float32)
+        if isinstance(config.marker_image, VolumePyramid) and config.marker_image.statistics is not None:
+            self.marker_levels = config.marker_image.statistics.levels
+        else:
+            self.marker_levels = (float(config.marker_image.min()), float(config.marker_image.max()))
+
+        # Translate (plane extents are set along with their position)
         self.set_saggital_position(config.marker_image.shape[0] // 2)
         self.set_coronal_position(config.marker_image.shape[2] // 2)
         self.set_transverse_position(config.marker_image.shape[1] // 2)
@@ -432,82 +927,152 @@ class VolumeView(gl.GLViewWidget):
         if self.volume_bounds is None:
             return
 
-        self.saggital_plane.resetTransform()
-        self.saggital_plane.translate(self.volume_bounds[0]-current_idx, 0, 0)
+        self.set_plane_transform(self.saggital_plane, 0, self.volume_bounds[0]-current_idx)
+        self.update_plane_slice(self.saggital_plane, current_idx)
 
     def set_coronal_position(self, current_idx: int):
 
         if self.volume_bounds is None:
             return
 
-        self.coronal_plane.resetTransform()
-        self.coronal_plane.translate(0, 0, current_idx)
+        self.set_plane_transform(self.coronal_plane, 2, current_idx)
+        self.update_plane_slice(self.coronal_plane, current_idx)
 
     def set_transverse_position(self, current_idx: int):
 
         if self.volume_bounds is None:
             return
 
-        self.transverse_plane.resetTransform()
-        self.transverse_plane.translate(0, current_idx, 0)
+        self.set_plane_transform(self.transverse_plane, 1, current_idx)
+        self.update_plane_slice(self.transverse_plane, current_idx)
 
-    def update_scatter(self):
+    def create_plane(self, axis: int) -> SlicePlaneItem:
+        # Volume X is inverted in GL view
+        return SlicePlaneItem(axis, color=tuple(self.plane_color / 255), slice_alpha=self.plane_slice_alpha, flip_x=True)
 
-        # Hide all items
-        for scatter_item in self.scatter_items.values():
-            scatter_item.hide()
+    def set_plane_transform(self, plane: SlicePlaneItem, axis: int, position: float):
 
-        # Go through all the ones that should be displayed
-        for name, roi_tree_item in config.roi_set_items.items():
+        extent = self.volume_bounds.copy()
+        extent[axis] = 1.
+        offset = np.zeros(3)
+        offset[axis] = position
 
-            if name not in self.scatter_items:
-                coordinates = roi_tree_item.coordinates.copy()
-                coordinates[:, 0] = self.volume_bounds[0] - coordinates[:, 0]
+        plane.resetTransform()
+        plane.scale(*extent)
+        plane.translate(*offset)
 
-                scatter_item = gl.GLScatterPlotItem(size=5, color=(1., 1., 1., 1.0), pos=coordinates, pxMode=False)
-                scatter_item .setGLOptions('additive')
-                self.addItem(scatter_item)
-                self.scatter_items[name] = scatter_item
+    def marker_level_loaded(self):
 
-            scatter_item = self.scatter_items[name]
+        for plane in (self.saggital_plane, self.coronal_plane, self.transverse_plane):
+            if plane.axis in self.plane_indices:
+                self.update_plane_slice(plane, self.plane_indices[plane.axis])
 
-            # Set color
-            color = roi_tree_item.color
-            scatter_item.setData(color=color.getRgbF())
+    def update_plane_slice(self, plane: SlicePlaneItem, current_idx: int):
 
-            # Show
-            scatter_item.show()
+        self.plane_indices[plane.axis] = current_idx
 
-    def update_regions(self):
+        # Use finest marker level loaded so far, the plane stretches it over the full volume extent
+        volume = config.marker_image
+        factor = getattr(volume, 'loaded_factor', 1)
+        if factor > 1:
+            volume = volume.level(factor)
 
-        for mesh_item in self.mesh_items.values():
-            mesh_item.hide()
+        index = [slice(None)] * 3
+        index[plane.axis] = int(np.clip(current_idx, 0, self.volume_bounds[plane.axis] - 1)) // factor
+        marker_slice = volume[tuple(index)][..., 0]
 
-        for i, (name, (_, region_mesh)) in enumerate(config.regions.items()):
+        # Only the single slice is scaled to 8 bit and uploaded
+        low, high = self.marker_levels
+        if marker_slice.dtype != np.uint8 or (low, high) != (0., 255.):
+            scale = 255. / (high - low) if high > low else 0.
+            marker_slice = np.clip((marker_slice.astype(np.float32) - low) * scale, 0, 255)
 
-            if name not in self.mesh_items:
-                vecs = region_mesh.vectors.copy()
-                # Invert X for GL view
-                vecs[:, :, 0] = self.volume_bounds[0] - vecs[:, :, 0]
+        plane.setSlice(marker_slice)
+
+    def add_scatter(self, tree_item: QtWidgets.QTreeWidgetItem):
 
-                data_item = gl.MeshData(vertexes=vecs)
-                mesh_item = gl.GLMeshItem(meshdata=data_item, smooth=True, shader='balloon')
-                mesh_item.setGLOptions('additive')
+        name = tree_item.name
 
-                self.addItem(mesh_item)
-                self.mesh_items[name] = mesh_item
+        if name not in self.roi_cloud.set_slots:
+            # Progressive order was computed along with the other indexes of the set
+            positions = np.asarray(tree_item.coordinates[tree_item.progressive_order, :3], dtype=np.float32)
+            positions[:, 0] = self.volume_bounds[0] - positions[:, 0]
+            self.roi_cloud.add_set(name, positions, tree_item.level_counts, tree_item.color.getRgbF())
 
-            mesh_item = self.mesh_items[name]
+        # Added sets only become visible once they are selected
+        self.roi_cloud.show_set(name, name in config.roi_set_items)
 
-            # Show mesh
-            mesh_item.show()
+    def update_scatter_color(self, tree_item: QtWidgets.QTreeWidgetItem):
+        self.roi_cloud.set_color(tree_item.name, tree_item.color.getRgbF())
+
+    def hide_scatter(self, tree_item: QtWidgets.QTreeWidgetItem):
+        self.roi_cloud.show_set(tree_item.name, False)
+
+    def remove_scatter(self, tree_item: QtWidgets.QTreeWidgetItem):
+        self.roi_cloud.remove_set(tree_item.name)
+
+    def regions_changed(self, changes: RegionChanges):
+
+        for name in changes.removed:
+            if name in self.mesh_levels:
+                self.mesh_items[name][self.mesh_levels.pop(name)].hide()
+
+        # Only touch meshes of added and recolored regions
+        for name in changes.added | changes.recolored:
+
+            if name not in config.regions:
+                continue
+
+            self.show_mesh(name, self.mesh_levels.get(name, self.mesh_level()))
 
             # Set color
             color = config.region_colors[name].getRgbF()
 
             # Reduce alpha for volume view
+            for mesh_item in self.mesh_items[name].values():
+                mesh_item.setColor((*color[:3], color[3] / 10))
+
+    def show_mesh(self, name: str, level: int):
+
+        # Levels that collapsed for small regions are shown with the next finer one
+        level = config.regions[name].level_index(level)
+        region_items = self.mesh_items.setdefault(name, {})
+
+        # Create item for this level of detail on first use
+        if level not in region_items:
+            data_item = self.create_mesh_data(config.regions[name].level(level))
+            mesh_item = gl.GLMeshItem(meshdata=data_item, smooth=True, shader='balloon')
+            mesh_item.setGLOptions('additive')
+
+            color = config.region_colors[name].getRgbF()
             mesh_item.setColor((*color[:3], color[3] / 10))
 
+            self.addItem(mesh_item)
+            region_items[level] = mesh_item
+
+        # Swap shown level
+        current_level = self.mesh_levels.get(name)
+        if current_level is not None and current_level != level:
+            region_items[current_level].hide()
+
+        region_items[level].show()
+        self.mesh_levels[name] = level
+
+    def create_mesh_data(self, region_mesh: RegionMesh) -> gl.MeshData:
+
+        vertexes = region_mesh.vertexes.copy()
+        normals = region_mesh.normals.copy()
+
+        # Invert X for GL view
+        vertexes[:, 0] = self.volume_bounds[0] - vertexes[:, 0]
+        normals[:, 0] = -normals[:, 0]
+
+        data_item = gl.MeshData(vertexes=vertexes, faces=region_mesh.faces)
+        # Use precomputed normals, MeshData would otherwise calculate them vertex by vertex
+        data_item._vertexNormals = normals
+
+        return data_item
+
     def add_map(self, tree_item: QtWidgets.QTreeWidgetItem):
 
         name = tree_item.name
@@ -515,20 +1080,18 @@ class VolumeView(gl.GLViewWidget):
         self.map_data[name] = tree_item.map_data
 
         self.update_maps()
+        self.update_map_color(tree_item)
 
     def update_maps(self):
 
-        # for mesh_item in self.map_items.values():
-        #     mesh_item.hide()
-
         for i, (name, data) in enumerate(self.map_data.items()):
 
             if name not in self.map_items:
 
-                map_data = (np.repeat(data[::-1,:,:], 4, axis=-1) / 2**(8 * np.dtype(data.dtype).itemsize) * 255)
-                map_data[:,:,:,:3] *= np.array([1.0, 0.0, 0.0])[None, None, None, :]
-                map_data[:,:,:,-1] = 255 // 10
-                map_item = gl.GLVolumeItem(map_data.astype(np.uint8))
+                # Keep maps single channel, colors are only applied on the GPU
+                wide = np.dtype(data.dtype).itemsize > 1
+                map_data = scalar_volume_data(data, dtype=np.uint16 if wide else np.uint8, flip_x=True)
+                map_item = ScalarVolumeItem(map_data, lut=color_ramp_lut((1., 0., 0., 1.), alpha=self.map_alpha))
                 map_item.setGLOptions('additive')
                 self.addItem(map_item)
                 self.map_items[name] = map_item
@@ -538,12 +1101,15 @@ class VolumeView(gl.GLViewWidget):
             # Show mesh
             map_item.show()
 
-            # Set color
-            # color = config.region_colors[name].getRgbF()
+    def update_map_color(self, tree_item: QtWidgets.QTreeWidgetItem):
 
-            # Reduce alpha for volume view
-            # cmap = pg.ColorMap(pos=[0., 1.], color=[[0, 0, 0], tree_item.color], linearize=True)
-            # map_item.setColorMap(cmap)
+        name = tree_item.name
+
+        if name not in self.map_items:
+            return
+
+        # Only the lookup table is uploaded again
+        self.map_items[name].setLookupTable(color_ramp_lut(tree_item.color.getRgbF(), alpha=self.map_alpha))
 
 
 class PrettyView(QtWidgets.QWidget):
@@ -619,7 +1185,7 @@ class PrettyView(QtWidgets.QWidget):
 
     def update_regions(self):
 
-        for name, (_, region_mesh) in config.regions.items():
+        for name, region_mesh in config.regions.items():
             if name not in self.region_items:
                 vecs = region_mesh.vectors.copy()
                 # Invert X for GL view
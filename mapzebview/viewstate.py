@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from typing import Dict
+
+from pyqtgraph.Qt import QtCore, QtGui
+
+
+class ViewState(QtCore.QObject):
+    """Current slice index along each volume axis, shared by all linked views
+
+    Index requests from timelines and line drags are collected and applied at most once per
+    display frame by a timer-driven flush. Only the latest request per axis is applied,
+    all earlier ones within the same frame are counted as dropped. Numbers of applied and dropped
+    updates since the last report are emitted every stats_interval milliseconds while updates come in.
+    """
+
+    sig_index_changed = QtCore.Signal(int, int)
+    sig_stats = QtCore.Signal(int, int)
+
+    default_refresh_rate: float = 60.
+    stats_interval: int = 1000
+
+    def __init__(self, parent: QtCore.QObject = None):
+        QtCore.QObject.__init__(self, parent)
+
+        self.indices: Dict[int, int] = {}
+        self.pending: Dict[int, int] = {}
+        self.applied_updates: int = 0
+        self.dropped_updates: int = 0
+
+        # Flush once per display frame
+        screen = QtGui.QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen is not None else 0.
+        refresh_rate = refresh_rate if refresh_rate > 0 else self.default_refresh_rate
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
+        self.timer.setInterval(int(1000 / refresh_rate))
+        self.timer.timeout.connect(self.flush)
+
+        # Report update counts periodically
+        self.reported_updates = (0, 0)
+        self.stats_timer = QtCore.QTimer(self)
+        self.stats_timer.setInterval(self.stats_interval)
+        self.stats_timer.timeout.connect(self.report_stats)
+        self.stats_timer.start()
+
+    def set_index(self, axis: int, index: int):
+
+        if axis in self.pending:
+            self.dropped_updates += 1
+
+        self.pending[axis] = int(index)
+
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+
+        self.timer.stop()
+
+        pending, self.pending = self.pending, {}
+        for axis, index in pending.items():
+            self.indices[axis] = index
+            self.applied_updates += 1
+            self.sig_index_changed.emit(axis, index)
+
+    def report_stats(self):
+        """Emit numbers of applied and dropped updates since the last report, if there were any"""
+
+        applied = self.applied_updates - self.reported_updates[0]
+        dropped = self.dropped_updates - self.reported_updates[1]
+        if applied == 0 and dropped == 0:
+            return
+
+        self.reported_updates = (self.applied_updates, self.dropped_updates)
+        self.sig_stats.emit(applied, dropped)
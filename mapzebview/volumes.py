@@ -0,0 +1,730 @@
+from __future__ import annotations
+
+import contextlib
+import itertools
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+import numpy as np
+import tifffile
+
+
+class BrickedVolume:
+    """3D volume stored in cubic bricks of brick_size voxels per side
+
+    Bricks are kept in an array of shape (nbx, nby, nbz, B, B, B, ...), so that extracting a plane
+    touches the same amount of contiguous memory regardless of which axis is sliced.
+    For file-backed volumes the most recently used bricks are held in RAM by a small LRU cache.
+
+    Indexing supports a single integer index on one of the three spatial axes,
+    e.g. volume[idx, :, :] or volume[::-1, :, idx], and returns a regular np.ndarray.
+    """
+
+    default_brick_size: int = 32
+    default_cache_bytes: int = 64 * 2**20
+
+    def __init__(self, bricks: np.ndarray, shape: Tuple[int, ...], value_range: Tuple[float, float],
+                 cache_bytes: int = None):
+        self.bricks = bricks
+        self.brick_size = bricks.shape[3]
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = bricks.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+
+        # Only file-backed bricks need to be cached, in-memory bricks are returned as views
+        cache_bytes = self.default_cache_bytes if cache_bytes is None else cache_bytes
+        brick_nbytes = int(np.prod(bricks.shape[3:])) * self.dtype.itemsize
+        self.cache_capacity = max(1, cache_bytes // brick_nbytes) if isinstance(bricks, np.memmap) else 0
+        self._cache: OrderedDict[Tuple[int, int, int], np.ndarray] = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def grid_shape(shape: Tuple[int, ...], brick_size: int) -> Tuple[int, int, int]:
+        return tuple(-(-s // brick_size) for s in shape[:3])
+
+    @classmethod
+    def from_array(cls, data: np.ndarray, brick_size: int = None, out: np.ndarray = None) -> BrickedVolume:
+        """Rearrange data of shape (x, y, z, ...) into bricks, optionally writing to a preallocated out array"""
+
+        brick_size = cls.default_brick_size if brick_size is None else brick_size
+        grid = cls.grid_shape(data.shape, brick_size)
+        rest = data.shape[3:]
+
+        if out is None:
+            out = np.zeros((*grid, brick_size, brick_size, brick_size, *rest), dtype=data.dtype)
+
+        # Process one slab of bricks along x at a time to keep temporary copies small
+        slab = np.zeros((brick_size, grid[1] * brick_size, grid[2] * brick_size, *rest), dtype=data.dtype)
+        for bx in range(grid[0]):
+            chunk = data[bx * brick_size:(bx + 1) * brick_size]
+            slab[:] = 0
+            slab[:chunk.shape[0], :chunk.shape[1], :chunk.shape[2]] = chunk
+
+            # (B, nby * B, nbz * B, ...) -> (nby, nbz, B, B, B, ...)
+            bricks = slab.reshape(brick_size, grid[1], brick_size, grid[2], brick_size, *rest)
+            out[bx] = np.moveaxis(bricks, (1, 3), (0, 1))
+
+        value_range = (data.min(), data.max()) if data.size > 0 else (0, 0)
+
+        return cls(out, data.shape, value_range)
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike]) -> BrickedVolume:
+        """Open a bricked volume written by write_volume_cache as read-only memory map"""
+
+        bricks = np.load(brick_file_path(path), mmap_mode='r')
+        with open(metadata_file_path(path), 'r') as f:
+            metadata = json.load(f)
+
+        return cls(bricks, metadata['shape'], metadata['value_range'])
+
+    def min(self):
+        return self.value_range[0]
+
+    def max(self):
+        return self.value_range[1]
+
+    def brick(self, index: Tuple[int, int, int]) -> np.ndarray:
+
+        if self.cache_capacity == 0:
+            return self.bricks[index]
+
+        with self._cache_lock:
+            brick = self._cache.get(index)
+            if brick is not None:
+                self._cache.move_to_end(index)
+                return brick
+
+        # Pull brick into RAM and evict least recently used ones
+        brick = np.array(self.bricks[index])
+        with self._cache_lock:
+            self._cache[index] = brick
+            while len(self._cache) > self.cache_capacity:
+                self._cache.popitem(last=False)
+
+        return brick
+
+    def plane(self, axis: int, index: int) -> np.ndarray:
+        """Return plane at index along axis with remaining axes in their original order"""
+
+        if not -self.shape[axis] <= index < self.shape[axis]:
+            raise IndexError(f'Index {index} out of bounds for axis {axis} with size {self.shape[axis]}')
+        index %= self.shape[axis]
+
+        b = self.brick_size
+        brick_idx, local_idx = divmod(index, b)
+        grid = self.bricks.shape[:3]
+        ax0, ax1 = [a for a in range(3) if a != axis]
+
+        local_slice = [slice(None)] * 3
+        local_slice[axis] = local_idx
+        local_slice = tuple(local_slice)
+
+        rest = self.bricks.shape[6:]
+
+        # In-memory bricks can be gathered in one go
+        if self.cache_capacity == 0:
+            brick_slice = [slice(None)] * 6
+            brick_slice[axis] = brick_idx
+            brick_slice[3 + axis] = local_idx
+            # (grid_0, grid_1, B, B, ...) -> (grid_0 * B, grid_1 * B, ...)
+            out = np.moveaxis(self.bricks[tuple(brick_slice)], 2, 1).reshape(grid[ax0] * b, grid[ax1] * b, *rest)
+
+            return out[:self.shape[ax0], :self.shape[ax1]]
+
+        out = np.empty((grid[ax0] * b, grid[ax1] * b, *rest), dtype=self.dtype)
+        brick_pos = [0, 0, 0]
+        brick_pos[axis] = brick_idx
+        for i in range(grid[ax0]):
+            brick_pos[ax0] = i
+            for j in range(grid[ax1]):
+                brick_pos[ax1] = j
+                out[i * b:(i + 1) * b, j * b:(j + 1) * b] = self.brick(tuple(brick_pos))[local_slice]
+
+        return out[:self.shape[ax0], :self.shape[ax1]]
+
+    def slab(self, brick_idx: int) -> np.ndarray:
+        """Return all voxels within the brick_idx-th layer of bricks along axis 0 as (<=B, y, z, ...) array"""
+
+        b = self.brick_size
+        grid = self.bricks.shape[:3]
+        rest = self.bricks.shape[6:]
+
+        # (nby, nbz, B, B, B, ...) -> (B, nby * B, nbz * B, ...)
+        data = np.moveaxis(np.asarray(self.bricks[brick_idx]), (0, 1), (1, 3))
+        data = data.reshape(b, grid[1] * b, grid[2] * b, *rest)
+
+        return data[:self.shape[0] - brick_idx * b, :self.shape[1], :self.shape[2]]
+
+    def to_array(self) -> np.ndarray:
+        """Reassemble the full volume as a regular np.ndarray"""
+
+        b = self.brick_size
+        grid = self.bricks.shape[:3]
+        rest = self.bricks.shape[6:]
+
+        # (nbx, nby, nbz, B, B, B, ...) -> (nbx * B, nby * B, nbz * B, ...)
+        data = np.moveaxis(np.asarray(self.bricks), (3, 4), (1, 3))
+        data = data.reshape(grid[0] * b, grid[1] * b, grid[2] * b, *rest)
+
+        return np.ascontiguousarray(data[:self.shape[0], :self.shape[1], :self.shape[2]])
+
+    def __getitem__(self, key) -> np.ndarray:
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        int_axes = [i for i, k in enumerate(key[:3]) if isinstance(k, (int, np.integer))]
+        if len(int_axes) != 1:
+            raise IndexError('BrickedVolume only supports indexing a single plane along one of the spatial axes')
+
+        axis = int_axes[0]
+        remaining = tuple(k for i, k in enumerate(key) if i != axis)
+
+        return self.plane(axis, int(key[axis]))[remaining]
+
+
+def volume_cache_path(tif_path: Union[str, os.PathLike]) -> str:
+    return os.path.splitext(tif_path)[0]
+
+
+def brick_file_path(cache_path: Union[str, os.PathLike]) -> str:
+    return f'{cache_path}.bricks.npy'
+
+
+def metadata_file_path(cache_path: Union[str, os.PathLike]) -> str:
+    return f'{cache_path}.json'
+
+
+def load_cached_volume(tif_path: Union[str, os.PathLike]) -> BrickedVolume:
+    """Return the volume stored in tif_path as memory-mapped BrickedVolume in the viewer's (x, y, z, c) layout.
+
+    The first call converts the TIFF stack and writes it to a bricked .npy cache file next to it,
+    all subsequent calls only read the header and map the file into memory
+    """
+
+    cache_path = volume_cache_path(tif_path)
+    brick_path = brick_file_path(cache_path)
+
+    if not os.path.exists(brick_path) or os.path.getmtime(brick_path) < os.path.getmtime(tif_path):
+        write_volume_cache(tif_path, cache_path)
+
+    return BrickedVolume.open(cache_path)
+
+
+def write_volume_cache(tif_path: Union[str, os.PathLike], cache_path: Union[str, os.PathLike],
+                       brick_size: int = None):
+    print(f'Write volume cache for {tif_path} to {cache_path}')
+
+    # TIFF stacks are stored as (z, y, x), transposing gives a view in (x, y, z, c) layout
+    data = tifffile.imread(tif_path)
+    data = data.transpose(2, 1, 0)[:, :, :, None]
+
+    write_bricked_array(data, cache_path, brick_size=brick_size)
+
+
+@contextlib.contextmanager
+def atomic_write(path: Union[str, os.PathLike]) -> Iterator[str]:
+    """Yield a temporary path to write to, which only replaces path once the block completes without error
+
+    Readers therefore never see partially written files, e.g. of an interrupted cache conversion or download.
+    Nested blocks replace their files in reverse order, innermost first.
+    """
+
+    temp_path = f'{path}.tmp'
+    try:
+        yield temp_path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    os.replace(temp_path, path)
+
+
+def write_bricked_array(data: np.ndarray, cache_path: Union[str, os.PathLike], brick_size: int = None):
+
+    brick_size = BrickedVolume.default_brick_size if brick_size is None else brick_size
+
+    grid = BrickedVolume.grid_shape(data.shape, brick_size)
+    with atomic_write(metadata_file_path(cache_path)) as metadata_path, \
+            atomic_write(brick_file_path(cache_path)) as brick_path:
+        bricks = np.lib.format.open_memmap(brick_path, mode='w+', dtype=data.dtype,
+                                           shape=(*grid, brick_size, brick_size, brick_size, *data.shape[3:]))
+        volume = BrickedVolume.from_array(data, brick_size=brick_size, out=bricks)
+        bricks.flush()
+        metadata = {'shape': volume.shape, 'value_range': volume.value_range}
+        del volume, bricks
+
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+
+
+class VolumeStatistics:
+    """Intensity histogram of a volume, from which display levels are derived as percentiles"""
+
+    default_bin_count: int = 256
+    level_percentiles: Tuple[float, float] = (0.1, 99.9)
+
+    def __init__(self, counts: np.ndarray, value_range: Tuple[float, float]):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.bin_edges = np.linspace(*self.value_range, self.counts.shape[0] + 1)
+
+    @classmethod
+    def from_volume(cls, volume: BrickedVolume, bin_count: int = None) -> VolumeStatistics:
+        """Accumulate histogram in a single pass over the volume, one slab of bricks at a time"""
+
+        bin_count = cls.default_bin_count if bin_count is None else bin_count
+
+        counts = np.zeros(bin_count, dtype=np.int64)
+        for i in range(volume.bricks.shape[0]):
+            counts += np.histogram(volume.slab(i), bins=bin_count, range=volume.value_range)[0]
+
+        return cls(counts, volume.value_range)
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike]) -> VolumeStatistics:
+        with open(statistics_file_path(path), 'r') as f:
+            statistics = json.load(f)
+
+        return cls(statistics['counts'], statistics['value_range'])
+
+    def save(self, path: Union[str, os.PathLike]):
+
+        with atomic_write(statistics_file_path(path)) as statistics_path, open(statistics_path, 'w') as f:
+            json.dump({'counts': self.counts.tolist(), 'value_range': self.value_range}, f)
+
+    def min(self):
+        return self.value_range[0]
+
+    def max(self):
+        return self.value_range[1]
+
+    def percentile(self, q: float) -> float:
+        """Return value below which q percent of all voxels lie, interpolated linearly within bins"""
+
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        if cumulative[-1] == 0:
+            return self.value_range[0]
+
+        return float(np.interp(q / 100 * cumulative[-1], cumulative, self.bin_edges))
+
+    @property
+    def levels(self) -> Tuple[float, float]:
+        low, high = (self.percentile(q) for q in self.level_percentiles)
+
+        # Fall back to the full range for (nearly) constant volumes
+        return (low, high) if high > low else self.value_range
+
+
+class VolumePyramid:
+    """Full resolution volume together with copies block-averaged by factors of two
+
+    Exposes shape, dtype and value range of the full resolution volume. loaded_factor is the
+    downsampling factor of the finest level that is ready for display, it starts at the coarsest level
+    and decreases as load_level is called for finer ones, e.g. from a background thread.
+    The full resolution level may also be a plain array held in memory, its value range is then unknown.
+    """
+
+    default_factors: Tuple[int, ...] = (2, 4, 8)
+
+    def __init__(self, levels: Dict[int, Union[BrickedVolume, np.ndarray]]):
+        self.levels = levels
+
+        full = levels[1]
+        self.shape = full.shape
+        self.dtype = full.dtype
+        self.ndim = full.ndim
+        self.size = full.size
+        self.value_range = getattr(full, 'value_range', None)
+        self.statistics: VolumeStatistics = None
+
+        self.loaded_factor = max(levels)
+
+    @classmethod
+    def from_array(cls, data: np.ndarray, factors: Tuple[int, ...] = None) -> VolumePyramid:
+        """Use data with shape (x, y, z, ...) as full resolution level without copying it and build coarser levels"""
+
+        pyramid = cls({1: data, **downsample_levels(data, factors)})
+        pyramid.loaded_factor = 1
+
+        return pyramid
+
+    @property
+    def factors(self) -> List[int]:
+        return sorted(self.levels)
+
+    def min(self):
+        return self.value_range[0]
+
+    def max(self):
+        return self.value_range[1]
+
+    def level(self, factor: int) -> Union[BrickedVolume, np.ndarray]:
+        return self.levels[factor]
+
+    def load_level(self, factor: int):
+        """Read level into memory and mark it as ready"""
+
+        level = self.levels[factor]
+
+        # Downsampled levels are small enough to be held in RAM completely
+        if factor > 1:
+            self.levels[factor] = BrickedVolume(np.array(level.bricks), level.shape, level.value_range)
+
+        # Full resolution stays memory-mapped, read it once so that it is served from the page cache
+        elif isinstance(level, BrickedVolume):
+            for i in range(level.bricks.shape[0]):
+                np.array(level.bricks[i])
+
+        self.loaded_factor = min(self.loaded_factor, factor)
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.levels[1][key]
+
+
+def pyramid_cache_path(cache_path: Union[str, os.PathLike], factor: int) -> str:
+    return f'{cache_path}.x{factor}'
+
+
+def statistics_file_path(path: Union[str, os.PathLike]) -> str:
+    return f'{path}.stats.json'
+
+
+def load_cached_statistics(cache_path: Union[str, os.PathLike], volume: BrickedVolume) -> VolumeStatistics:
+    """Return statistics of the volume cached at cache_path, computing and writing them next to it on first use"""
+
+    stats_path = statistics_file_path(cache_path)
+    if os.path.exists(stats_path) and os.path.getmtime(stats_path) >= os.path.getmtime(brick_file_path(cache_path)):
+        return VolumeStatistics.open(cache_path)
+
+    print(f'Write volume statistics to {stats_path}')
+    statistics = VolumeStatistics.from_volume(volume)
+    statistics.save(cache_path)
+
+    return statistics
+
+
+def downsample_volume(volume: Union[BrickedVolume, np.ndarray], factor: int) -> np.ndarray:
+    """Return volume block-averaged by factor along all spatial axes, computed one slab of bricks at a time"""
+
+    # Plain arrays are split into slabs of about a brick's thickness
+    if isinstance(volume, np.ndarray):
+        step = factor * -(-BrickedVolume.default_brick_size // factor)
+        slabs = (volume[start:start + step] for start in range(0, volume.shape[0], step))
+
+    elif volume.brick_size % factor != 0:
+        raise ValueError(f'Brick size {volume.brick_size} is not a multiple of factor {factor}')
+
+    else:
+        slabs = (volume.slab(i) for i in range(volume.bricks.shape[0]))
+
+    data = np.concatenate([block_mean(slab, factor) for slab in slabs])
+
+    if np.issubdtype(volume.dtype, np.integer):
+        data = np.round(data)
+
+    return data.astype(volume.dtype)
+
+
+def downsample_levels(data: Union[BrickedVolume, np.ndarray], factors: Tuple[int, ...] = None) \
+        -> Dict[int, BrickedVolume]:
+    """Return bricked copies of data block-averaged by each of factors, each one generated from the next finer one"""
+
+    factors = VolumePyramid.default_factors if factors is None else factors
+
+    levels = {}
+    previous, previous_factor = data, 1
+    for factor in sorted(factors):
+        levels[factor] = BrickedVolume.from_array(downsample_volume(previous, factor // previous_factor))
+        previous, previous_factor = levels[factor], factor
+
+    return levels
+
+
+def block_mean(data: np.ndarray, factor: int) -> np.ndarray:
+    """Return mean of each block of factor voxels per side of data with shape (x, y, z, ...) as float32"""
+
+    # Repeat last voxels so that every axis splits into full blocks
+    pad = [(0, -s % factor) for s in data.shape[:3]] + [(0, 0)] * (data.ndim - 3)
+    data = np.pad(data, pad, mode='edge')
+
+    blocks = data.reshape(data.shape[0] // factor, factor, data.shape[1] // factor, factor,
+                          data.shape[2] // factor, factor, *data.shape[3:])
+
+    return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def load_cached_pyramid(tif_path: Union[str, os.PathLike], factors: Tuple[int, ...] = None) -> VolumePyramid:
+    """Return the volume stored in tif_path as VolumePyramid of memory-mapped levels
+
+    Levels missing from the cache or older than the full resolution cache are generated once and
+    written next to it. Only the coarsest level is read right away.
+    """
+
+    factors = VolumePyramid.default_factors if factors is None else factors
+
+    full = load_cached_volume(tif_path)
+    cache_path = volume_cache_path(tif_path)
+    levels = {1: full}
+
+    # Each level is generated from the next finer one
+    previous, previous_factor = full, 1
+    for factor in sorted(factors):
+        level_path = pyramid_cache_path(cache_path, factor)
+        level_brick_path = brick_file_path(level_path)
+
+        if not os.path.exists(level_brick_path) \
+                or os.path.getmtime(level_brick_path) < os.path.getmtime(brick_file_path(cache_path)):
+            print(f'Write {factor}x downsampled volume cache to {level_path}')
+            write_bricked_array(downsample_volume(previous, factor // previous_factor), level_path,
+                                brick_size=full.brick_size)
+
+        levels[factor] = BrickedVolume.open(level_path)
+        previous, previous_factor = levels[factor], factor
+
+    pyramid = VolumePyramid(levels)
+    pyramid.statistics = load_cached_statistics(cache_path, full)
+    pyramid.load_level(max(levels))
+
+    return pyramid
+
+
+class RegionMask:
+    """Binary mask cropped to its bounding box, placed at offset within a volume of the given full shape"""
+
+    def __init__(self, data: BrickedVolume, offset: Tuple[int, int, int], shape: Tuple[int, ...]):
+        self.data = data
+        self.offset = tuple(int(o) for o in offset)
+        self.size = tuple(int(s) for s in data.shape[:3])
+        self.shape = tuple(int(s) for s in shape[:3])
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray) -> RegionMask:
+
+        mask = mask > 0
+
+        # Find bounding box from projections onto each axis
+        bounds = []
+        for axis in range(3):
+            nonzero = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+            bounds.append((nonzero[0], nonzero[-1] + 1) if nonzero.size > 0 else (0, 0))
+
+        crop = mask[tuple(slice(start, end) for start, end in bounds)]
+
+        return cls(BrickedVolume.from_array(crop), [start for start, _ in bounds], mask.shape)
+
+    @property
+    def empty(self) -> bool:
+        return 0 in self.size
+
+    def contains(self, axis: int, index: int) -> bool:
+        return self.offset[axis] <= index < self.offset[axis] + self.size[axis]
+
+
+class RegionChanges:
+    """Names of regions added, removed or recolored in one update"""
+
+    def __init__(self, added: Iterable[str] = (), removed: Iterable[str] = (), recolored: Iterable[str] = ()):
+        self.added: Set[str] = set(added)
+        self.removed: Set[str] = set(removed)
+        self.recolored: Set[str] = set(recolored)
+
+    def __repr__(self):
+        return f'RegionChanges(added={self.added}, removed={self.removed}, recolored={self.recolored})'
+
+
+class PackedRegionVolume:
+    """Masks of all selected regions packed as single bits into bricked uint8 word volumes
+
+    Each word holds up to 8 regions and is cropped to the joint bounding box of its regions.
+    New regions are added to the word whose bounding box grows least, so small nuclei stay small.
+    Slices of all regions are extracted from the packed words, regions whose bounding box does not
+    contain the requested slice are skipped without touching any data.
+
+    Every word carries a version number that changes whenever the word is repacked,
+    so that consumers can keep derived data of unchanged words. Regions are added and removed
+    under a lock, readers on other threads take a consistent snapshot of the words first.
+    """
+
+    bits_per_word: int = 8
+
+    def __init__(self, shape: Tuple[int, ...]):
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.words: List[Union[RegionMask, None]] = []
+        self.versions: List[int] = []
+        self._version_counter = itertools.count()
+        self.locations: Dict[str, Tuple[int, int]] = {}
+        self.bounds: Dict[str, Tuple[Tuple[int, int, int], Tuple[int, int, int]]] = {}
+        self.lock = threading.RLock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.bounds
+
+    @staticmethod
+    def _union(*bounds: Tuple[Tuple[int, ...], Tuple[int, ...]]) -> Tuple[np.ndarray, np.ndarray]:
+        start = np.min([offset for offset, _ in bounds], axis=0)
+        end = np.max([np.add(offset, size) for offset, size in bounds], axis=0)
+
+        return start, end
+
+    def _free_location(self, mask: RegionMask) -> Tuple[int, int]:
+
+        # Pick the word with a free bit, whose bounding box grows least by adding the mask
+        best_location = None
+        best_growth = int(np.prod(mask.size))
+        for word_idx, word in enumerate(self.words):
+            used_bits = {bit for w, bit in self.locations.values() if w == word_idx}
+            if len(used_bits) == self.bits_per_word:
+                continue
+
+            growth = int(np.prod(mask.size))
+            if word is not None:
+                start, end = self._union((word.offset, word.size), (mask.offset, mask.size))
+                growth = int(np.prod(end - start)) - int(np.prod(word.size))
+
+            if best_location is None or growth < best_growth:
+                bit = min(set(range(self.bits_per_word)) - used_bits)
+                best_location, best_growth = (word_idx, bit), growth
+
+        if best_location is None:
+            self.words.append(None)
+            self.versions.append(next(self._version_counter))
+            best_location = (len(self.words) - 1, 0)
+
+        return best_location
+
+    def _repack_word(self, word_idx: int, clear_bit: int = None, add: Tuple[int, RegionMask] = None):
+        """Rebuild a word cropped to the bounding box of its current regions"""
+
+        members = [name for name, (w, _) in self.locations.items() if w == word_idx]
+
+        if len(members) == 0:
+            self.words[word_idx] = None
+            self.versions[word_idx] = next(self._version_counter)
+
+            # Drop trailing empty words
+            while len(self.words) > 0 and self.words[-1] is None:
+                self.words.pop()
+                self.versions.pop()
+
+            return
+
+        start, end = self._union(*[self.bounds[name] for name in members])
+        data = np.zeros(end - start, dtype=np.uint8)
+
+        # Copy the part of the previous word that overlaps with the new bounding box
+        old = self.words[word_idx]
+        if old is not None:
+            old_data = old.data.to_array()
+            if clear_bit is not None:
+                old_data &= ~np.uint8(1 << clear_bit)
+
+            overlap_start = np.maximum(start, old.offset)
+            overlap_end = np.minimum(end, np.add(old.offset, old.size))
+            if np.all(overlap_end > overlap_start):
+                dst = tuple(slice(s, e) for s, e in zip(overlap_start - start, overlap_end - start))
+                src = tuple(slice(s, e) for s, e in zip(overlap_start - old.offset, overlap_end - old.offset))
+                data[dst] = old_data[src]
+
+        if add is not None:
+            bit, mask = add
+            dst = tuple(slice(o - s, o - s + n) for o, s, n in zip(mask.offset, start, mask.size))
+            data[dst] |= (mask.data.to_array() > 0).astype(np.uint8) << np.uint8(bit)
+
+        self.words[word_idx] = RegionMask(BrickedVolume.from_array(data), start, self.shape)
+        self.versions[word_idx] = next(self._version_counter)
+
+    def add(self, name: str, mask: RegionMask):
+
+        if mask.shape != self.shape:
+            raise ValueError(f'Region mask shape {mask.shape} does not match volume shape {self.shape}')
+
+        with self.lock:
+            if name in self.bounds:
+                self.remove(name)
+
+            self.bounds[name] = (mask.offset, mask.size)
+
+            # Empty regions never show up in any slice
+            if mask.empty:
+                return
+
+            word_idx, bit = self._free_location(mask)
+            self.locations[name] = (word_idx, bit)
+            self._repack_word(word_idx, add=(bit, mask))
+
+    def remove(self, name: str):
+
+        with self.lock:
+            self.bounds.pop(name, None)
+
+            if name not in self.locations:
+                return
+
+            word_idx, bit = self.locations.pop(name)
+            self._repack_word(word_idx, clear_bit=bit)
+
+    def word_members(self, word_idx: int) -> Dict[str, int]:
+        """Return bit position of every region stored in word"""
+        return {name: bit for name, (w, bit) in self.locations.items() if w == word_idx}
+
+    def word_of(self, name: str) -> Union[int, None]:
+        location = self.locations.get(name)
+        return None if location is None else location[0]
+
+    def intersecting_words(self, axis: int, index: int) -> List[int]:
+        """Return indices of all words with a region intersecting the plane at index along axis"""
+
+        intersecting_words = set()
+        for name, (word_idx, _) in self.locations.items():
+            offset, size = self.bounds[name]
+            if offset[axis] <= index < offset[axis] + size[axis]:
+                intersecting_words.add(word_idx)
+
+        return sorted(intersecting_words)
+
+    def snapshot(self, axis: int, index: int) -> List[Tuple[int, RegionMask, int, Dict[str, int]]]:
+        """Return (word index, word, version, member bits) of all words intersecting the plane, taken under the lock"""
+
+        with self.lock:
+            return [(word_idx, self.words[word_idx], self.versions[word_idx], self.word_members(word_idx))
+                    for word_idx in self.intersecting_words(axis, index)]
+
+    def word_slices(self, axis: int, index: int, get_slice: Callable[[BrickedVolume, int], np.ndarray]) \
+            -> List[Tuple[int, np.ndarray, Tuple[int, int, int], Tuple[int, int, int]]]:
+        """Return (word index, packed slice, offset, size) of all words with a region intersecting the plane
+
+        get_slice is called once per word with the word data and the index relative to the word.
+        Words whose regions do not intersect the plane are rejected without touching any data.
+        """
+
+        word_slices = []
+        for word_idx in self.intersecting_words(axis, index):
+            word = self.words[word_idx]
+            word_slices.append((word_idx, get_slice(word.data, index - word.offset[axis]), word.offset, word.size))
+
+        return word_slices
+
+    def slices(self, axis: int, index: int, get_slice: Callable[[BrickedVolume, int], np.ndarray]) \
+            -> Dict[str, Tuple[np.ndarray, Tuple[int, int, int], Tuple[int, int, int]]]:
+        """Return binary slices at index along axis for all regions intersecting that plane
+
+        Returned slices cover the bounding box of the word each region is stored in
+        and are returned together with its offset and size.
+        """
+
+        region_slices = {}
+        for word_idx, word_slice, offset, size in self.word_slices(axis, index, get_slice):
+            for name, bit in self.word_members(word_idx).items():
+                region_offset, region_size = self.bounds[name]
+                if region_offset[axis] <= index < region_offset[axis] + region_size[axis]:
+                    region_slices[name] = ((word_slice >> bit) & 1, offset, size)
+
+        return region_slices
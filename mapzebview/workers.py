@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import traceback
+from typing import Any, Callable
+
+from pyqtgraph.Qt import QtCore
+
+
+class WorkerSignals(QtCore.QObject):
+    sig_progress = QtCore.Signal(str, float)
+    sig_finished = QtCore.Signal(str, object)
+    sig_failed = QtCore.Signal(str, str)
+
+
+class Worker(QtCore.QRunnable):
+    """Run fun(name, progress_callback) on a thread pool and report back through Qt signals
+
+    Signals are emitted from the worker thread and delivered as queued calls
+    to receivers living in the GUI thread
+    """
+
+    def __init__(self, name: str, fun: Callable[[str, Callable[[float], None]], Any]):
+        QtCore.QRunnable.__init__(self)
+        self.setAutoDelete(False)
+
+        self.name = name
+        self.fun = fun
+        self.signals = WorkerSignals()
+
+    def progress(self, fraction: float):
+        self.signals.sig_progress.emit(self.name, fraction)
+
+    def run(self):
+        try:
+            result = self.fun(self.name, self.progress)
+        except Exception as _:
+            self.signals.sig_failed.emit(self.name, traceback.format_exc())
+        else:
+            self.signals.sig_finished.emit(self.name, result)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+from mapzebview.atlas import count_points, flatten_structure, load_cached_atlas
+
+shape = (20, 16, 12)
+
+# Preorder: a (0), b (1), c (2), d (3), e (4), where b and c lie within a and d within c
+structure = {'a': {'b': 2., 'c': {'d': 2.}}, 'e': 2.}
+
+
+def _box(start, end):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[tuple(slice(s, e) for s, e in zip(start, end))] = 255
+    return mask
+
+
+masks = {
+    'a': _box((0, 0, 0), (10, 16, 12)),
+    'b': _box((0, 0, 0), (5, 8, 12)),
+    'c': _box((5, 0, 0), (10, 16, 12)),
+    'd': _box((6, 2, 2), (8, 4, 4)),
+    'e': _box((12, 0, 0), (20, 16, 6)),
+}
+
+
+@pytest.fixture
+def atlas_path(tmp_path):
+    for name, mask in masks.items():
+        np.save(tmp_path / f'{name}.npy', mask)
+
+    return tmp_path / 'atlas'
+
+
+def _source_path(atlas_path):
+    return lambda name: os.path.join(os.path.dirname(atlas_path), f'{name}.npy')
+
+
+def _load_mask(atlas_path):
+    return lambda name: np.load(_source_path(atlas_path)(name))
+
+
+def test_flatten_structure():
+    names, parents = flatten_structure(structure)
+
+    assert names == ['a', 'b', 'c', 'd', 'e']
+    np.testing.assert_array_equal(parents, [-1, 0, 0, 2, -1])
+
+
+def test_lookup(atlas_path):
+    atlas = load_cached_atlas(atlas_path, structure, _load_mask(atlas_path), source_path=_source_path(atlas_path))
+
+    points = np.array([[1, 1, 1], [7, 3, 3], [7.9, 3.5, 3.9], [6, 10, 10], [15, 2, 2], [15, 2, 8], [-1, 0, 0],
+                       [20, 0, 0]])
+    np.testing.assert_array_equal(atlas.lookup(points), [1, 3, 3, 2, 4, -1, -1, -1])
+
+    ids, paths = atlas.query(points[:2])
+    np.testing.assert_array_equal(paths, [[0, 1, -1], [0, 2, 3]])
+    assert atlas.name_of(ids[1]) == 'd' and atlas.name_of(-1) is None
+
+
+def test_roll_up(atlas_path):
+    atlas = load_cached_atlas(atlas_path, structure, _load_mask(atlas_path), source_path=_source_path(atlas_path))
+
+    np.testing.assert_array_equal(atlas.roll_up(np.array([1, 2, 3, 4, 5])), [10, 2, 7, 4, 5])
+
+    # Voxels of each region are counted including its subregions
+    expected = [np.count_nonzero(masks[name]) for name in atlas.names]
+    np.testing.assert_array_equal(atlas.roll_up(atlas.voxel_counts), expected)
+
+
+def test_count_points(atlas_path):
+    atlas = load_cached_atlas(atlas_path, structure, _load_mask(atlas_path), source_path=_source_path(atlas_path))
+
+    points = np.random.default_rng(0).uniform(-2, 22, size=(5000, 3))
+    counts = count_points(atlas, points)
+
+    ids = atlas.lookup(points)
+    direct = np.array([np.count_nonzero(ids == i) for i in range(len(atlas.names))])
+    np.testing.assert_array_equal(counts.direct_counts, direct)
+    np.testing.assert_array_equal(counts.counts, atlas.roll_up(direct))
+    np.testing.assert_allclose(counts.fractions, counts.counts / len(points))
+    assert counts.to_dataframe().loc['a', 'count'] == direct[:4].sum()
+
+    # Results are cached per content of points
+    assert count_points(atlas, points.copy()) is counts
+    assert count_points(atlas, points[:-1]) is not counts
+
+
+def test_cached_atlas_rebuilt_on_changes(atlas_path):
+    load_mask, source_path = _load_mask(atlas_path), _source_path(atlas_path)
+
+    version = load_cached_atlas(atlas_path, structure, load_mask, source_path=source_path).version
+    assert load_cached_atlas(atlas_path, structure, load_mask, source_path=source_path).version == version
+
+    # Changed region file of the same size, stamped later in case the file system's timestamps are coarse
+    mtime = os.stat(source_path('e')).st_mtime_ns
+    np.save(source_path('e'), _box((12, 0, 0), (20, 16, 4)))
+    os.utime(source_path('e'), ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    atlas = load_cached_atlas(atlas_path, structure, load_mask, source_path=source_path)
+    assert atlas.version != version
+    assert atlas.voxel_counts[4] == 8 * 16 * 4
+
+    # Changed structure
+    atlas = load_cached_atlas(atlas_path, {'e': 2.}, load_mask, source_path=source_path)
+    assert atlas.names == ['e']
@@ -0,0 +1,59 @@
+import numpy as np
+from pyqtgraph.Qt import QtCore, QtGui
+
+from mapzebview.compositing import bit_color_lut, composite_slices, members_color_lut
+
+
+def test_bit_color_lut():
+    colors = np.arange(24, dtype=np.float32).reshape(8, 3)
+
+    lut = bit_color_lut(colors)
+
+    assert lut.shape == (256, 3)
+    np.testing.assert_array_equal(lut[0], 0)
+    np.testing.assert_array_equal(lut[0b101], colors[0] + colors[2])
+    np.testing.assert_array_equal(lut[255], colors.sum(axis=0))
+
+
+def test_members_color_lut():
+    region_colors = {'a': QtGui.QColor(255, 0, 0, 255), 'b': QtGui.QColor(0, 0, 255, 51)}
+
+    lut = members_color_lut({'a': 3, 'b': 0}, region_colors)
+
+    # Colors are premultiplied by their alpha
+    np.testing.assert_allclose(lut[1 << 3], [255, 0, 0])
+    np.testing.assert_allclose(lut[1], [0, 0, 51])
+    np.testing.assert_allclose(lut[1 << 3 | 1 | 1 << 5], [255, 0, 51])
+
+
+def test_composite_slices():
+    rng = np.random.default_rng(0)
+    region_colors = {name: QtGui.QColor(*rng.integers(0, 256, size=3), int(rng.integers(1, 256)))
+                     for name in 'abcdefghij'}
+
+    # Two overlapping words of 8 and 2 regions
+    layers = []
+    words = [({name: bit for bit, name in enumerate('abcdefgh')}, QtCore.QRectF(2, 3, 10, 6)),
+             ({'i': 0, 'j': 4}, QtCore.QRectF(7, 1, 8, 5))]
+    for members, rect in words:
+        word_slice = rng.integers(0, 256, size=(int(rect.height()), int(rect.width())), dtype=np.uint8)
+        layers.append((word_slice, rect, members_color_lut(members, region_colors)))
+
+    rgba, rect = composite_slices(layers)
+
+    assert rect == QtCore.QRectF(2, 1, 13, 8)
+    assert rgba.shape == (8, 13, 4)
+
+    # Reference sums the color of every region separately
+    expected = np.zeros((8, 13, 3))
+    for (members, word_rect), (word_slice, _, _) in zip(words, layers):
+        x, y = int(word_rect.x() - rect.x()), int(word_rect.y() - rect.y())
+        for name, bit in members.items():
+            r, g, b, a = region_colors[name].getRgbF()
+            inside = ((word_slice >> bit) & 1).astype(bool)
+            expected[y:y + word_slice.shape[0], x:x + word_slice.shape[1]][inside] += np.array([r, g, b]) * a * 255
+
+    np.testing.assert_allclose(rgba[..., :3], np.clip(expected, 0, 255).astype(np.uint8), atol=1)
+    np.testing.assert_array_equal(rgba[..., 3], np.where(expected.any(axis=-1), 255, 0))
+
+    assert composite_slices([]) is None
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import stl
+
+from mapzebview.meshes import RegionMesh, decimate, weld_vertexes
+
+
+@pytest.fixture
+def vectors():
+    """Triangle soup of a UV sphere with radius 20, the faces at the poles are degenerate"""
+
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, 25), np.linspace(0, 2 * np.pi, 49), indexing='ij')
+    grid = 20 * np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=-1)
+
+    # Close the seam exactly, so that its corners are welded
+    grid[:, -1] = grid[:, 0]
+
+    a, b, c, d = grid[:-1, :-1], grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:]
+    triangles = np.concatenate([np.stack([a, b, c], axis=-2), np.stack([a, c, d], axis=-2)])
+
+    return triangles.reshape(-1, 3, 3).astype(np.float32)
+
+
+def test_weld_vertexes(vectors):
+    vertexes, faces = weld_vertexes(vectors)
+
+    assert faces.max() < len(vertexes)
+    assert len(np.unique(vertexes, axis=0)) == len(vertexes)
+
+    # Only the faces collapsed at the poles are dropped, all others are kept as they were
+    soup = vectors.reshape(-1, 3, 3)
+    degenerate = np.array([len(np.unique(triangle, axis=0)) < 3 for triangle in soup])
+    assert len(faces) == np.count_nonzero(~degenerate)
+    np.testing.assert_array_equal(vertexes[faces], soup[~degenerate])
+
+
+def test_decimate(vectors):
+    vertexes, faces = weld_vertexes(vectors)
+
+    for cell_size in (2., 8., 50.):
+        decimated_vertexes, decimated_faces = decimate(vertexes, faces, cell_size)
+
+        assert decimated_faces.dtype == np.uint32
+        assert len(decimated_faces) <= len(faces)
+        if len(decimated_faces) > 0:
+            assert decimated_faces.max() < len(decimated_vertexes)
+
+            # Every vertex is referenced and faces do not collapse
+            assert len(np.unique(decimated_faces)) == len(decimated_vertexes)
+            assert np.all(decimated_faces[:, 0] != decimated_faces[:, 1])
+            assert np.all(decimated_faces[:, 1] != decimated_faces[:, 2])
+            assert np.all(decimated_faces[:, 0] != decimated_faces[:, 2])
+
+
+def test_level_index(vectors):
+    data = np.zeros(len(vectors), dtype=stl.mesh.Mesh.dtype)
+    data['vectors'] = vectors
+    mesh = RegionMesh.from_stl(stl.mesh.Mesh(data))
+
+    assert mesh.level_count == len(RegionMesh.lod_cell_sizes) + 1
+    assert mesh.level_index(0) == 0
+    assert mesh.level(0) is mesh
+
+    # Levels with too few faces fall back to the next finer one
+    face_counts = [len(level.faces) for level in mesh.levels]
+    for idx in range(1, mesh.level_count + 2):
+        level_idx = mesh.level_index(idx)
+        assert level_idx <= min(idx, len(mesh.levels))
+        assert level_idx == 0 or face_counts[level_idx - 1] >= RegionMesh.lod_min_faces
+        assert mesh.level(idx) is (mesh if level_idx == 0 else mesh.levels[level_idx - 1])
+
+    mesh.levels[-1] = RegionMesh(*decimate(mesh.vertexes, mesh.faces, 1000.))
+    assert len(mesh.levels[-1].faces) < RegionMesh.lod_min_faces
+    assert mesh.level_index(len(mesh.levels)) == len(mesh.levels) - 1
+
+
+def test_save_open(vectors, tmp_path):
+    mesh = RegionMesh(*weld_vertexes(vectors))
+    mesh.levels = [RegionMesh(*decimate(mesh.vertexes, mesh.faces, cell_size))
+                   for cell_size in RegionMesh.lod_cell_sizes]
+
+    mesh.save(tmp_path / 'mesh.npz')
+    opened = RegionMesh.open(tmp_path / 'mesh.npz')
+
+    np.testing.assert_array_equal(opened.vectors, mesh.vectors)
+    np.testing.assert_array_equal(opened.normals, mesh.normals)
+    assert [len(level.faces) for level in opened.levels] == [len(level.faces) for level in mesh.levels]
+    assert not (tmp_path / 'mesh.npz.tmp').exists()
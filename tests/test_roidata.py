@@ -0,0 +1,65 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from mapzebview.roidata import _iter_json_array, coordinate_columns, read_csv_coordinates, read_json_coordinates
+
+
+def test_coordinate_columns_by_name():
+    assert coordinate_columns(['z', 'y', 'x']) == ['x', 'y', 'z']
+    assert coordinate_columns(['a', 'b', 'c']) == ['a', 'b', 'c']
+
+
+def test_read_csv_spaced_header(tmp_path):
+    path = tmp_path / 'rois.csv'
+    path.write_text('id, z, y, x\n0, 3.0, 2.0, 1.0\n1, 6.0, 5.0, 4.0\n')
+
+    coordinates = read_csv_coordinates(str(path), chunk_rows=1)
+
+    assert coordinates.dtype == np.float32
+    np.testing.assert_array_equal(coordinates, [[1., 2., 3.], [4., 5., 6.]])
+
+
+def test_read_csv_without_header(tmp_path):
+    path = tmp_path / 'rois.csv'
+    path.write_text('1.0;2.0;3.0;9.0\n4.0;5.0;6.0;9.0\n')
+
+    np.testing.assert_array_equal(read_csv_coordinates(str(path)), [[1., 2., 3.], [4., 5., 6.]])
+
+
+def _json_elements():
+    names = ['plain', 'quote " inside', 'ends with backslash \\', '\\" mixed', '[bracket', 'brace}',
+             '"], {"x": 1}, ["', 'comma, here']
+    return [{'name': name, 'x': i, 'y': [i, [i]], 'z': {'v': i}} for i, name in enumerate(names)]
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 3, 7, 4096])
+def test_iter_json_array_strings(chunk_bytes):
+    elements = _json_elements()
+    data = json.dumps(elements, indent=1).encode()
+
+    parsed = [element for chunk in _iter_json_array(io.BytesIO(data), chunk_bytes) for element in chunk]
+
+    assert parsed == elements
+
+
+def test_iter_json_array_errors():
+    with pytest.raises(ValueError):
+        list(_iter_json_array(io.BytesIO(b'{"a": 1}'), 4))
+    with pytest.raises(ValueError):
+        list(_iter_json_array(io.BytesIO(b'[[1, 2, 3], [4, 5'), 4))
+
+    assert list(_iter_json_array(io.BytesIO(b' [ ] '), 4)) == [[]]
+
+
+def test_read_json_coordinates(tmp_path):
+    path = tmp_path / 'rois.json'
+    path.write_text(json.dumps([{'label': '"]', 'z': 3.0, 'y': 2.0, 'x': 1.0},
+                                {'label': '\\', 'z': 6.0, 'y': 5.0, 'x': 4.0}]))
+
+    np.testing.assert_array_equal(read_json_coordinates(str(path), chunk_bytes=2), [[1., 2., 3.], [4., 5., 6.]])
+
+    path.write_text('[[1, 2, 3, 9], [4, 5, 6, 9]]')
+    np.testing.assert_array_equal(read_json_coordinates(str(path), chunk_bytes=2), [[1., 2., 3.], [4., 5., 6.]])
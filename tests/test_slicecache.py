@@ -0,0 +1,65 @@
+import threading
+
+import numpy as np
+
+from mapzebview.slicecache import SliceCache, SlicePrefetcher
+
+
+def test_cache_evicts_least_recently_used():
+    cache = SliceCache(max_bytes=3 * 100)
+    for i in range(3):
+        cache.put(i, np.zeros(100, dtype=np.uint8))
+
+    # Looking up entry 0 makes entry 1 the least recently used one
+    assert cache.lookup(0)[0]
+    cache.put(3, (np.zeros(50, dtype=np.uint8), np.zeros(50, dtype=np.uint8)))
+
+    assert 1 not in cache
+    assert all(key in cache for key in (0, 2, 3))
+    assert cache.nbytes == 300
+    assert cache.lookup(1) == (False, None)
+
+
+def test_cache_keeps_newest_entry():
+    cache = SliceCache(max_bytes=10)
+    cache.put('small', np.zeros(5, dtype=np.uint8))
+    cache.put('large', np.zeros(100, dtype=np.uint8))
+
+    assert 'small' not in cache and 'large' in cache
+
+    # Existing entries are not replaced
+    cache.put('large', None)
+    assert cache.lookup('large')[1] is not None
+
+    cache.clear()
+    assert cache.nbytes == 0 and 'large' not in cache
+
+
+def test_prefetcher_computes_ahead_and_stops():
+    computed = []
+    started, release, done = threading.Event(), threading.Event(), threading.Event()
+
+    def compute(index):
+        computed.append(index)
+        started.set()
+        release.wait(5)
+        if index == 7:
+            raise KeyError(index)
+        if index == 8:
+            done.set()
+
+    prefetcher = SlicePrefetcher(compute, count=3)
+    prefetcher.request(5, -1, size=10)
+    assert started.wait(5)
+
+    # New requests replace the indices still pending, a failed index does not stop the prefetcher
+    prefetcher.request(5, 1, size=9)
+    release.set()
+    assert done.wait(5)
+    assert computed == [4, 6, 7, 8]
+
+    prefetcher.stop()
+    assert not prefetcher._thread.is_alive()
+
+    prefetcher.request(0, 1, size=10)
+    assert computed == [4, 6, 7, 8]
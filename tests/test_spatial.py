@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from mapzebview.spatial import PointIndex, SliceIndex, progressive_order
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+
+    # Clustered and uniform points, with a few exact duplicates
+    points = np.concatenate([rng.uniform(0, 60, size=(1500, 3)), rng.normal(30, 2, size=(500, 3))])
+    points[-10:] = points[:10]
+
+    return points.astype(np.float32)
+
+
+def test_slice_index(points):
+    index = SliceIndex(points)
+
+    for axis in range(3):
+        keys = points[:, axis].astype(np.int64)
+        for i in range(keys.min() - 1, keys.max() + 2):
+            rows = index.get_slice_rows(axis, i)
+            np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(keys == i))
+            np.testing.assert_array_equal(index.get_slice(axis, i), points[rows, :3])
+
+    assert index.orders[0].dtype == np.int32
+
+
+def test_box(points):
+    index = PointIndex(points, cell_size=4.)
+
+    for lower, upper in [((10, 10, 10), (20, 30, 25)), ((-5, -5, -5), (100, 100, 100)), ((70, 0, 0), (80, 5, 5))]:
+        lower, upper = np.array(lower), np.array(upper)
+        expected = np.flatnonzero(np.all((points >= lower) & (points <= upper), axis=1))
+        np.testing.assert_array_equal(np.sort(index.box(lower, upper)), expected)
+
+
+def test_radius(points):
+    scale = (0.8, 0.8, 2.)
+    index = PointIndex(points, cell_size=4., scale=scale)
+
+    for center, radius in [((30, 30, 30), 5.), ((0, 0, 0), 12.), ((30, 30, 30), 0.)]:
+        distances = np.linalg.norm((points - np.array(center)) * scale, axis=1)
+        rows, found_distances = index.radius(np.array(center), radius)
+
+        np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(distances <= radius))
+        np.testing.assert_allclose(found_distances, np.sort(distances[distances <= radius]), rtol=1e-5)
+        assert np.all(np.diff(found_distances) >= 0)
+
+
+def test_nearest(points):
+    index = PointIndex(points, cell_size=4.)
+
+    for center in [(30, 30, 30), (-50, 10, 10), (59, 59, 0)]:
+        distances = np.linalg.norm(points - np.array(center), axis=1)
+        rows, found_distances = index.nearest(np.array(center), k=5)
+
+        np.testing.assert_allclose(found_distances, np.sort(distances)[:5], rtol=1e-5)
+        np.testing.assert_allclose(distances[rows], found_distances, rtol=1e-5)
+
+    assert len(index.nearest(np.zeros(3), k=len(points) + 1)[0]) == len(points)
+
+
+def test_ray(points):
+    index = PointIndex(points, cell_size=4.)
+
+    for origin, direction in [((-10, 30, 30), (1, 0, 0)), ((0, 0, 0), (1, 1, 1)), ((30, 30, 100), (0, 0, -1))]:
+        origin = np.array(origin, dtype=np.float64)
+        direction = np.array(direction, dtype=np.float64) / np.linalg.norm(direction)
+
+        offsets = points - origin
+        depths = offsets @ direction
+        distances = np.linalg.norm(offsets - depths[:, None] * direction, axis=1)
+        expected = np.flatnonzero((distances <= 1.5) & (depths >= 0))
+
+        rows, found_depths = index.ray(origin, direction, 1.5)
+
+        np.testing.assert_array_equal(np.sort(rows), expected)
+        assert np.all(np.diff(found_depths) >= 0)
+
+
+def test_empty_index():
+    index = PointIndex(np.zeros((0, 3)))
+
+    assert len(index.box(np.zeros(3), np.ones(3))) == 0
+    assert len(index.radius(np.zeros(3), 1.)[0]) == 0
+    assert len(index.nearest(np.zeros(3))[0]) == 0
+    assert len(index.ray(np.zeros(3), np.ones(3), 1.)[0]) == 0
+
+
+def test_progressive_order(points):
+    cell_sizes = (16., 4.)
+    order, counts = progressive_order(points, cell_sizes)
+
+    np.testing.assert_array_equal(np.sort(order), np.arange(len(points)))
+    assert counts[-1] == len(points)
+
+    # Each prefix holds exactly one point per occupied cell of its level
+    origin = points.min(axis=0)
+    for cell_size, count in zip(cell_sizes, counts):
+        cells = np.floor((points - origin) / cell_size).astype(np.int64)
+        prefix_cells = cells[order[:count]]
+        assert len(np.unique(prefix_cells, axis=0)) == count == len(np.unique(cells, axis=0))
@@ -0,0 +1,40 @@
+import os
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from pyqtgraph.Qt import QtWidgets
+
+from mapzebview.viewstate import ViewState
+
+app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def test_updates_coalesced_per_axis():
+    view_state = ViewState()
+    emitted = []
+    view_state.sig_index_changed.connect(lambda axis, index: emitted.append((axis, index)))
+
+    for index in range(5):
+        view_state.set_index(0, index)
+    view_state.set_index(1, 7)
+    view_state.set_index(1, 3)
+    view_state.flush()
+
+    assert sorted(emitted) == [(0, 4), (1, 3)]
+    assert view_state.indices == {0: 4, 1: 3}
+    assert view_state.applied_updates == len(emitted)
+    assert view_state.dropped_updates == 7 - len(emitted)
+
+
+def test_stats_report_updates_since_last_report():
+    view_state = ViewState()
+    reports = []
+    view_state.sig_stats.connect(lambda applied, dropped: reports.append((applied, dropped)))
+
+    view_state.set_index(0, 1)
+    view_state.set_index(0, 2)
+    view_state.flush()
+    view_state.report_stats()
+    view_state.report_stats()
+
+    assert reports == [(1, 1)]
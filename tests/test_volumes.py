@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from mapzebview.volumes import BrickedVolume, PackedRegionVolume, RegionMask, VolumePyramid, block_mean, \
+    write_bricked_array
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).integers(0, 200, size=(37, 20, 11, 2), dtype=np.uint8)
+
+
+def test_bricked_plane_matches_take(data):
+    volume = BrickedVolume.from_array(data, brick_size=8)
+
+    for axis in range(3):
+        for index in (0, 7, 8, data.shape[axis] - 1):
+            np.testing.assert_array_equal(volume.plane(axis, index), np.take(data, index, axis=axis))
+
+
+def test_bricked_plane_from_file_matches_take(data, tmp_path):
+    write_bricked_array(data, tmp_path / 'volume', brick_size=8)
+    volume = BrickedVolume.open(tmp_path / 'volume')
+
+    assert volume.cache_capacity > 0
+    assert volume.value_range == (data.min(), data.max())
+    for axis in range(3):
+        for index in (0, 9, data.shape[axis] - 1):
+            np.testing.assert_array_equal(volume.plane(axis, index), np.take(data, index, axis=axis))
+
+
+def test_bricked_getitem(data):
+    volume = BrickedVolume.from_array(data, brick_size=8)
+
+    np.testing.assert_array_equal(volume[5, :, :], data[5, :, :])
+    np.testing.assert_array_equal(volume[::-1, :, 3], data[::-1, :, 3])
+    np.testing.assert_array_equal(volume[:, -1], data[:, -1])
+    np.testing.assert_array_equal(volume.to_array(), data)
+
+    with pytest.raises(IndexError):
+        volume[1, 2, :]
+    with pytest.raises(IndexError):
+        volume.plane(0, data.shape[0])
+
+
+def test_block_mean():
+    data = np.arange(5 * 4 * 3, dtype=np.float32).reshape(5, 4, 3)
+
+    mean = block_mean(data, 2)
+
+    assert mean.shape == (3, 2, 2)
+    assert mean[0, 0, 0] == data[:2, :2, :2].mean()
+
+    # Incomplete blocks at the end repeat the last voxels
+    assert mean[2, 1, 1] == data[4:, 2:, 2:].mean()
+
+
+def test_pyramid_levels(data):
+    pyramid = VolumePyramid.from_array(data, factors=(2, 4))
+
+    assert pyramid.factors == [1, 2, 4]
+    assert pyramid.level(1) is data
+    assert pyramid.loaded_factor == 1
+    assert pyramid.value_range is None
+
+    for factor in (2, 4):
+        level = pyramid.level(factor)
+        assert level.shape == (*(-(-s // factor) for s in data.shape[:3]), 2)
+        assert level.dtype == data.dtype
+
+    # Coarser levels are built from the next finer one, both agree on blocks not touching the border
+    expected = np.round(block_mean(np.round(block_mean(data[:16, :16, :8], 2)), 2))
+    np.testing.assert_array_equal(pyramid.level(4).to_array()[:4, :4, :2], expected)
+
+
+def _sphere(shape, center, radius):
+    grid = np.indices(shape)
+    return np.sum((grid - np.reshape(center, (3, 1, 1, 1))) ** 2, axis=0) < radius ** 2
+
+
+def _assert_packed_slices(region_volume, masks):
+
+    for axis in range(3):
+        for index in range(region_volume.shape[axis]):
+            slices = region_volume.slices(axis, index, lambda data, i: data.plane(axis, i))
+
+            for name, mask in masks.items():
+                plane = np.take(mask, index, axis=axis)
+                if name not in slices:
+                    assert not plane.any()
+                    continue
+
+                # Slices cover the word's bounding box, the region must be all zero outside of it
+                region_slice, offset, size = slices[name]
+                crop = tuple(slice(o, o + s) for a, (o, s) in enumerate(zip(offset, size)) if a != axis)
+                np.testing.assert_array_equal(region_slice, plane[crop])
+                assert region_slice.sum() == plane.sum()
+
+
+def test_packed_regions_add_remove_readd():
+    shape = (24, 20, 16)
+    masks = {f'region{i}': _sphere(shape, (2 + 2 * i, 10, 8), 1 + i % 4) for i in range(10)}
+
+    region_volume = PackedRegionVolume(shape)
+    for name, mask in masks.items():
+        region_volume.add(name, RegionMask.from_array(mask))
+
+    # Ten regions need two words of eight bits
+    assert len(region_volume.words) == 2
+    _assert_packed_slices(region_volume, masks)
+
+    removed = {name: masks.pop(name) for name in ('region1', 'region8')}
+    for name in removed:
+        region_volume.remove(name)
+        assert name not in region_volume
+    _assert_packed_slices(region_volume, masks)
+
+    masks.update(removed)
+    for name, mask in removed.items():
+        region_volume.add(name, RegionMask.from_array(mask))
+    _assert_packed_slices(region_volume, masks)
+
+    # Repacked words get a new version
+    word_idx = region_volume.word_of('region0')
+    version = region_volume.versions[word_idx]
+    region_volume.add('region0', RegionMask.from_array(masks['region0']))
+    assert region_volume.versions[region_volume.word_of('region0')] != version
+    _assert_packed_slices(region_volume, masks)